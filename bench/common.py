@@ -0,0 +1,113 @@
+"""
+Shared pieces of the benchmarks: timing summaries, memory use, and saving
+results and comparing them with a baseline.
+
+A results file is JSON: {"kind", "meta", "results": {name: stats}}, where
+stats holds at least p50/p95/p99 in milliseconds. compare() matches
+results by name and flags any whose p50 or p95 got slower than the baseline
+by more than the tolerance.
+"""
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def summarize(seconds, elapsed=None):
+    """Latency stats in milliseconds for a list of durations in seconds, plus ops/s if elapsed is given."""
+    values = sorted(seconds)
+    stats = {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 4) if values else 0.0,
+        "p50": round(percentile(values, 0.50) * 1000, 4),
+        "p95": round(percentile(values, 0.95) * 1000, 4),
+        "p99": round(percentile(values, 0.99) * 1000, 4),
+        "max": round(values[-1] * 1000, 4) if values else 0.0,
+    }
+    if elapsed:
+        stats["throughput"] = round(len(values) / elapsed, 2)
+    return stats
+
+def rss_mb():
+    """Resident memory of this process in MB (peak RSS where the current value isn't available)."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def meta(**extra):
+    return dict(extra, python=platform.python_version(), platform=platform.platform(),
+                time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+
+def save(path, kind, results, info):
+    with open(path, 'w') as f:
+        json.dump({"kind": kind, "meta": info, "results": results}, f, indent=2)
+
+def compare(results, baseline_path, tolerance):
+    """
+    Prints every result next to its baseline and returns the names that
+    regressed: p50 or p95 more than `tolerance` (e.g. 0.2 for 20%) slower.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)["results"]
+    regressed = []
+    print(f"\n{'name':48} {'p50 base':>10} {'p50 now':>10} {'change':>8}   {'p95 base':>10} {'p95 now':>10} {'change':>8}")
+    for name, stats in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:48} {'(new)':>10} {stats['p50']:10.3f}")
+            continue
+        changes = []
+        for key in ("p50", "p95"):
+            changes.append((stats[key] - old[key]) / old[key] if old[key] else 0.0)
+        flag = ""
+        # Sub-10µs timings are mostly noise; don't call those regressions.
+        if any(change > tolerance for change in changes) and stats["p50"] > 0.01:
+            regressed.append(name)
+            flag = "  <-- slower"
+        print(f"{name:48} {old['p50']:10.3f} {stats['p50']:10.3f} {changes[0]:+8.0%}   "
+              f"{old['p95']:10.3f} {stats['p95']:10.3f} {changes[1]:+8.0%}{flag}")
+    for name in baseline:
+        if name not in results:
+            print(f"{name:48} (missing from this run)")
+    return regressed
+
+def finish(args, kind, results, info):
+    """Saves and compares results as asked on the command line. Returns the exit code."""
+    if args.out:
+        save(args.out, kind, results, info)
+        print(f"\nResults saved to {args.out}")
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            save(args.baseline, kind, results, info)
+            print(f"No baseline at {args.baseline} yet; saved this run as the baseline.")
+            return 0
+        regressed = compare(results, args.baseline, args.tolerance)
+        if regressed:
+            print(f"\n{len(regressed)} result(s) more than {args.tolerance:.0%} slower than the baseline.")
+            return 1
+        print("\nNo regressions against the baseline.")
+    return 0
+
+def add_output_args(parser):
+    parser.add_argument("--out", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with this results file (saved there if it doesn't exist yet).")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Slowdown of p50 or p95 over the baseline counted as a regression (default 0.2 = 20%%).")
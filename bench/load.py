@@ -0,0 +1,165 @@
+"""
+HTTP load generator for /instruct, /search and /timeheap.
+
+    python -m bench.load [--duration 10] [--concurrency 8] [--endpoints instruct,search_index,...]
+                         [--entries 1000] [--latency 0.05] [--url http://host:port]
+                         [--out results.json] [--baseline bench/baseline-load.json]
+
+By default the server runs in this process on a free port, with the stub
+model (QAPI_STUB_LATENCY per model turn), a temporary data directory seeded
+with --entries entries per store, and the archiver off. No network or API
+key is needed. With --url the load goes to a running server as it is, and
+the server's memory isn't reported.
+
+Each endpoint gets its own phase: --concurrency workers send requests back
+to back for --duration seconds. Endpoints:
+
+    instruct        POST /instruct, a new prompt every time (one tool call, then an answer)
+    search_index    POST /search?mode=index, BM25 index only
+    search_llm      POST /search, a new query every time so the answer cache never hits
+    timeheap        GET /timeheap
+    timeheap_etag   GET /timeheap with If-None-Match, answered 304 while nothing changes
+
+429s (model busy) are counted apart from errors and left out of the latency stats.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from bench.common import add_output_args, finish, meta, rss_mb, summarize
+from bench.micro import WORDS, make_entries
+
+ENDPOINTS = ("instruct", "search_index", "search_llm", "timeheap", "timeheap_etag")
+
+# Every stub session makes one small tool call and then answers.
+STUB_SCRIPT = [
+    {"match": "The user wants to search", "turns": [
+        {"function_calls": [{"name": "load_summaries", "args": {"store_name": "user_goals_map", "limit": 20}}]},
+        {"text": "Found a few matching goals."},
+    ]},
+    {"turns": [
+        {"function_calls": [{"name": "load_summaries", "args": {"store_name": "timeheap", "limit": 20}}]},
+        {"text": "Done."},
+    ]},
+]
+
+def start_server(entries, latency, concurrency):
+    """Starts the app in a thread on a temporary data directory. Returns its base URL."""
+    workdir = tempfile.mkdtemp(prefix="qapi-load-")
+    script_path = os.path.join(workdir, "stub.json")
+    with open(script_path, 'w') as f:
+        json.dump(STUB_SCRIPT, f)
+    os.environ.update(QAPI_LLM_BACKEND="stub", QAPI_STUB_SCRIPT=script_path, QAPI_STUB_LATENCY=str(latency),
+                      QAPI_ARCHIVE_INTERVAL="0")
+    # Don't let the model limiter turn the benchmark into a 429 test.
+    os.environ.setdefault("QAPI_LLM_MAX_CONCURRENT", str(concurrency))
+    os.environ.setdefault("QAPI_LLM_MAX_WAITING", str(concurrency * 2))
+    # server.log is written to the working directory.
+    os.chdir(workdir)
+
+    from server import handlers
+    handlers.DATA_DIR = os.path.join(workdir, "data")
+    os.makedirs(handlers.DATA_DIR)
+    rng = random.Random(0)
+    start_ts = time.time() + 3600
+    for store in ("user_goals_map", "timeheap", "agent_context", "user_context"):
+        handlers.write_data(store, make_entries(entries, rng, start_ts))
+
+    from werkzeug.serving import make_server
+    from server.app import app
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def make_request(endpoint, url, session, counter, etag):
+    """Sends one request for an endpoint. Returns the response."""
+    if endpoint == "instruct":
+        return session.post(f"{url}/instruct", json={"prompt": f"Benchmark instruct {counter}: what's next today?"})
+    if endpoint == "search_index":
+        return session.post(f"{url}/search?mode=index", json={"query": " ".join(random.sample(WORDS, 2))})
+    if endpoint == "search_llm":
+        return session.post(f"{url}/search", json={"query": f"{' '.join(random.sample(WORDS, 2))} {counter}"})
+    headers = {"If-None-Match": etag} if endpoint == "timeheap_etag" and etag else {}
+    return session.get(f"{url}/timeheap", headers=headers)
+
+def run_phase(endpoint, url, duration, concurrency):
+    """Runs one endpoint's phase and returns its stats."""
+    import requests
+
+    etag = requests.get(f"{url}/timeheap").headers.get("ETag") if endpoint == "timeheap_etag" else None
+    lock = threading.Lock()
+    latencies, statuses, counters = [], {}, iter(range(10 ** 9))
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            with lock:
+                counter = next(counters)
+            started = time.perf_counter()
+            try:
+                status = make_request(endpoint, url, session, counter, etag).status_code
+            except requests.exceptions.RequestException:
+                status = "connection error"
+            took = time.perf_counter() - started
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status in (200, 304):
+                    latencies.append(took)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    stats = summarize(latencies, time.perf_counter() - started)
+    stats["busy"] = statuses.pop(429, 0)
+    stats["errors"] = sum(count for status, count in statuses.items() if status not in (200, 304))
+    stats["statuses"] = {str(status): count for status, count in statuses.items()}
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP load generator")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per endpoint (default 10).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients (default 8).")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"Comma-separated, from: {', '.join(ENDPOINTS)}.")
+    parser.add_argument("--entries", type=int, default=1000, help="Entries seeded per store (default 1000).")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub model seconds per turn (default 0.05).")
+    parser.add_argument("--url", help="Load a running server instead of starting one.")
+    add_output_args(parser)
+    args = parser.parse_args()
+
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(",") if endpoint.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoint(s): {', '.join(sorted(unknown))}")
+
+    # start_server changes directory.
+    args.out, args.baseline = [os.path.abspath(path) if path else path for path in (args.out, args.baseline)]
+    url = args.url.rstrip("/") if args.url else start_server(args.entries, args.latency, args.concurrency)
+    results, memory = {}, {}
+    for endpoint in endpoints:
+        print(f"Loading {endpoint} for {args.duration:g}s with {args.concurrency} clients...", file=sys.stderr)
+        results[endpoint] = run_phase(endpoint, url, args.duration, args.concurrency)
+        if not args.url:
+            memory[endpoint] = rss_mb()
+
+    print(f"\n{'endpoint':16} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'busy':>6} {'errors':>6}")
+    for endpoint, stats in results.items():
+        print(f"{endpoint:16} {stats.get('throughput', 0):9.1f} {stats['p50']:9.2f} {stats['p95']:9.2f} "
+              f"{stats['p99']:9.2f} {stats['max']:9.2f} {stats['busy']:6} {stats['errors']:6}")
+    if memory:
+        print("\nServer RSS after each phase (MB): " + ", ".join(f"{name}: {mb}" for name, mb in memory.items()))
+    info = meta(url=args.url or "in-process", duration=args.duration, concurrency=args.concurrency,
+                entries=args.entries, latency=args.latency, rss_mb=memory)
+    return finish(args, "load", results, info)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+Microbenchmarks for the store handlers at store sizes from 10 to 100k entries.
+
+    python -m bench.micro [--sizes 10,100,1000,10000,100000] [--mode file|journal|sqlite]
+                          [--out results.json] [--baseline bench/baseline-micro.json]
+
+Each size runs in its own process with a fresh data directory, so caches,
+locks and memory use don't carry over from one size to the next. Every
+operation is repeated until it has run --reps times or for --seconds,
+whichever comes first (but at least 5 times), and reported as
+p50/p95/p99 milliseconds under "<operation>@<size>". Results are named the
+same across runs, so a saved baseline can be compared with later ones.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from bench.common import add_output_args, finish, meta, rss_mb, summarize
+
+DEFAULT_SIZES = "10,100,1000,10000,100000"
+
+WORDS = [f"{stem}{suffix}" for stem in ("plan", "call", "write", "read", "pay", "fix", "gym", "cook", "email",
+                                        "study", "clean", "meet", "ship", "review", "train", "sleep")
+         for suffix in ("", "s", "ing", "ed", "er", "ly", "able", "ment")]
+
+def make_entries(count, rng, start_ts):
+    entries = []
+    for position in range(count):
+        description = " ".join(rng.choice(WORDS) for _ in range(12))
+        due_ts = start_ts + position * 60
+        entries.append({
+            "id": f"e{position}",
+            "description": description,
+            "truncated_desc": description[:100],
+            "entry_date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_ts - 86400)),
+            "due_date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(due_ts)),
+        })
+    return entries
+
+def measure(fn, reps, seconds):
+    """Runs fn() repeatedly and returns the durations in seconds."""
+    durations = []
+    deadline = time.perf_counter() + seconds
+    while len(durations) < reps and (len(durations) < 5 or time.perf_counter() < deadline):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+def run_size(size, reps, seconds):
+    """Benchmarks every handler against stores of `size` entries. Runs in a child process."""
+    data_dir = tempfile.mkdtemp(prefix=f"qapi-bench-{size}-")
+    from server import handlers
+    handlers.DATA_DIR = data_dir
+    from server import timeheap
+    from server.search import search
+
+    rng = random.Random(size)
+    start_ts = time.time() + 3600
+    store = "user_goals_map"
+    for name in (store, "timeheap"):
+        handlers.write_data(name, make_entries(size, rng, start_ts))
+    ids = [f"e{position}" for position in range(size)]
+    middle = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_ts + size * 30))
+    window_end = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_ts + size * 30 + 3600))
+    appended = []
+
+    def append():
+        entry_id = f"a{len(appended)}-{time.perf_counter_ns()}"
+        appended.append(entry_id)
+        handlers.append_data(store, {"id": entry_id, "description": " ".join(rng.choice(WORDS) for _ in range(12))})
+
+    def delete():
+        handlers.delete_data_entry(store, appended.pop() if appended else rng.choice(ids))
+
+    def batch():
+        handlers.batch_mutate([{"op": "append", "store_name": store, "entry": {"description": f"batch {position}"}}
+                               for position in range(10)])
+
+    results = {}
+    def bench(name, fn, reps=reps):
+        results[f"{name}@{size}"] = summarize(measure(fn, reps, seconds))
+
+    started = time.perf_counter()
+    handlers._drop_cached_store(store)
+    handlers.read_data(store)
+    results[f"read_data_cold@{size}"] = summarize([time.perf_counter() - started])
+
+    bench("read_data", lambda: handlers.read_data(store))
+    bench("get_store_version", lambda: handlers.get_store_version(store))
+    bench("load_memory", lambda: handlers.load_memory(store, rng.choice(ids)))
+    bench("load_summaries", lambda: handlers.load_summaries(store, limit=50))
+    bench("load_entries", lambda: handlers.load_entries(store, rng.sample(ids, min(10, size))))
+    bench("find_entries_by_date", lambda: handlers.find_entries_by_date("timeheap", "due_date", middle, window_end))
+    bench("timeheap_peek", timeheap.peek)
+    bench("timeheap_due", lambda: timeheap.due(before=start_ts + size * 30, limit=50))
+
+    started = time.perf_counter()
+    search("plan review", stores=[store])
+    results[f"search_index_build@{size}"] = summarize([time.perf_counter() - started])
+    bench("search_index", lambda: search(" ".join(rng.sample(WORDS, 2)), stores=[store]))
+
+    # Writes last, they change the store.
+    bench("append_data", append)
+    bench("delete_data_entry", delete)
+    bench("batch_mutate_10", batch)
+    return {"results": results, "rss_mb": rss_mb()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Handler microbenchmarks")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Comma-separated store sizes (default {DEFAULT_SIZES}).")
+    parser.add_argument("--mode", choices=["file", "journal", "sqlite"],
+                        help="Store mode to benchmark (default: QAPI_STORE_MODE, or file).")
+    parser.add_argument("--reps", type=int, default=200, help="Repetitions per operation (default 200).")
+    parser.add_argument("--seconds", type=float, default=2.0, help="Time cap per operation (default 2).")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    add_output_args(parser)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_size(args.child, args.reps, args.seconds)))
+        return 0
+
+    mode = args.mode or os.getenv("QAPI_STORE_MODE", "file")
+    env = dict(os.environ, QAPI_STORE_MODE=mode)
+    results, memory = {}, {}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print(f"Benchmarking {size} entries ({mode} mode)...", file=sys.stderr)
+        child = subprocess.run([sys.executable, "-m", "bench.micro", "--child", str(size), "--reps", str(args.reps),
+                                "--seconds", str(args.seconds)], env=env, capture_output=True, text=True)
+        if child.returncode != 0:
+            print(child.stderr, file=sys.stderr)
+            return child.returncode
+        report = json.loads(child.stdout.strip().splitlines()[-1])
+        results.update(report["results"])
+        memory[size] = report["rss_mb"]
+
+    print(f"\n{'operation':40} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'runs':>6}")
+    for name, stats in results.items():
+        print(f"{name:40} {stats['p50']:10.3f} {stats['p95']:10.3f} {stats['p99']:10.3f} {stats['count']:6}")
+    print("\nRSS after each size (MB): " + ", ".join(f"{size}: {mb}" for size, mb in memory.items()))
+    return finish(args, "micro", results, meta(mode=mode, rss_mb=memory))
+
+if __name__ == "__main__":
+    sys.exit(main())
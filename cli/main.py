@@ -1,13 +1,77 @@
 import click
-import requests
 from datetime import datetime, timezone
 import time
-import subprocess
 import sys
+import json
+import os
+import socket
 
-print("Executing cli/main.py")
+# requests and subprocess are imported where they're first needed, so
+# `--help` and the commands that don't use them skip those imports. Most of
+# what's left of startup is the interpreter and click itself.
 
-SERVER_URL = "http://127.0.0.1:5000"
+SERVER_URL = os.getenv("QAPI_SERVER_URL", "http://127.0.0.1:5000")
+
+REMINDER_DAEMON_ADDRESS = ("127.0.0.1", int(os.getenv("QAPI_REMINDER_PORT", "5055")))
+REMINDER_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'reminder', 'main.py')
+
+def reminder_daemon_command(command):
+    """Sends one command to the reminder daemon and returns its reply."""
+    with socket.create_connection(REMINDER_DAEMON_ADDRESS, timeout=5) as sock:
+        sock.sendall((json.dumps(command) + "\n").encode())
+        reply = sock.makefile('r').readline()
+    return json.loads(reply)
+
+def ensure_reminder_daemon():
+    """Starts the reminder daemon unless one is already running."""
+    try:
+        reminder_daemon_command({"op": "list"})
+        return
+    except OSError:
+        pass
+
+    import subprocess
+    click.echo("Starting reminder daemon...")
+    if sys.platform == "win32":
+        flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        subprocess.Popen([sys.executable, REMINDER_SCRIPT_PATH, "--daemon"], creationflags=flags)
+    else:
+        subprocess.Popen([sys.executable, REMINDER_SCRIPT_PATH, "--daemon"], start_new_session=True,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        time.sleep(0.1)
+        try:
+            reminder_daemon_command({"op": "list"})
+            return
+        except OSError:
+            continue
+    raise OSError("reminder daemon did not start, see reminder.log")
+
+_session = None
+
+def session():
+    """
+    The HTTP session every command shares: one kept-alive, pooled connection
+    to the server. Connection failures are retried with backoff, and so are
+    GETs answered with 502/503/504.
+    """
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry = Retry(total=3, connect=3, read=0, status=3, backoff_factor=0.3,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET", "HEAD"}))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        _session = requests.Session()
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+def request_error():
+    """The requests exception class, for except clauses (only imported once something failed)."""
+    import requests
+    return requests.exceptions.RequestException
 
 @click.group()
 def cli():
@@ -18,109 +82,194 @@ def cli():
 def healthcheck():
     """Checks the health of the Qapi server."""
     try:
-        response = requests.get(f"{SERVER_URL}/healthcheck")
+        response = session().get(f"{SERVER_URL}/healthcheck")
         response.raise_for_status()
         click.echo(response.json())
-    except requests.exceptions.RequestException as e:
+    except request_error() as e:
         click.echo(f"Error connecting to the server: {e}")
 
+def wait_for_job(job_id):
+    """Long-polls the server until a job finishes and returns its final state."""
+    while True:
+        response = session().get(f"{SERVER_URL}/jobs/{job_id}", params={"wait": 25})
+        response.raise_for_status()
+        job = response.json()
+        if job["status"] not in ("queued", "running"):
+            return job
+
+def echo_job(job):
+    if job["status"] == "done":
+        click.echo(job["result"])
+    else:
+        click.echo(f"Job {job['job_id']} {job['status']}: {job.get('error')}")
+
+def stream_instruct(prompt):
+    """Prints /instruct/stream events as they arrive: text to stdout, tool calls to stderr."""
+    with session().post(f"{SERVER_URL}/instruct/stream", json={"prompt": prompt}, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue  # blank separators, "event:" lines and keep-alive comments
+            event = json.loads(line[len("data: "):])
+            if event["type"] == "text":
+                click.echo(event["text"], nl=False)
+            elif event["type"] == "tool":
+                click.secho(f"[{event['name']} {event.get('store') or ''} {event['duration_ms']}ms]",
+                            dim=True, err=True)
+            elif event["type"] == "done":
+                click.echo()
+            elif event["type"] == "error":
+                click.echo(f"\nError: {event['error']}")
+
 @cli.command()
 @click.argument('prompt')
-def instruct(prompt):
+@click.option('--job', 'as_job', is_flag=True, help="Run as a server-side job and wait for its result.")
+@click.option('--stream', is_flag=True, help="Print the response as it is generated.")
+def instruct(prompt, as_job, stream):
     """Sends an instruction to the Qapi LLM."""
     try:
-        response = requests.post(f"{SERVER_URL}/instruct", json={"prompt": prompt})
+        if stream:
+            stream_instruct(prompt)
+            return
+        response = session().post(f"{SERVER_URL}/instruct", json={"prompt": prompt, "async": as_job})
         response.raise_for_status()
-        click.echo(response.json().get('response'))
-    except requests.exceptions.RequestException as e:
+        if as_job:
+            job_id = response.json()["job_id"]
+            click.echo(f"Queued job {job_id}, waiting...")
+            echo_job(wait_for_job(job_id))
+        else:
+            click.echo(response.json().get('response'))
+    except request_error() as e:
         click.echo(f"Error communicating with the LLM: {e}")
 
+REPL_HELP = """Type an instruction to send it, or:
+  /search <query>   search the local index
+  /chatlog          show the conversation context the agent sees
+  /health           server health
+  /quit             leave (or Ctrl-D)"""
+
+@cli.command()
+def repl():
+    """Interactive mode: every line is an instruction, streamed back over one kept-alive connection."""
+    try:
+        import readline  # line editing and history, where available
+    except ImportError:
+        pass
+    click.echo("Qapi REPL. /help for commands.")
+    while True:
+        try:
+            line = input("qapi> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            click.echo()
+            return
+        if not line:
+            continue
+        if line in ("/quit", "/exit"):
+            return
+        try:
+            if line == "/help":
+                click.echo(REPL_HELP)
+            elif line == "/health":
+                click.echo(session().get(f"{SERVER_URL}/healthcheck").json())
+            elif line == "/chatlog":
+                click.echo(json.dumps(session().get(f"{SERVER_URL}/chatlog").json(), indent=2))
+            elif line.startswith("/search "):
+                response = session().post(f"{SERVER_URL}/search", params={"mode": "index"},
+                                          json={"query": line[len("/search "):]})
+                response.raise_for_status()
+                echo_hits(response.json()["results"])
+            elif line.startswith("/"):
+                click.echo(f"Unknown command {line.split()[0]}. /help for commands.")
+            else:
+                stream_instruct(line)
+        except request_error() as e:
+            click.echo(f"Error talking to the server: {e}")
+        except KeyboardInterrupt:
+            # Drops the stream; the instruction may still finish on the server.
+            click.echo("\nInterrupted.")
+
+@cli.command()
+@click.argument('job_id')
+@click.option('--wait', is_flag=True, help="Wait for the job to finish.")
+def job(job_id, wait):
+    """Shows the status of a server-side job."""
+    try:
+        if wait:
+            echo_job(wait_for_job(job_id))
+            return
+        response = session().get(f"{SERVER_URL}/jobs/{job_id}")
+        response.raise_for_status()
+        job = response.json()
+        if job["status"] in ("queued", "running"):
+            click.echo(f"Job {job_id} is {job['status']}.")
+        else:
+            echo_job(job)
+    except request_error() as e:
+        click.echo(f"Error fetching job: {e}")
+
+def echo_hits(hits):
+    for hit in hits:
+        click.echo(f"{hit['score']:8.3f}  {hit['store']}/{hit['id']}  {hit['truncated_desc']}")
+
 @cli.command()
 @click.argument('query')
-def search(query):
+@click.option('--mode', type=click.Choice(['llm', 'index', 'hybrid']), default='llm',
+              help="llm: the LLM searches the stores; index: local index only; hybrid: the LLM sees the top index hits.")
+def search(query, mode):
     """Searches the data stores using a query."""
     try:
-        response = requests.post(f"{SERVER_URL}/search", json={"query": query})
+        response = session().post(f"{SERVER_URL}/search", params={"mode": mode}, json={"query": query})
         response.raise_for_status()
-        click.echo(response.json().get('response'))
-    except requests.exceptions.RequestException as e:
+        if mode == 'index':
+            echo_hits(response.json()["results"])
+        else:
+            click.echo(response.json().get('response'))
+    except request_error() as e:
         click.echo(f"Error searching: {e}")
 
+@cli.command(name='import')
+@click.argument('store_name')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, help="Entries per write on the server (default QAPI_IMPORT_BATCH_SIZE).")
+def import_entries(store_name, path, batch_size):
+    """Bulk-loads a JSON Lines file (one entry per line) into a list store."""
+    try:
+        params = {"batch_size": batch_size} if batch_size else {}
+        # requests streams an open file, so large files aren't read into memory.
+        with open(path, 'rb') as f:
+            response = session().post(f"{SERVER_URL}/import/{store_name}", params=params, data=f,
+                                     headers={"Content-Type": "application/x-ndjson"})
+        result = response.json()
+        click.echo(f"Imported {result.get('imported', 0)}, skipped {result.get('skipped', 0)} already present, "
+                   f"{result.get('bad_lines', 0)} bad lines.")
+        for error in result.get("errors", []):
+            click.echo(f"  line {error['line']}: {error['error']}")
+        if "error" in result:
+            click.echo(f"Error: {result['error']}")
+    except (request_error(), ValueError) as e:
+        click.echo(f"Error importing: {e}")
+
 @cli.command()
 def create_timeheap():
     """Triggers the creation of the daily timeheap."""
     try:
-        response = requests.post(f"{SERVER_URL}/create_daily_timeheap")
+        response = session().post(f"{SERVER_URL}/create_daily_timeheap")
         response.raise_for_status()
         click.echo(response.json().get('response'))
-    except requests.exceptions.RequestException as e:
+    except request_error() as e:
         click.echo(f"Error creating timeheap: {e}")
 
 @cli.command()
 def setup_reminders():
-    """Fetches the timeheap and sets up reminders."""
-    click.echo("Fetching timeheap from server...")
+    """Fetches the upcoming timeheap entries and sets up reminders."""
+    click.echo("Fetching upcoming timeheap entries from server...")
     try:
-        response = requests.get(f"{SERVER_URL}/timeheap")
-        response.raise_for_status()
-        timeheap = response.json()
-
-        if "error" in timeheap:
-            click.echo(f"Error fetching timeheap: {timeheap['error']}")
-            return
-
-        click.echo("Timeheap fetched successfully.")
+        # Use timezone-aware current time in UTC
         now = datetime.now(timezone.utc)
-        
-        for entry in timeheap:
-            due_date_str = entry.get("due_date")
-            if not due_date_str:
-                click.echo(f"Skipping entry with no due_date: {entry}")
-                continue
-
-            try:
-                due_date = datetime.fromisoformat(due_date_str)
-            except ValueError:
-                click.echo(f"Skipping entry with invalid due_date format: {entry}")
-                continue
-
-            # Ensure due_date is timezone-aware for comparison
-            if due_date.tzinfo is None:
-                due_date = due_date.replace(tzinfo=timezone.utc)
-
-            if due_date > now:
-                delay_seconds = (due_date - now).total_seconds()
-                description = entry.get("description", "No description")
-                
-                # Get the absolute path to the Python executable
-                python_executable = sys.executable
-                
-                # Get the absolute path to the reminder script
-                reminder_script_path = "C:/Users/shrid/Desktop/Projects/Qapi/reminder/main.py"
-
-                
-                command = [
-                    python_executable,
-                    reminder_script_path,
-                    f"--delay={delay_seconds}",
-                    f"--message={description}"
-                ]
-                
-                click.echo(f"Scheduling reminder for '{description}' in {delay_seconds} seconds.")
-                subprocess.Popen(command)
-        
-        click.echo("Finished scheduling reminders.")
-
-    except requests.exceptions.RequestException as e:
-        click.echo(f"Error setting up reminders: {e}")
-
+        click.echo(f"Current UTC time: {now.isoformat()}")
 
-@cli.command()
-def setup_reminders():
-    """Fetches the timeheap and sets up reminders."""
-    click.echo("Fetching timeheap from server...")
-    try:
-        response = requests.get(f"{SERVER_URL}/timeheap")
+        # Only ask for what is still ahead of us, the server keeps it ordered by due date.
+        response = session().get(f"{SERVER_URL}/timeheap/due", params={"after": now.timestamp()})
         response.raise_for_status()
         timeheap = response.json()
 
@@ -129,59 +278,47 @@ def setup_reminders():
             return
 
         click.echo("Timeheap fetched successfully.")
-        
-        # Use timezone-aware current time in UTC
-        now = datetime.now(timezone.utc)
-        click.echo(f"Current UTC time: {now.isoformat()}")
-        
-        scheduled_count = 0
+
+        reminders = []
         for entry in timeheap:
-            due_date_str = entry.get("due_date")
-            if not due_date_str:
+            due_ts = entry.get("due_ts")
+            if due_ts is None:
                 click.echo(f"Skipping entry with no due_date: {entry}")
                 continue
 
-            try:
-                # Handle both 'Z' suffix and '+00:00' suffix for UTC
-                due_date_str_cleaned = due_date_str.replace('Z', '+00:00')
-                due_date = datetime.fromisoformat(due_date_str_cleaned)
-                
-                # Ensure timezone aware
-                if due_date.tzinfo is None:
-                    due_date = due_date.replace(tzinfo=timezone.utc)
-                
-                description = entry.get("description", "No description")
-                click.echo(f"Task: '{description[:50]}...' Due: {due_date.isoformat()}")
-                
-            except ValueError as e:
-                click.echo(f"Skipping entry with invalid due_date format: {due_date_str} - Error: {e}")
-                continue
+            description = entry.get("description", "No description")
+            due_date = datetime.fromtimestamp(due_ts, timezone.utc)
+            click.echo(f"Task: '{description[:50]}...' Due: {due_date.isoformat()}")
+            reminders.append({"id": entry["id"], "due_ts": due_ts, "message": description})
 
-            if due_date > now:
-                delay_seconds = (due_date - now).total_seconds()
-                
-                python_executable = sys.executable
-                reminder_script_path = "C:/Users/shrid/Desktop/Projects/Qapi/reminder/main.py"
-
-                command = [
-                    python_executable,
-                    reminder_script_path,
-                    f"--delay={delay_seconds}",
-                    f"--message={description}"
-                ]
-                
-                click.echo(f"  -> Scheduling in {delay_seconds:.1f} seconds")
-                subprocess.Popen(command)
-                scheduled_count += 1
-            else:
-                time_diff = (now - due_date).total_seconds()
-                click.echo(f"  -> PAST DUE by {time_diff:.0f} seconds, skipping")
-        
-        click.echo(f"\nFinished scheduling {scheduled_count} reminders.")
+        # One daemon holds every reminder. Re-sending an id just updates it, and
+        # anything the server no longer has as upcoming gets cancelled.
+        ensure_reminder_daemon()
+        scheduled = reminder_daemon_command({"op": "list"})["entries"]
+        wanted = {reminder["id"] for reminder in reminders}
+        stale = [reminder["id"] for reminder in scheduled if reminder["id"] not in wanted]
+        added = reminder_daemon_command({"op": "add", "entries": reminders})["added"]
+        cancelled = reminder_daemon_command({"op": "cancel", "ids": stale})["cancelled"] if stale else 0
+
+        click.echo(f"\nFinished scheduling {len(reminders)} reminders ({added} new, {cancelled} cancelled).")
 
-    except requests.exceptions.RequestException as e:
+    except request_error() as e:
         click.echo(f"Error setting up reminders: {e}")
+    except OSError as e:
+        click.echo(f"Error talking to the reminder daemon: {e}")
 
+@cli.command()
+def reminders():
+    """Lists the reminders the reminder daemon has scheduled."""
+    try:
+        scheduled = reminder_daemon_command({"op": "list"})["entries"]
+    except OSError as e:
+        click.echo(f"Reminder daemon is not running: {e}")
+        return
+    for reminder in scheduled:
+        due_date = datetime.fromtimestamp(reminder["due_ts"], timezone.utc)
+        click.echo(f"{due_date.isoformat()}  {reminder['message'][:60]}")
+    click.echo(f"{len(scheduled)} reminders scheduled.")
         
 @cli.command()
 def log():
@@ -1,15 +1,31 @@
 import time
 from plyer import notification
 import argparse
+import heapq
+import json
 import logging
 import os
+import socketserver
+import sys
+import threading
 
 # Construct the absolute path for the log file
 log_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 log_file_path = os.path.join(log_dir, 'reminder.log')
 
-logging.basicConfig(filename=log_file_path, level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
+# Run as a script, so put the repo root on the path for the shared logging setup.
+sys.path.insert(0, log_dir)
+from server.logs import setup_logging
+
+# Where the daemon keeps its pending reminders so they survive a restart.
+schedule_file_path = os.path.join(log_dir, 'reminder_schedule.json')
+
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = int(os.getenv("QAPI_REMINDER_PORT", "5055"))
+
+# Reminders that came due while the daemon was down are still shown if they
+# are late by less than this many seconds, otherwise they are dropped.
+MISSED_GRACE = 3600
 
 def show_reminder(task_description):
     """Displays a reminder notification."""
@@ -23,16 +39,235 @@ def show_reminder(task_description):
     )
     logging.info(f"Finished showing reminder for: {task_description}")
 
+class ReminderDaemon:
+    """
+    Keeps every pending reminder in one timer heap, keyed by timeheap entry id.
+    Adding an id that is already scheduled replaces it instead of duplicating it.
+    """
+
+    def __init__(self, schedule_path):
+        self.schedule_path = schedule_path
+        self._schedule = {}  # id -> {"id", "due_ts", "message"}
+        self._heap = []      # (due_ts, id); stale pairs are skipped when they surface
+        self._cond = threading.Condition()
+
+    def load(self):
+        """Reloads the schedule saved by a previous run."""
+        try:
+            with open(self.schedule_path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            logging.error(f"Ignoring unreadable schedule file {self.schedule_path}")
+            return
+        now = time.time()
+        with self._cond:
+            for entry in saved:
+                if entry["due_ts"] < now - MISSED_GRACE:
+                    logging.info(f"Dropping reminder missed while stopped: {entry['message']}")
+                    continue
+                self._schedule[entry["id"]] = entry
+                heapq.heappush(self._heap, (entry["due_ts"], entry["id"]))
+            self._save()
+        logging.info(f"Loaded {len(self._schedule)} scheduled reminders.")
+
+    def _save(self):
+        # Caller holds self._cond.
+        tmp_path = self.schedule_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self._schedule.values()), f, indent=4)
+        os.replace(tmp_path, self.schedule_path)
+
+    def add(self, entries):
+        """Schedules (or reschedules) reminders. Returns how many were new."""
+        added = 0
+        with self._cond:
+            for entry in entries:
+                entry = {"id": entry["id"], "due_ts": float(entry["due_ts"]),
+                         "message": entry.get("message", "No description")}
+                previous = self._schedule.get(entry["id"])
+                if previous == entry:
+                    continue
+                if previous is None:
+                    added += 1
+                self._schedule[entry["id"]] = entry
+                heapq.heappush(self._heap, (entry["due_ts"], entry["id"]))
+                logging.info(f"Reminder scheduled for '{entry['message']}' at {entry['due_ts']}.")
+            self._save()
+            self._cond.notify()
+        return added
+
+    def cancel(self, entry_ids):
+        """Drops scheduled reminders. Returns how many were found."""
+        with self._cond:
+            cancelled = [entry_id for entry_id in entry_ids if self._schedule.pop(entry_id, None)]
+            if cancelled:
+                self._save()
+                self._cond.notify()
+        for entry_id in cancelled:
+            logging.info(f"Reminder {entry_id} cancelled.")
+        return len(cancelled)
+
+    def entries(self):
+        with self._cond:
+            return sorted(self._schedule.values(), key=lambda entry: entry["due_ts"])
+
+    def run(self):
+        """Fires reminders as they come due. Never returns."""
+        with self._cond:
+            while True:
+                # Skip heap pairs for reminders that were cancelled or rescheduled.
+                while self._heap:
+                    due_ts, entry_id = self._heap[0]
+                    entry = self._schedule.get(entry_id)
+                    if entry is not None and entry["due_ts"] == due_ts:
+                        break
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                _, entry_id = heapq.heappop(self._heap)
+                entry = self._schedule.pop(entry_id)
+                self._save()
+                # Notifications can block, keep the timer loop going meanwhile.
+                threading.Thread(target=show_reminder, args=(entry["message"],), daemon=True).start()
+
+def _reminder_for(entry):
+    return {"id": entry["id"], "due_ts": entry["due_ts"], "message": entry.get("description", "No description")}
+
+def sync_from_server(daemon, server_url, interval):
+    """
+    Keeps the daemon in step with the server's timeheap by polling its change
+    feed. An unchanged timeheap costs one 304 per poll.
+    """
+    import requests
+
+    session = requests.Session()
+    token = None
+    while True:
+        try:
+            if token is None:
+                # Full resync: take the version first, then the upcoming entries.
+                # Changes that land in between are replayed next poll, which is harmless.
+                response = session.get(f"{server_url}/timeheap/changes", timeout=10)
+                response.raise_for_status()
+                version = response.json()["version"]
+                response = session.get(f"{server_url}/timeheap/due", params={"after": time.time()}, timeout=10)
+                response.raise_for_status()
+                upcoming = [_reminder_for(entry) for entry in response.json() if entry.get("due_ts") is not None]
+                wanted = {reminder["id"] for reminder in upcoming}
+                daemon.add(upcoming)
+                daemon.cancel([reminder["id"] for reminder in daemon.entries() if reminder["id"] not in wanted])
+                token = version
+                logging.info(f"Synced {len(upcoming)} reminders from {server_url}")
+            else:
+                response = session.get(f"{server_url}/timeheap/changes", params={"since": token},
+                                       headers={"If-None-Match": f'"{token}"'}, timeout=10)
+                if response.status_code != 304:
+                    response.raise_for_status()
+                    body = response.json()
+                    if body["reset"]:
+                        token = None
+                        continue
+                    now = time.time()
+                    for change in body["changes"]:
+                        entry = change.get("entry") or {}
+                        if change["op"] != "delete" and entry.get("due_ts") is not None and entry["due_ts"] > now:
+                            daemon.add([_reminder_for(entry)])
+                        else:
+                            daemon.cancel([change["id"]])
+                    token = body["version"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.warning(f"Timeheap sync with {server_url} failed: {e}")
+            token = None
+        time.sleep(interval)
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON command per line, one JSON reply per line:
+    {"op": "add", "entries": [{"id", "due_ts", "message"}, ...]}
+    {"op": "cancel", "ids": [...]}
+    {"op": "list"}
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                command = json.loads(line)
+                op = command.get("op")
+                if op == "add":
+                    reply = {"added": self.server.reminders.add(command.get("entries", []))}
+                elif op == "cancel":
+                    reply = {"cancelled": self.server.reminders.cancel(command.get("ids", []))}
+                elif op == "list":
+                    reply = {"entries": self.server.reminders.entries()}
+                else:
+                    reply = {"error": f"Unknown op: {op}"}
+            except Exception as e:
+                logging.exception("Bad reminder daemon command.")
+                reply = {"error": str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+class _CommandServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+def run_daemon(port=DAEMON_PORT, server_url=None, poll_interval=5.0):
+    """
+    Runs the reminder daemon: one process and one timer heap for every reminder.
+    With server_url, it also follows the server's timeheap by itself.
+    """
+    try:
+        server = _CommandServer((DAEMON_HOST, port), _CommandHandler)
+    except OSError as e:
+        # Most likely another daemon already owns the port (and the schedule).
+        logging.error(f"Reminder daemon could not listen on {DAEMON_HOST}:{port}: {e}")
+        raise SystemExit(1)
+    daemon = ReminderDaemon(schedule_file_path)
+    daemon.load()
+    server.reminders = daemon
+    threading.Thread(target=server.serve_forever, name="reminder-commands", daemon=True).start()
+    logging.info(f"Reminder daemon listening on {DAEMON_HOST}:{port}")
+    if server_url:
+        threading.Thread(target=sync_from_server, args=(daemon, server_url, poll_interval),
+                         name="timeheap-sync", daemon=True).start()
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        server.shutdown()
+
 def main():
     """Main function for the reminder script."""
     parser = argparse.ArgumentParser(description="Qapi Reminder")
-    parser.add_argument("--delay", type=float, required=True, help="Delay in seconds before showing the reminder.")
-    parser.add_argument("--message", type=str, required=True, help="The reminder message.")
+    parser.add_argument("--daemon", action="store_true", help="Run as the long-lived reminder daemon.")
+    parser.add_argument("--port", type=int, default=DAEMON_PORT, help="Port the daemon listens on (localhost only).")
+    parser.add_argument("--server", type=str, help="Qapi server URL; the daemon then polls its timeheap for changes.")
+    parser.add_argument("--poll", type=float, default=5.0, help="Seconds between timeheap polls when --server is given.")
+    parser.add_argument("--delay", type=float, help="Delay in seconds before showing the reminder.")
+    parser.add_argument("--message", type=str, help="The reminder message.")
     args = parser.parse_args()
+    # Queued and rotated like the server's log, so the timer loop never waits on the file.
+    setup_logging(log_file_path)
+    run_command(parser, args)
+
+def run_command(parser, args):
+    if args.daemon:
+        run_daemon(args.port, args.server, args.poll)
+        return
 
+    if args.delay is None or args.message is None:
+        parser.error("--delay and --message are required unless --daemon is given")
     logging.info(f"Reminder scheduled for '{args.message}' in {args.delay} seconds.")
     time.sleep(args.delay)
     show_reminder(args.message)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
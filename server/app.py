@@ -1,32 +1,37 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 import json
+import queue
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
-import logging
-from server.handlers import read_data, write_data, append_data, get_timestamp, delete_data_entry, load_memory
-from google.generativeai import types
+import time
+import uuid
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from server.handlers import read_data, write_data, append_data, get_timestamp, delete_data_entry, load_memory, get_cache_stats, find_entries_by_date, get_version_token, get_changes_since_token, load_summaries, load_entries, get_store_sizes, batch_mutate, import_entries, LIST_STORES
+from server import timeheap
+from server.budget import SessionBudget, measure
+from server.chatlog import get_chatlog, set_summarizer
+from server import archive
+from server.cache import ResponseCache, SessionMemo, get_memo_stats, store_versions
+from server import metrics
+from server.prefetch import prefetch, record_session, get_prefetch_stats
+from server.search import search as search_index, get_index_stats
+from server.llm import LLMBusy, create_backend
+from server.jobs import JobQueue, JobTimeout, QueueFull, SingleFlight
+from server.index import parse_timestamp
+from server.logs import setup_logging, request_id_var
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(filename='server.log', level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
+# Configure logging: queued, rotated, levels from QAPI_LOG_* (see server/logs.py)
+setup_logging('server.log')
 
 app = Flask(__name__)
 
 # Path to the data directory
 DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
 
-# Configure Gemini API
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    app.logger.error("GEMINI_API_KEY not found in environment variables.")
-    raise ValueError("GEMINI_API_KEY not found in environment variables.")
-genai.configure(api_key=GEMINI_API_KEY)
-
-
 # Define the function declarations for the handler functions
 read_data_function = {
     "name": "read_data",
@@ -101,15 +106,90 @@ load_memory_function = {
     },
 }
 
-# Create the tools object
-tools = types.Tool(function_declarations=[
+find_entries_by_date_function = {
+    "name": "find_entries_by_date",
+    "description": "Finds entries in a list-based data store whose due_date or entry_date falls in a time range, oldest first.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "store_name": {"type": "string", "description": "The name of the data store."},
+            "field": {"type": "string", "description": "The date field to query: 'due_date' or 'entry_date'."},
+            "start": {"type": "string", "description": "Optional: Start of the range (ISO format, inclusive)."},
+            "end": {"type": "string", "description": "Optional: End of the range (ISO format, inclusive)."},
+        },
+        "required": ["store_name", "field"],
+    },
+}
+
+load_summaries_function = {
+    "name": "load_summaries",
+    "description": "Loads a page of a list-based data store as just ids and truncated descriptions. Pass the returned next_cursor to get the next page; it is null on the last page.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "store_name": {"type": "string", "description": "The name of the data store."},
+            "cursor": {"type": "string", "description": "Optional: The next_cursor from the previous page."},
+            "limit": {"type": "integer", "description": "Optional: Entries per page (default 50, max 500)."},
+        },
+        "required": ["store_name"],
+    },
+}
+
+load_entries_function = {
+    "name": "load_entries",
+    "description": "Loads the full entries for several ids of a list-based data store in one call.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "store_name": {"type": "string", "description": "The name of the data store."},
+            "entry_ids": {"type": "array", "items": {"type": "string"}, "description": "The IDs of the entries to load."},
+        },
+        "required": ["store_name", "entry_ids"],
+    },
+}
+
+batch_mutate_function = {
+    "name": "batch_mutate",
+    "description": "Applies several appends, updates and deletes to list-based data stores in one call. Each store's operations are saved together, all or nothing.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "operations": {"type": "string", "description": "A JSON array of operations: {\"op\": \"append\", \"store_name\": ..., \"entry\": {...}}, {\"op\": \"update\", \"store_name\": ..., \"entry_id\": ..., \"fields\": {...}} (fields to change) or {\"op\": \"delete\", \"store_name\": ..., \"entry_id\": ...}."},
+        },
+        "required": ["operations"],
+    },
+}
+
+search_archive_function = {
+    "name": "search_archive",
+    "description": "Searches the archive of a list-based data store, where past-due timeheap entries and tasks and old memories are moved. Give an entry_id to fetch one entry, or a query and/or a time range. Returns newest first.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "store_name": {"type": "string", "description": "The name of the data store whose archive to search."},
+            "entry_id": {"type": "string", "description": "Optional: The ID of one archived entry to fetch."},
+            "query": {"type": "string", "description": "Optional: Words that must all appear in the description."},
+            "start": {"type": "string", "description": "Optional: Start of the range (ISO format, inclusive)."},
+            "end": {"type": "string", "description": "Optional: End of the range (ISO format, inclusive)."},
+        },
+        "required": ["store_name"],
+    },
+}
+
+# The function declarations handed to the model
+tools = [
     read_data_function,
     write_data_function,
     append_data_function,
     get_timestamp_function,
     delete_data_entry_function,
     load_memory_function,
-])
+    find_entries_by_date_function,
+    load_summaries_function,
+    load_entries_function,
+    batch_mutate_function,
+    search_archive_function,
+]
 
 system_prompt = """
     You are Qapi, a helpful AI assistant. Your goal is to help the user manage their tasks and goals.
@@ -132,131 +212,709 @@ system_prompt = """
     6.  When creating tasks, always include the consequences of not completing the task in the description.
         This is very important. The consequences should be the worst-case scenario.
     7.  When adding to a data store, you should first read the data store to see what is already there, and then append the new data.
+        If the instruction came with a snapshot of that store, that counts as having read it.
     8.  You can use 'delete_data_entry(store_name, entry_id)' to remove an entry from a list-based data store.
     9.  You can use 'load_memory(store_name, entry_id=None)' to retrieve data from any store, either the entire store or a specific entry by ID.
+    10. You can use 'find_entries_by_date(store_name, field, start, end)' to get only the entries due or added in a time range.
+    11. When you need several tool calls that don't depend on each other's results, request them all in the same turn.
+        They are executed together and you get every result back at once.
+    12. To look through a list store, start with 'load_summaries(store_name, cursor, limit)', which returns only ids
+        and truncated descriptions, then fetch the full entries you need with 'load_entries(store_name, entry_ids)'.
+        Tool results count against a token budget for each instruction, so avoid reading whole stores.
+    13. To add, change or delete more than one entry, use a single 'batch_mutate(operations)' call
+        instead of one append_data or delete_data_entry call per entry.
+    14. Past-due timeheap entries and tasks and old memories are moved out of the stores into an archive.
+        If something you're asked about isn't in a store, look for it with 'search_archive(store_name, ...)'.
     """
 
-model = genai.GenerativeModel(
-    model_name='gemini-2.5-flash', # Corrected model name
-    generation_config={"temperature": 0.7},
-    tools=tools,
-    system_instruction=system_prompt
-)
+# The LLM backend: Gemini by default, or a stub/recording/replay for offline runs (see server/llm.py)
+try:
+    model = create_backend(
+        model_name='gemini-2.5-flash', # Corrected model name
+        system_instruction=system_prompt,
+        tools=tools,
+        temperature=0.7,
+    )
+except ValueError as e:
+    app.logger.error(str(e))
+    raise
+
+# Whether /instruct sessions see and extend the chatlog (see server/chatlog.py).
+CHATLOG_ENABLED = os.getenv("QAPI_CHATLOG", "1") != "0"
+
+CHATLOG_SUMMARY_PROMPT = """
+    Update the running summary of your conversation with the user. Keep every fact, decision,
+    preference and open question that could matter later; drop small talk. Reply with the new
+    summary as plain text only, no tool calls, at most 300 words.
+    """
+
+def summarize_chat(summary, turns):
+    """Has the model fold older chatlog turns into the running summary."""
+    conversation = [{"role": turn["role"], "content": turn["content"]} for turn in turns]
+    parts = model.start_chat().send_message(CHATLOG_SUMMARY_PROMPT + "\n" + json.dumps(
+        {"summary_so_far": summary, "older_turns": conversation})).parts
+    text = "".join(part.text for part in parts if part.text).strip()
+    if not text:
+        raise ValueError("the model returned no summary text")
+    return text
+
+# Only the real model summarizes. Stub and replay sessions are scripted in order, and a
+# summary started from a background thread at any time would take someone else's; record
+# would save those summaries among the sessions to replay. The others get fallback_summary.
+if os.getenv("QAPI_LLM_BACKEND", "gemini") == "gemini":
+    set_summarizer(summarize_chat)
+
+_route_seconds = metrics.histogram("qapi_http_request_duration_seconds", "Time to produce a response, per route.",
+                                   ["route", "method", "status"])
+_llm_turn_seconds = metrics.histogram("qapi_llm_turn_duration_seconds", "Time per model turn, including streaming.",
+                                      ["kind"])
+_tool_seconds = metrics.histogram("qapi_tool_duration_seconds", "Time per tool call made by the model.", ["tool"])
+_session_round_trips = metrics.histogram("qapi_session_round_trips", "Model round trips per agent session.", ["kind"],
+                                         buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50))
+_session_tool_tokens = metrics.histogram("qapi_session_tool_tokens", "Estimated tokens of tool results per agent session.",
+                                         ["kind"], buckets=(0, 100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000))
+
+@app.before_request
+def _start_request():
+    g.started = time.perf_counter()
+    # Tags every log line written for this request (and its jobs and tool calls).
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:12]
+    request_id_var.set(g.request_id)
+
+@app.after_request
+def _finish_request(response):
+    if "started" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        _route_seconds.observe(time.perf_counter() - g.started, route=route, method=request.method,
+                               status=response.status_code)
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+@metrics.collector
+def _collect_stats():
+    """Gauges read from the stats the other modules already keep."""
+    families = []
+    sizes = get_store_sizes(LIST_STORES + ["priorities"])
+    families.append(("qapi_store_entries", "gauge", "Entries in each list store.",
+                     [({"store": name}, size["entries"]) for name, size in sizes.items() if size["entries"] is not None]))
+    families.append(("qapi_store_bytes", "gauge", "Size of each store on disk.",
+                     [({"store": name}, size["bytes"]) for name, size in sizes.items()]))
+
+    caches = {"store": get_cache_stats(), "search": search_cache.stats(), "tool_memo": get_memo_stats()}
+    families.append(("qapi_cache_hits_total", "counter", "Cache hits.",
+                     [({"cache": name}, stats.get("hits", 0)) for name, stats in caches.items()]))
+    families.append(("qapi_cache_misses_total", "counter", "Cache misses.",
+                     [({"cache": name}, stats.get("misses", 0)) for name, stats in caches.items()]))
+    families.append(("qapi_cache_hit_ratio", "gauge", "Cache hit rate since start.",
+                     [({"cache": name}, stats["hit_rate"]) for name, stats in caches.items()]
+                     + [({"cache": "prefetch"}, get_prefetch_stats()["hit_rate"])]))
+
+    job_stats = jobs.stats()
+    llm_stats = model.limiter.stats()
+    families.append(("qapi_jobs", "gauge", "Background jobs by state.",
+                     [({"state": "queued"}, job_stats["queued"]), ({"state": "running"}, job_stats["running"])]))
+    families.append(("qapi_llm_calls", "gauge", "Model calls running or waiting for a slot.",
+                     [({"state": "active"}, llm_stats["active"]), ({"state": "waiting"}, llm_stats["waiting"])]))
+    families.append(("qapi_llm_rejected_total", "counter", "Sessions turned away by the model call limiter.",
+                     [({}, llm_stats["rejected"])]))
+    families.append(("qapi_search_index_documents", "gauge", "Entries in the local search index.",
+                     [({}, get_index_stats()["documents"])]))
+    return families
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics in the text exposition format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route('/healthcheck', methods=['GET'])
 def healthcheck():
-    return jsonify({"status": "ok", "message": "Server is running"})
+    return jsonify({"status": "ok", "message": "Server is running", "store_cache": get_cache_stats(),
+                    "jobs": jobs.stats(), "search_index": get_index_stats(),
+                    "prefetch": get_prefetch_stats(),
+                    "tool_memo": get_memo_stats(), "search_cache": search_cache.stats(),
+                    "llm": model.limiter.stats(), "chatlog": get_chatlog().stats(),
+                    "archive": archive.get_archive_stats()})
+
+@app.route('/chatlog', methods=['GET'])
+def get_chatlog_context():
+    """The chatlog context the next instruct will see: the running summary and the latest turns."""
+    return jsonify(get_chatlog().context())
 
 @app.route('/timeheap', methods=['GET'])
 def get_timeheap():
-    return jsonify(read_data('timeheap'))
+    # The token comes from the store file (or database), so every worker tags the same data alike.
+    token, data = get_version_token('timeheap')
+    response = jsonify(data)
+    response.set_etag(token)
+    return response.make_conditional(request)
 
-@app.route('/instruct', methods=['POST'])
-def instruct_llm():
-    user_prompt = request.json.get('prompt')
-    if not user_prompt:
-        app.logger.warning("Instruct endpoint called with no prompt.")
-        return jsonify({"error": "No prompt provided"}), 400
+@app.route('/timeheap/changes', methods=['GET'])
+def get_timeheap_changes():
+    """
+    Lists what changed in the timeheap since the version token in 'since'.
+    When that history isn't available here (unknown or stale token, a token
+    from another worker that this one never saw, or the store was reloaded),
+    "reset" is true and the client should re-fetch. A token that is still
+    current needs no history, so it's never a reset on any worker.
+    """
+    token, changes = get_changes_since_token('timeheap', request.args.get('since'))
+    response = jsonify({
+        "version": token,
+        "reset": changes is None,
+        "changes": changes or [],
+    })
+    response.set_etag(token)
+    return response.make_conditional(request)
 
+def _time_value(name, value):
+    """Reads a time as epoch seconds (a number or numeric string) or an ISO timestamp. Raises ValueError."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, str):
+        raise ValueError(f"'{name}' must be epoch seconds or an ISO timestamp, got {value!r}.")
     try:
-        response = agent_execute(user_prompt)
-        return jsonify({"response": response})
-    except Exception as e:
-        app.logger.exception("An error occurred during agent execution.")
-        return jsonify({"error": "An internal error occurred."}), 500
+        return float(value)
+    except ValueError:
+        pass
+    timestamp = parse_timestamp(value)
+    if timestamp is None:
+        raise ValueError(f"Invalid '{name}' timestamp: {value}")
+    return timestamp
+
+def _time_arg(name):
+    """Reads a time bound from the query string, either epoch seconds or ISO format."""
+    return _time_value(name, request.args.get(name))
+
+def _limit_value(value):
+    """Reads a 'limit' as a whole number of at least 1, or None if not given. Raises ValueError."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"'limit' must be a whole number, got {value!r}.")
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"'limit' must be a whole number, got {value!r}.")
+    if limit < 1:
+        raise ValueError("'limit' must be at least 1.")
+    return limit
 
-def agent_execute(user_prompt):
+@app.route('/timeheap/due', methods=['GET'])
+def get_timeheap_due():
     """
-    The core logic for the agent.
-    Constructs a system prompt, interacts with the LLM using function calling,
-    and executes the user's instruction.
+    Returns timeheap entries due in a range, earliest first.
+    With neither 'before' nor 'after' given, returns what is already due.
+    """
+    try:
+        before = _time_arg('before')
+        after = _time_arg('after')
+        limit = _limit_value(request.args.get('limit'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if before is None and after is None:
+        before = time.time()
+    return jsonify(timeheap.due(before=before, after=after, limit=limit))
+
+@app.route('/import/<store_name>', methods=['POST'])
+def import_store(store_name):
     """
-    chat = model.start_chat()
+    Bulk-appends a JSON Lines body (one entry per line) to a list store.
+    The body is read a line at a time and written in batches, so a large
+    file never has to fit in memory.
+    """
+    if store_name not in LIST_STORES:
+        return jsonify({"error": f"'{store_name}' is not a list store. Use one of: {', '.join(LIST_STORES)}."}), 400
+    batch_size = request.args.get('batch_size', type=int)
+    if batch_size is not None and batch_size < 1:
+        return jsonify({"error": "'batch_size' must be at least 1."}), 400
+    result = import_entries(store_name, request.stream, batch_size)
+    return jsonify(result), 500 if "error" in result else 200
 
-    response = chat.send_message(user_prompt)
+@app.route('/archive/<store_name>', methods=['GET'])
+def get_archived(store_name):
+    """Searches a store's archive: ?q=words&start=...&end=...&limit=N (ISO timestamps or epoch seconds)."""
+    try:
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 500)
+    except ValueError:
+        return jsonify({"error": "'limit' must be a number."}), 400
+    result = search_archive(store_name, query=request.args.get('q'), start=request.args.get('start'),
+                            end=request.args.get('end'), limit=limit)
+    return jsonify(result), 400 if isinstance(result, dict) else 200
 
-    final_response_text = ""
+@app.route('/archive/<store_name>/<entry_id>', methods=['GET'])
+def get_archived_entry(store_name, entry_id):
+    result = search_archive(store_name, entry_id=entry_id)
+    return jsonify(result), 404 if "error" in result else 200
 
-    while True:
-        function_call = None
-        if response.candidates and response.candidates[0].content.parts:
-            for part in response.candidates[0].content.parts:
-                if part.function_call:
-                    function_call = part.function_call
-                    break
-                elif part.text:
-                    final_response_text += part.text # Accumulate text parts
-
-        if not function_call:
-            break # No function call, break the loop
+@app.route('/archive/run', methods=['POST'])
+def run_archiver():
+    """Archives whatever is due for it now instead of waiting for the next scheduled run."""
+    return jsonify({"archived": archive.archive_expired()})
 
-        function_name = function_call.name
-        function_args = function_call.args
+@app.route('/timeheap/peek', methods=['GET'])
+def peek_timeheap():
+    return jsonify(timeheap.peek())
 
-        result = None
+@app.route('/timeheap/pop_due', methods=['POST'])
+def pop_due_timeheap():
+    """Removes and returns the timeheap entries that are due."""
+    body = request.get_json(silent=True) or {}
+    try:
+        now = _time_value('now', body.get('now'))
+        limit = _limit_value(body.get('limit'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(timeheap.pop_due(now=now, limit=limit))
+
+# Tools that only read. Calls to them can run side by side.
+READ_ONLY_TOOLS = {"read_data", "load_memory", "get_timestamp", "find_entries_by_date", "load_summaries", "load_entries",
+                   "search_archive"}
+
+# Estimated tokens of tool results one agent session may send the model (0 for no limit).
+SESSION_TOKEN_BUDGET = int(os.getenv("QAPI_SESSION_TOKEN_BUDGET", "100000"))
+
+tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv("QAPI_TOOL_WORKERS", "8")),
+                                   thread_name_prefix="tool")
+
+def call_tool(function_name, function_args):
+    """Runs the handler for one model function call and returns its result."""
+    try:
         if function_name == "read_data":
-            result = read_data(function_args["store_name"])
+            return read_data(function_args["store_name"])
         elif function_name == "write_data":
-            result = write_data(function_args["store_name"], json.loads(function_args["data"]))
+            return write_data(function_args["store_name"], json.loads(function_args["data"]))
         elif function_name == "append_data":
-            result = append_data(function_args["store_name"], json.loads(function_args["new_entry"]))
+            return append_data(function_args["store_name"], json.loads(function_args["new_entry"]))
         elif function_name == "get_timestamp":
-            result = get_timestamp()
+            return get_timestamp()
         elif function_name == "delete_data_entry":
-            result = delete_data_entry(function_args["store_name"], function_args["entry_id"])
+            return delete_data_entry(function_args["store_name"], function_args["entry_id"])
         elif function_name == "load_memory":
-            result = load_memory(function_args["store_name"], function_args.get("entry_id"))
+            return load_memory(function_args["store_name"], function_args.get("entry_id"))
+        elif function_name == "find_entries_by_date":
+            return find_entries_by_date(function_args["store_name"], function_args["field"],
+                                        function_args.get("start"), function_args.get("end"))
+        elif function_name == "load_summaries":
+            return load_summaries(function_args["store_name"], function_args.get("cursor"),
+                                  function_args.get("limit", 50))
+        elif function_name == "load_entries":
+            return load_entries(function_args["store_name"], list(function_args["entry_ids"]))
+        elif function_name == "batch_mutate":
+            return batch_mutate(json.loads(function_args["operations"]))
+        elif function_name == "search_archive":
+            return search_archive(function_args["store_name"], function_args.get("entry_id"),
+                                  function_args.get("query"), function_args.get("start"), function_args.get("end"))
         else:
-            result = {"error": f"Unknown function: {function_name}"}
+            return {"error": f"Unknown function: {function_name}"}
+    except (KeyError, ValueError) as e:
+        return {"error": f"Bad arguments for {function_name}: {e}"}
 
-        # Send the result back to the model
-        response = chat.send_message(
-            [{"function_response": {"name": function_name, "response": {"result": result}}}]
-        )
-    
+def _tool_stores(name, args):
+    """The stores a tool call touches (batch_mutate can touch several)."""
+    if name == "batch_mutate":
+        try:
+            operations = json.loads(args.get("operations") or "[]")
+            return sorted({op.get("store_name") for op in operations if isinstance(op, dict)}, key=str) or [None]
+        except (TypeError, ValueError, AttributeError):
+            return [None]
+    return [args.get("store_name")]
+
+def search_archive(store_name, entry_id=None, query=None, start=None, end=None, limit=20):
+    """One archived entry by id, or the archived entries matching a query and/or time range."""
+    if store_name not in archive.POLICIES:
+        return {"error": f"'{store_name}' has no archive. Archived stores: {', '.join(archive.POLICIES)}."}
+    if entry_id:
+        entry = archive.lookup(store_name, entry_id)
+        return entry if entry is not None else {"error": f"Entry with ID '{entry_id}' not found in the archive of '{store_name}'."}
+    bounds = []
+    for bound in (start, end):
+        timestamp = parse_timestamp(bound) if bound else None
+        if bound and timestamp is None:
+            return {"error": f"Invalid timestamp '{bound}'. Use ISO format."}
+        bounds.append(timestamp)
+    return archive.search(store_name, query, bounds[0], bounds[1], limit)
+
+def execute_function_calls(function_calls, on_event=None, memo=None):
+    """
+    Runs every function call from one model turn and returns the results in
+    call order, as (name, result, (bytes, tokens)). Calls on a store that the
+    turn writes to run one after another in the order the model gave them;
+    everything else runs concurrently.
+    on_event, if given, gets a "tool" event as each call finishes.
+    With a SessionMemo, a read-only call the session already made against the
+    same store version just tells the model the result hasn't changed.
+    """
+    calls = [(function_call.name, dict(function_call.args)) for function_call in function_calls]
+    stores = [_tool_stores(name, args) for name, args in calls]
+    written_stores = {store_name for (name, _), touched in zip(calls, stores) if name not in READ_ONLY_TOOLS
+                      for store_name in touched}
+
+    # A call touching several stores ties their queues together.
+    queue_of = {}
+    for touched in stores:
+        if len(touched) > 1:
+            merged = {queue_of.get(store_name, store_name) for store_name in touched}
+            target = min(merged, key=str)
+            for store_name, current in list(queue_of.items()):
+                if current in merged:
+                    queue_of[store_name] = target
+            for store_name in touched:
+                queue_of[store_name] = target
+
+    independent = []
+    per_store = {}
+    for position, ((name, args), touched) in enumerate(zip(calls, stores)):
+        if name not in READ_ONLY_TOOLS or touched[0] in written_stores:
+            per_store.setdefault(queue_of.get(touched[0], touched[0]), []).append(position)
+        else:
+            independent.append([position])
+
+    results = [None] * len(calls)
+    sizes = [None] * len(calls)
+    def run_in_order(positions):
+        for position in positions:
+            started = time.perf_counter()
+            name, args = calls[position]
+            memoized = False
+            if memo is None:
+                results[position] = call_tool(name, args)
+            elif name in READ_ONLY_TOOLS:
+                results[position], memoized = memo.call(name, args, lambda: call_tool(name, args))
+                unchanged = {"unchanged": True, "note": f"Same result as your earlier {name} call "
+                                                        f"with these arguments; nothing changed since."}
+                if memoized and measure(unchanged)[0] < measure(results[position])[0]:
+                    results[position] = unchanged
+            else:
+                results[position] = call_tool(name, args)
+                for store_name in stores[position]:
+                    memo.invalidate(store_name)
+            sizes[position] = measure(results[position])
+            _tool_seconds.observe(time.perf_counter() - started, tool=name)
+            if on_event is not None:
+                on_event({"type": "tool", "name": name, "store": ",".join(filter(None, stores[position])) or None,
+                          "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                          "bytes": sizes[position][0], "tokens": sizes[position][1], "memoized": memoized})
+
+    groups = independent + list(per_store.values())
+    if len(groups) == 1:
+        run_in_order(groups[0])
+    else:
+        for future in [tool_executor.submit(contextvars.copy_context().run, run_in_order, positions)
+                       for positions in groups]:
+            future.result()
+    return [(name, result, size) for (name, _), result, size in zip(calls, results, sizes)]
+
+def agent_execute(user_prompt, deadline=None, on_event=None, kind="instruct"):
+    """
+    The core logic for the agent.
+    Constructs a system prompt, interacts with the LLM using function calling,
+    and executes the user's instruction.
+    If a deadline (epoch seconds) is given, JobTimeout is raised once a new
+    model turn would start after it.
+    If on_event is given, the model's reply is streamed and on_event gets
+    {"type": "text"} events for each chunk, {"type": "tool"} events for each
+    tool call and a closing {"type": "usage"} event.
+    Tool results are charged against a SESSION_TOKEN_BUDGET for the session.
+    kind names the endpoint, which decides what is prefetched into the first message.
+    """
+    chat = model.start_chat(user_prompt, deadline=deadline)
+    budget = SessionBudget(SESSION_TOKEN_BUDGET)
+    memo = SessionMemo()
+
+    original_prompt = user_prompt
+    if kind == "instruct" and CHATLOG_ENABLED:
+        # The conversation so far: a summary plus recent turns, the same size however long the log is
+        conversation = get_chatlog().context()
+        if (conversation["summary"] or conversation["recent"]) and \
+                budget.charge("chatlog", conversation) is conversation:
+            user_prompt = ("Our conversation so far (a summary of older turns, then the latest turns):\n"
+                           + json.dumps(conversation) + "\n\nNew instruction:\n" + user_prompt)
+
+    # Attach the stores this session will probably read, saving the round trips to fetch them
+    prefetched, snapshots = prefetch(kind)
+    if snapshots:
+        charged = budget.charge("prefetch", snapshots)
+        if charged is snapshots:
+            user_prompt += ("\n\nSnapshots of data stores you are likely to need, taken just now "
+                            "(list stores show ids and truncated descriptions only, use load_entries for details). "
+                            "Don't read these stores again unless you need more than this:\n"
+                            + json.dumps(snapshots))
+        else:
+            prefetched = []
+    session_calls = []
+
+    def send(content):
+        if on_event is None:
+            return chat.send_message(content).parts
+        return chat.stream_message(content)
+
+    turn_started = time.perf_counter()
+    parts = send(user_prompt)
+    round_trips = 1
+
+    final_response_text = ""
+
+    while True:
+        function_calls = []
+        for part in parts:
+            if part.function_call:
+                function_calls.append(part.function_call)
+            elif part.text:
+                final_response_text += part.text # Accumulate text parts
+                if on_event is not None:
+                    on_event({"type": "text", "text": part.text})
+        _llm_turn_seconds.observe(time.perf_counter() - turn_started, kind=kind)
+
+        if not function_calls:
+            break # No function call, break the loop
+        session_calls.extend((function_call.name, dict(function_call.args)) for function_call in function_calls)
+
+        if deadline is not None and time.time() > deadline:
+            raise JobTimeout("The agent ran past its deadline.")
+
+        # Send every result back to the model in one round trip
+        responses = []
+        for function_name, result, size in execute_function_calls(function_calls, on_event, memo):
+            result = budget.charge(function_name, result, size)
+            call = budget.calls[-1]
+            app.logger.info(f"Tool {function_name} sent {call['bytes']} bytes (~{call['tokens']} tokens)"
+                            + (", over budget" if call["rejected"] else ""))
+            responses.append({"function_response": {"name": function_name, "response": {"result": result}}})
+        turn_started = time.perf_counter()
+        parts = send(responses)
+        round_trips += 1
+
+    record_session(kind, prefetched, session_calls)
+    if kind == "instruct" and CHATLOG_ENABLED:
+        get_chatlog().record_exchange(original_prompt, final_response_text)
+    _session_round_trips.observe(round_trips, kind=kind)
+    _session_tool_tokens.observe(budget.tokens, kind=kind)
+    app.logger.info(f"Agent session used {budget.bytes} bytes (~{budget.tokens} tokens) "
+                    f"over {len(budget.calls)} tool calls, {memo.hits} answered from the session memo.")
+    if on_event is not None:
+        on_event(dict(budget.report(), type="usage"))
     return final_response_text
 
-@app.route('/search', methods=['POST'])
-def search():
+# Background jobs for clients that don't want to hold a request open for a
+# whole agent conversation (POST with "async": true, then GET /jobs/<id>).
+jobs = JobQueue(
+    workers=int(os.getenv("QAPI_JOB_WORKERS", "2")),
+    max_queued=int(os.getenv("QAPI_JOB_QUEUE_SIZE", "16")),
+    timeout=float(os.getenv("QAPI_JOB_TIMEOUT", "300")),
+)
+# Shares one execution between identical requests answered inline.
+single_flight = SingleFlight()
+# Longest a GET /jobs/<id>?wait=... long-poll is held open.
+JOB_MAX_WAIT = 30.0
+
+# Move expired entries to the archive every QAPI_ARCHIVE_INTERVAL seconds (0 to only do it on demand).
+archive.start_archiver(float(os.getenv("QAPI_ARCHIVE_INTERVAL", "3600")))
+
+def _wants_async():
+    body = request.get_json(silent=True) or {}
+    return body.get('async') is True or request.args.get('async') in ('1', 'true')
+
+def _run_endpoint(kind, description, fn, *args, key=None):
     """
-    Instructs the LLM to search the data stores.
+    Runs fn(*args) for a request, or queues it as a job when the client asked
+    for async, answering 202 with the job id. Requests with the same key that
+    arrive while one is in flight share its execution (and job).
     """
-    query = request.json.get('query')
-    if not query:
-        return jsonify({"error": "No query provided"}), 400
+    if _wants_async():
+        try:
+            job = jobs.submit(kind, fn, *args, key=key)
+        except QueueFull as e:
+            app.logger.warning(f"Rejected {kind} job: {e}")
+            return jsonify({"error": f"Server busy: {e}"}), 503, {"Retry-After": "5"}
+        return jsonify({"job_id": job.id, "status": job.status}), 202, {"Location": f"/jobs/{job.id}"}
+
+    try:
+        if key is None:
+            return jsonify({"response": fn(*args)})
+        response, shared = single_flight.do(key, fn, *args)
+        if shared:
+            app.logger.info(f"Coalesced a {kind} request with one already in flight.")
+            return jsonify({"response": response, "coalesced": True})
+        return jsonify({"response": response})
+    except LLMBusy as e:
+        app.logger.warning(f"Rejected {kind} request: {e}")
+        return jsonify({"error": f"Model busy: {e}"}), 429, {"Retry-After": "5"}
+    except Exception as e:
+        app.logger.exception(f"An error occurred during {description}.")
+        return jsonify({"error": "An internal error occurred."}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Returns a job's status and result. ?wait=N long-polls up to N seconds for it to finish."""
+    wait = min(request.args.get('wait', 0, type=float), JOB_MAX_WAIT)
+    job = jobs.wait(job_id, wait) if wait > 0 else jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job '{job_id}'."}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/instruct', methods=['POST'])
+def instruct_llm():
+    user_prompt = request.json.get('prompt')
+    if not user_prompt:
+        app.logger.warning("Instruct endpoint called with no prompt.")
+        return jsonify({"error": "No prompt provided"}), 400
+
+    return _run_endpoint("instruct", "agent execution", agent_execute, user_prompt)
 
+def _sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+@app.route('/instruct/stream', methods=['POST'])
+def instruct_stream():
+    """
+    Runs an instruction as a job and streams its progress as Server-Sent
+    Events: "job" first, then "text" chunks and "tool" calls as they happen,
+    and finally "done" (with the full response) or "error".
+    """
+    user_prompt = (request.get_json(silent=True) or {}).get('prompt')
+    if not user_prompt:
+        app.logger.warning("Instruct stream endpoint called with no prompt.")
+        return jsonify({"error": "No prompt provided"}), 400
+
+    events = queue.Queue()
+    def run(prompt, deadline=None):
+        try:
+            response = agent_execute(prompt, deadline, on_event=events.put)
+        except (JobTimeout, LLMBusy) as e:
+            events.put({"type": "error", "error": str(e)})
+            raise
+        except Exception:
+            events.put({"type": "error", "error": "An internal error occurred."})
+            raise
+        events.put({"type": "done", "response": response})
+        return response
+
+    try:
+        job = jobs.submit("instruct", run, user_prompt)
+    except QueueFull as e:
+        return jsonify({"error": f"Server busy: {e}"}), 503, {"Retry-After": "5"}
+
+    def generate():
+        yield _sse({"type": "job", "job_id": job.id})
+        while True:
+            try:
+                event = events.get(timeout=15)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield _sse(event)
+            if event["type"] in ("done", "error"):
+                return
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def run_search(query, deadline=None):
+    """Has the agent search the data stores for a query."""
     search_prompt = f"""
     The user wants to search the data stores.
     The query is: "{query}"
     Please search the relevant data stores and return the results.
     """
-    try:
-        response = agent_execute(search_prompt)
-        return jsonify({"response": response})
-    except Exception as e:
-        app.logger.exception("An error occurred during search.")
-        return jsonify({"error": "An internal error occurred."}), 500
+    return agent_execute(search_prompt, deadline, kind="search")
 
-@app.route('/create_daily_timeheap', methods=['POST'])
-def create_daily_timeheap():
+def run_hybrid_search(query, hits, deadline=None):
+    """Has the agent answer a query from the top index hits instead of whole stores."""
+    search_prompt = f"""
+    The user wants to search the data stores.
+    The query is: "{query}"
+    These are the best matches from the local search index, as JSON (store, id, score, truncated_desc):
+    {json.dumps(hits)}
+    Use load_memory on the ones that look relevant if you need their full details,
+    and return the results. Don't read whole stores.
     """
-    Instructs the LLM to create the daily timeheap.
+    return agent_execute(search_prompt, deadline, kind="search")
+
+SEARCH_MODES = ("llm", "index", "hybrid")
+SEARCH_DEFAULT_K = int(os.getenv("QAPI_SEARCH_K", "10"))
+# Larger k is cut down to this.
+SEARCH_MAX_K = int(os.getenv("QAPI_SEARCH_MAX_K", "100"))
+
+# Agent search answers, reused while no store has changed.
+search_cache = ResponseCache(
+    max_entries=int(os.getenv("QAPI_SEARCH_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("QAPI_SEARCH_CACHE_TTL", "300")),
+)
+# Every store a search could read, for the cache key.
+SEARCHED_STORES = LIST_STORES + ["priorities"]
+
+def run_cached(key, fn, *args, deadline=None):
+    """Runs fn and keeps its answer in the search cache under key."""
+    response = fn(*args, deadline=deadline)
+    search_cache.put(key, response)
+    return response
+
+@app.route('/search', methods=['POST'])
+def search():
+    """
+    Searches the data stores. ?mode= (or "mode" in the body) picks how:
+    llm (default) has the LLM search the stores, index answers straight from
+    the local BM25 index with ids and scores, and hybrid hands only the top
+    k index hits to the LLM.
     """
-    # The prompt for the agent to create the daily timeheap
-    timeheap_creation_prompt = """
+    body = request.get_json(silent=True) or {}
+    query = body.get('query')
+    if not query:
+        return jsonify({"error": "No query provided"}), 400
+    mode = request.args.get('mode') or body.get('mode') or 'llm'
+    if mode not in SEARCH_MODES:
+        return jsonify({"error": f"Unknown search mode '{mode}', expected one of {', '.join(SEARCH_MODES)}."}), 400
+    k = request.args.get('k', body.get('k'))
+    if k is None:
+        k = SEARCH_DEFAULT_K
+    try:
+        k = int(k)
+    except (TypeError, ValueError):
+        return jsonify({"error": f"'k' must be a whole number, got {k!r}."}), 400
+    if k < 1:
+        return jsonify({"error": "'k' must be at least 1."}), 400
+    k = min(k, SEARCH_MAX_K)
+    stores = body.get('stores')
+    if stores is not None and (not isinstance(stores, list) or not set(stores) <= set(LIST_STORES)):
+        return jsonify({"error": f"'stores' must be a list of list stores: {', '.join(LIST_STORES)}."}), 400
+
+    if mode == 'index':
+        return jsonify({"query": query, "results": search_index(query, k, stores)})
+
+    key = (mode, query, k, tuple(stores or ()), store_versions(SEARCHED_STORES))
+    cached = search_cache.get(key)
+    if cached is not None:
+        return jsonify({"response": cached, "cached": True})
+    if mode == 'llm':
+        return _run_endpoint("search", "search", run_cached, key, run_search, query, key=key)
+    hits = search_index(query, k, stores)
+    return _run_endpoint("search", "search", run_cached, key, run_hybrid_search, query, hits, key=key)
+
+# The prompt for the agent to create the daily timeheap
+TIMEHEAP_CREATION_PROMPT = """
     It's the start of a new day. Please create the daily timeheap for today.
     Review the 'user_goals_map.json' and 'priorities.json' data stores.
     Based on the user's goals and priorities, create a list of tasks for today
-    and add them to the 'timeheap.json' data store.
+    and add them to the 'timeheap.json' data store with a single batch_mutate call.
     For each task, provide a detailed description, a due date in ISO format,
     and the worst-case consequences for not completing the task.
     """
-    try:
-        response = agent_execute(timeheap_creation_prompt)
-        return jsonify({"response": response})
-    except Exception as e:
-        app.logger.exception("An error occurred during daily timeheap creation.")
-        return jsonify({"error": "An internal error occurred."}), 500
+
+def run_daily_timeheap(deadline=None):
+    """Archives yesterday's timeheap, then has the agent create today's."""
+    archive.archive_expired()
+    return agent_execute(TIMEHEAP_CREATION_PROMPT, deadline, kind="create_daily_timeheap")
+
+@app.route('/create_daily_timeheap', methods=['POST'])
+def create_daily_timeheap():
+    """
+    Instructs the LLM to create the daily timeheap.
+    """
+    return _run_endpoint("create_daily_timeheap", "daily timeheap creation", run_daily_timeheap,
+                         key=("create_daily_timeheap",))
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
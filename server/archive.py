@@ -0,0 +1,287 @@
+"""
+Cold storage for list store entries that are no longer live.
+
+archive_expired() moves past-due timeheap entries and tasks and old
+memories out of their stores into data/archive/<store>/, so the hot stores
+(and everything that reads them whole) only carry live data. Entries are
+grouped by month, by the date the entry was archived under (due_date for
+the timeheap and tasks, entry_date for memories). Every move writes each
+month's entries to a new segment, <YYYY-MM>.<n>.jsonl.gz, through a temp
+file that is fsynced and renamed into place, so a segment on disk is always
+complete and is never written again. A crash mid-move leaves at most a temp
+file, which readers ignore.
+
+ids.tsv next to the segments maps each archived id to its segment, so
+lookup() only opens one segment. search() scans segments newest first and
+skips months outside the requested date range.
+
+What gets archived, and when, per store (0 turns a store off):
+
+    timeheap                    due more than QAPI_ARCHIVE_TIMEHEAP_HOURS ago (default 24)
+    agent_tasks                 due more than QAPI_ARCHIVE_TASK_DAYS ago (default 30)
+    agent_context, user_context added more than QAPI_ARCHIVE_MEMORY_DAYS ago (default 180)
+"""
+import gzip
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from server import handlers
+from server.index import parse_timestamp
+from server.metrics import counter, timed
+from server.search import tokenize
+
+# store -> (date field, age in seconds after which an entry is archived)
+POLICIES = {
+    "timeheap": ("due_date", float(os.getenv("QAPI_ARCHIVE_TIMEHEAP_HOURS", "24")) * 3600),
+    "agent_tasks": ("due_date", float(os.getenv("QAPI_ARCHIVE_TASK_DAYS", "30")) * 86400),
+    "agent_context": ("entry_date", float(os.getenv("QAPI_ARCHIVE_MEMORY_DAYS", "180")) * 86400),
+    "user_context": ("entry_date", float(os.getenv("QAPI_ARCHIVE_MEMORY_DAYS", "180")) * 86400),
+}
+# Entries moved per store per run, so one run never holds a store's lock for long.
+MAX_PER_RUN = int(os.getenv("QAPI_ARCHIVE_MAX_PER_RUN", "5000"))
+
+logger = logging.getLogger(__name__)
+
+_archived = counter("qapi_archived_entries_total", "Entries moved from a store into its archive.", ["store"])
+
+def _month_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m")
+
+def _gzip_members(raw, path):
+    """
+    Yields the decompressed gzip members in raw one by one. A damaged or
+    cut-off member is skipped, picking up again at the next gzip header.
+    Segments are renamed into place whole, so that only happens to archives
+    from before segments were written that way, or to damage from outside.
+    """
+    position = 0
+    while position < len(raw):
+        decompressor = zlib.decompressobj(31)  # 31: gzip wrapper
+        try:
+            data = decompressor.decompress(raw[position:])
+            complete = decompressor.eof
+        except zlib.error:
+            complete = False
+        if complete:
+            yield data
+            position = len(raw) - len(decompressor.unused_data)
+            continue
+        logger.warning("Skipping a damaged gzip member at byte %d of archive segment %s.", position, path)
+        position = raw.find(b"\x1f\x8b\x08", position + 1)
+        if position == -1:
+            return
+
+class StoreArchive:
+    """The archive of one store."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.ids_path = os.path.join(directory, "ids.tsv")
+        self._ids = {}       # id -> segment
+        self._ids_size = 0   # how much of ids.tsv _ids reflects
+        self._lock = threading.Lock()
+
+    def _refresh_ids(self):
+        """Reads whatever was added to ids.tsv since last time (by this or another process). Caller holds _lock."""
+        try:
+            size = os.path.getsize(self.ids_path)
+        except FileNotFoundError:
+            return
+        if size == self._ids_size:
+            return
+        with open(self.ids_path, 'r') as f:
+            f.seek(self._ids_size)
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # still being written
+                entry_id, _, segment = line.rstrip("\n").partition("\t")
+                self._ids[entry_id] = segment
+                self._ids_size += len(line.encode())
+
+    def segments(self):
+        """Segment names (YYYY-MM.<n>, or YYYY-MM for older archives), newest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((name[:-len(".jsonl.gz")] for name in names if name.endswith(".jsonl.gz")), reverse=True)
+
+    def _write_segment(self, month, entries):
+        """Writes entries to a new segment of the month. Returns the segment name."""
+        segment = f"{month}.{time.time_ns()}"
+        path = os.path.join(self.directory, f"{segment}.jsonl.gz")
+        tmp_path = os.path.join(self.directory, f".{segment}.tmp")
+        try:
+            with open(tmp_path, 'wb') as raw:
+                with gzip.open(raw, 'wt') as f:
+                    for entry in entries:
+                        f.write(json.dumps(entry) + "\n")
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return segment
+
+    def _read_segment(self, segment):
+        path = os.path.join(self.directory, f"{segment}.jsonl.gz")
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        for member in _gzip_members(raw, path):
+            for line in member.decode().splitlines():
+                if line:
+                    yield json.loads(line)
+
+    def add(self, entries, field):
+        """
+        Appends entries to their segments and records their ids. Entries that
+        are already archived are skipped. Caller holds the store's lock.
+        """
+        with self._lock:
+            self._refresh_ids()
+            by_month = {}
+            for entry in entries:
+                if entry["id"] in self._ids:
+                    continue
+                timestamp = parse_timestamp(entry.get(field)) or parse_timestamp(entry.get("entry_date")) or time.time()
+                by_month.setdefault(_month_of(timestamp), []).append(entry)
+            if not by_month:
+                return 0
+            os.makedirs(self.directory, exist_ok=True)
+            lines = []
+            for month, month_entries in by_month.items():
+                segment = self._write_segment(month, month_entries)
+                lines.extend(f"{entry['id']}\t{segment}\n" for entry in month_entries)
+            # The segments are on disk before the index points at them.
+            with open(self.ids_path, 'a') as f:
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh_ids()
+            return sum(len(month_entries) for month_entries in by_month.values())
+
+    def lookup(self, entry_id):
+        with self._lock:
+            self._refresh_ids()
+            segment = self._ids.get(entry_id)
+        if segment is None:
+            return None
+        for entry in self._read_segment(segment):
+            if entry.get("id") == entry_id:
+                return entry
+        return None
+
+    def search(self, query=None, start=None, end=None, field="entry_date", limit=20):
+        """
+        Returns up to `limit` archived entries, newest first, whose
+        description holds every word of `query` (if given) and whose `field`
+        falls in [start, end] (epoch seconds, either optional).
+        """
+        words = set(tokenize(query or ""))
+        first = _month_of(start) if start is not None else None
+        last = _month_of(end) if end is not None else None
+        found, found_month = [], None
+        for segment in self.segments():
+            month = segment[:7]
+            # Months come newest first, so a full page can't get newer entries from older months.
+            if len(found) >= limit and found_month is not None and month < found_month:
+                break
+            found_month = month
+            if (first is not None and month < first) or (last is not None and month > last):
+                continue
+            for entry in self._read_segment(segment):
+                timestamp = parse_timestamp(entry.get(field))
+                if (start is not None or end is not None) and timestamp is None:
+                    continue
+                if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                    continue
+                if words and not words <= set(tokenize(entry.get("description") or entry.get("truncated_desc") or "")):
+                    continue
+                found.append((timestamp or 0, entry))
+        return [entry for _, entry in heapq.nlargest(limit, found, key=lambda item: item[0])]
+
+    def stats(self):
+        with self._lock:
+            self._refresh_ids()
+            return {"entries": len(self._ids), "segments": len(self.segments())}
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+def get_archive(store_name):
+    with _archives_lock:
+        archive = _archives.get(store_name)
+        if archive is None:
+            archive = _archives[store_name] = StoreArchive(os.path.join(handlers.DATA_DIR, "archive", store_name))
+        return archive
+
+@timed
+def archive_expired(now=None):
+    """Moves every entry past its store's archive age into the archive. Returns {store: entries moved}."""
+    now = time.time() if now is None else now
+    moved = {}
+    for store_name, (field, age) in POLICIES.items():
+        if age <= 0:
+            continue
+        with handlers.locked_store(store_name):
+            store = handlers.get_list_store(store_name)
+            if isinstance(store, dict):
+                continue
+            expired = [entry for entry in store.find_by_date(field, end=now - age, limit=MAX_PER_RUN)
+                       if isinstance(entry, dict) and entry.get("id") is not None]
+            if not expired:
+                continue
+            # Archive first: if the delete fails, the next run finds them archived already and only deletes.
+            added = get_archive(store_name).add(expired, field)
+            result = handlers.delete_data_entries(store_name, [entry["id"] for entry in expired])
+            if "error" in result:
+                logger.error("Archived %d entries of %s but couldn't remove them: %s",
+                             len(expired), store_name, result["error"])
+                continue
+        _archived.inc(len(expired), store=store_name)
+        moved[store_name] = len(expired)
+        logger.info("Archived %d entries of %s (%d new to the archive).", len(expired), store_name, added)
+    return moved
+
+def lookup(store_name, entry_id):
+    """Returns an archived entry, or None."""
+    return get_archive(store_name).lookup(entry_id)
+
+@timed(name="archive_search")
+def search(store_name, query=None, start=None, end=None, limit=20):
+    field = POLICIES.get(store_name, ("entry_date", 0))[0]
+    return get_archive(store_name).search(query, start, end, field, limit)
+
+def get_archive_stats():
+    return {store_name: get_archive(store_name).stats() for store_name in POLICIES}
+
+_archiver = None
+
+def start_archiver(interval):
+    """Runs archive_expired every `interval` seconds in a daemon thread."""
+    global _archiver
+    if _archiver is not None or interval <= 0:
+        return
+
+    def run():
+        while True:
+            try:
+                archive_expired()
+            except Exception:
+                logger.exception("Archiving failed.")
+            time.sleep(interval)
+
+    _archiver = threading.Thread(target=run, name="archiver", daemon=True)
+    _archiver.start()
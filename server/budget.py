@@ -0,0 +1,48 @@
+"""
+Per-session accounting of what tool results cost the model.
+
+Every agent session (one agent_execute) gets a SessionBudget. Each tool
+result is measured as the JSON that goes back to the model, and its size
+in tokens is estimated from that (there is no tokenizer to ask). Once a
+result would push the session over its budget, it is replaced with an error
+telling the model to narrow the request down instead.
+"""
+import json
+
+# Rough average for English and JSON; good enough for a budget.
+BYTES_PER_TOKEN = 4
+
+def measure(result):
+    """Returns (bytes, estimated tokens) for a tool result as sent to the model."""
+    size = len(json.dumps(result, default=str).encode())
+    return size, -(-size // BYTES_PER_TOKEN)
+
+class SessionBudget:
+    def __init__(self, limit):
+        self.limit = limit  # tokens; 0 means no limit
+        self.bytes = 0
+        self.tokens = 0
+        self.calls = []     # {"name", "bytes", "tokens", "rejected"} per tool call
+
+    def remaining(self):
+        return None if not self.limit else max(0, self.limit - self.tokens)
+
+    def charge(self, name, result, size=None):
+        """
+        Counts one tool result against the budget and returns what should be
+        sent to the model: the result itself, or an error if it doesn't fit.
+        """
+        size, tokens = size or measure(result)
+        rejected = bool(self.limit) and self.tokens + tokens > self.limit
+        if rejected:
+            result = {"error": f"Result of {name} is about {tokens} tokens, but only {self.remaining()} "
+                               f"tokens are left in this session's budget. Use load_summaries and "
+                               f"load_entries to fetch only what you need."}
+            size, tokens = measure(result)
+        self.bytes += size
+        self.tokens += tokens
+        self.calls.append({"name": name, "bytes": size, "tokens": tokens, "rejected": rejected})
+        return result
+
+    def report(self):
+        return {"bytes": self.bytes, "tokens": self.tokens, "limit": self.limit, "calls": self.calls}
@@ -0,0 +1,109 @@
+"""
+Result caches keyed on store versions.
+
+SessionMemo remembers read-only tool results within one agent session,
+keyed on (tool, args, store version). A write to a store moves it to a new
+version, so anything memoized for it stops matching. ResponseCache is an
+LRU cache with a TTL for whole endpoint responses (used by /search), keyed
+on the request plus the versions of every store it could have read.
+"""
+import collections
+import json
+import threading
+import time
+from server.handlers import get_store_version
+
+_memo_stats = collections.Counter()
+_memo_stats_lock = threading.Lock()
+
+class SessionMemo:
+    """Read-only tool results for one agent session."""
+
+    def __init__(self):
+        self._results = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def call(self, name, args, fn):
+        """
+        Returns (result, memoized). fn() is only run if this call wasn't made
+        before in the session against the same store version.
+        """
+        store_name = args.get("store_name")
+        if store_name is None:
+            return fn(), False
+        version = get_store_version(store_name)
+        key = (store_name, name, json.dumps(args, sort_keys=True, default=str), version)
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                _count("hits")
+                return self._results[key], True
+        result = fn()
+        # Only keep results that certainly belong to that version.
+        if get_store_version(store_name) == version and not (isinstance(result, dict) and "error" in result):
+            with self._lock:
+                self._results[key] = result
+        _count("misses")
+        return result, False
+
+    def invalidate(self, store_name):
+        """Forgets everything memoized for a store (after the session wrote to it)."""
+        with self._lock:
+            for key in [key for key in self._results if key[0] == store_name]:
+                del self._results[key]
+
+def _count(name):
+    with _memo_stats_lock:
+        _memo_stats[name] += 1
+
+def get_memo_stats():
+    with _memo_stats_lock:
+        hits, misses = _memo_stats["hits"], _memo_stats["misses"]
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+class ResponseCache:
+    """A size-bounded LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_entries=256, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (expires, value), least recently used first
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def get(self, key):
+        """Returns the cached value, or None."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._entries[key]
+                    self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return item[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evicted"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries), max_entries=self.max_entries, ttl=self.ttl)
+        total = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_rate"] = stats.get("hits", 0) / total if total else 0.0
+        return stats
+
+def store_versions(store_names):
+    """The version of every store, as a hashable cache key part."""
+    return tuple(get_store_version(store_name) for store_name in store_names)
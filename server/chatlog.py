@@ -0,0 +1,228 @@
+"""
+The conversation log, fed to the agent as context on every instruct.
+
+Each turn is appended to data/chatlog.jsonl as one JSON line, so recording
+a turn never rewrites the history. Only the last QAPI_CHATLOG_RECENT turns
+are kept in memory, in a ring. Turns pushed out of the ring wait in a
+pending queue until a background thread folds them, QAPI_CHATLOG_BATCH at a
+time, into a rolling summary of at most QAPI_CHATLOG_SUMMARY_CHARS
+characters. The summary is appended to the same file. context() returns the
+summary plus the turns not folded into it yet, so what an instruct sends the
+model stays the same size however long the log gets.
+
+Records in chatlog.jsonl:
+
+    {"type": "turn", "id", "role", "content", "timestamp"}
+    {"type": "summary", "text", "through": <id of the last turn folded in>, "timestamp"}
+
+On the first start, the old chatlog.json list store is imported into
+chatlog.jsonl; the JSON file itself is left alone. Loading streams the file,
+holding only the turns after the last summary.
+
+Several server processes can share the log. Every write is made under
+data/chatlog.lock, after first reading whatever other processes appended
+since this one last looked, and context() catches up the same way. The ring
+is rebuilt from the file in file order, so every process sees the same
+turns and the same summary. Two processes may summarize the same batch;
+the first to write its summary wins and the other one's is dropped.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+from server import handlers
+from server.locks import StoreLock
+
+RECENT_TURNS = int(os.getenv("QAPI_CHATLOG_RECENT", "20"))
+SUMMARIZE_BATCH = int(os.getenv("QAPI_CHATLOG_BATCH", "20"))
+SUMMARY_CHARS = int(os.getenv("QAPI_CHATLOG_SUMMARY_CHARS", "2000"))
+# Turns waiting for the summarizer beyond this many are left out of it (they stay in the file).
+MAX_PENDING = SUMMARIZE_BATCH * 4
+
+logger = logging.getLogger(__name__)
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+def fallback_summary(summary, turns):
+    """Summarizes without a model: the old summary plus a clipped line per turn, keeping the newest text."""
+    lines = [summary] if summary else []
+    for turn in turns:
+        content = str(turn.get("content", "")).replace("\n", " ")
+        lines.append(f"{turn.get('role', '?')}: {content[:200]}")
+    return "\n".join(lines)[-SUMMARY_CHARS:]
+
+class Chatlog:
+    def __init__(self, path, legacy_path=None, summarizer=fallback_summary,
+                 recent=RECENT_TURNS, batch=SUMMARIZE_BATCH, max_pending=MAX_PENDING):
+        self.path = path
+        self.summarizer = summarizer
+        self.batch = batch
+        self._recent = collections.deque(maxlen=recent)
+        self._pending = collections.deque()
+        self._max_pending = max_pending
+        self._summary = None
+        self._stats = collections.Counter()
+        self._cond = threading.Condition()
+        # Held (by writers in every process) around catching up with and appending to the file.
+        self._lock = StoreLock(os.path.splitext(path)[0] + ".lock")
+        self._offset = 0  # bytes of the file already applied
+        self._worker = None
+
+        with self._lock.write():
+            if legacy_path and not os.path.exists(path) and os.path.exists(legacy_path):
+                self._import_legacy(legacy_path)
+            self._catch_up()
+        self._wake()
+
+    def _import_legacy(self, legacy_path):
+        try:
+            with open(legacy_path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning("Not importing %s: %s", legacy_path, e)
+            return
+        records = [{"type": "turn", "id": entry.get("id") or str(uuid.uuid4()), "role": entry.get("role"),
+                    "content": entry.get("content"), "timestamp": entry.get("timestamp") or entry.get("entry_date")}
+                   for entry in entries if isinstance(entry, dict)]
+        self._append(records)
+        logger.info("Imported %d turns from %s into %s.", len(records), legacy_path, self.path)
+
+    def _catch_up(self):
+        """Applies the records appended since the last call, by any process. Caller holds the write lock."""
+        try:
+            if os.path.getsize(self.path) == self._offset:
+                return
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f, self._cond:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn by a crash; _append finishes the line off
+                self._offset += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Ignoring bad chatlog record at byte %d of %s", self._offset - len(line), self.path)
+                    continue
+                if record.get("type") == "turn":
+                    self._push(record)
+                elif record.get("type") == "summary":
+                    self._fold(record)
+
+    def _append(self, records):
+        """Appends records to the file and applies them. Caller holds the write lock and has caught up."""
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+        with open(self.path, 'ab') as f:
+            if f.tell() > self._offset:
+                data = b"\n" + data
+            f.write(data)
+        self._catch_up()
+
+    def _push(self, turn):
+        """Adds a turn to the ring. Caller holds _cond."""
+        if len(self._recent) == self._recent.maxlen:
+            self._pending.append(self._recent[0])
+            if len(self._pending) > self._max_pending:
+                self._pending.popleft()
+                self._stats["dropped"] += 1
+        self._recent.append(turn)
+
+    def _fold(self, summary):
+        """Makes a summary record current, dropping the turns it covers. Caller holds _cond."""
+        self._summary = summary.get("text")
+        turns = list(self._pending) + list(self._recent)
+        ids = [turn["id"] for turn in turns]
+        if summary.get("through") in ids:
+            for _ in range(ids.index(summary["through"]) + 1):
+                (self._pending or self._recent).popleft()
+
+    def record_exchange(self, prompt, response):
+        """Appends a user prompt and the agent's reply in one write."""
+        turns = [{"type": "turn", "id": str(uuid.uuid4()), "role": role, "content": content, "timestamp": _now()}
+                 for role, content in (("user", prompt), ("agent", response))]
+        with self._lock.write():
+            self._catch_up()
+            self._append(turns)
+        with self._cond:
+            self._stats["turns"] += len(turns)
+        self._wake()
+
+    def context(self):
+        """The rolling summary and every turn not folded into it yet, oldest first."""
+        # Pick up turns and summaries written by other processes.
+        with self._lock.write():
+            self._catch_up()
+        self._wake()
+        with self._cond:
+            turns = list(self._pending) + list(self._recent)
+            summary = self._summary
+        return {"summary": summary,
+                "recent": [{"role": turn["role"], "content": turn["content"], "timestamp": turn["timestamp"]}
+                           for turn in turns]}
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, recent=len(self._recent), pending=len(self._pending),
+                        summary_chars=len(self._summary or ""))
+
+    def _wake(self):
+        with self._cond:
+            if len(self._pending) < self.batch:
+                return
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._summarize_loop, name="chatlog-summarizer", daemon=True)
+                self._worker.start()
+            self._cond.notify()
+
+    def _summarize_loop(self):
+        while True:
+            with self._cond:
+                while len(self._pending) < self.batch:
+                    self._cond.wait()
+                turns = list(self._pending)
+                summary = self._summary
+            fell_back = False
+            try:
+                text = self.summarizer(summary, turns)
+            except Exception as e:
+                # Fall back rather than let pending turns pile up.
+                logger.warning("Chatlog summarizer failed, using the plain fallback: %s", e)
+                text = fallback_summary(summary, turns)
+                fell_back = True
+            text = text[-SUMMARY_CHARS:]
+            with self._lock.write():
+                self._catch_up()
+                with self._cond:
+                    # Another process may have summarized these turns first.
+                    current = bool(self._pending) and self._pending[0]["id"] == turns[0]["id"]
+                if current:
+                    self._append([{"type": "summary", "text": text, "through": turns[-1]["id"], "timestamp": _now()}])
+            with self._cond:
+                self._stats["summaries" if current else "superseded"] += 1
+                self._stats["fallbacks"] += fell_back
+
+_chatlog = None
+_chatlog_lock = threading.Lock()
+_summarizer = fallback_summary
+
+def set_summarizer(fn):
+    """Sets the function (summary, turns) -> new summary text used to fold old turns."""
+    global _summarizer
+    _summarizer = fn
+    if _chatlog is not None:
+        _chatlog.summarizer = fn
+
+def get_chatlog():
+    """Returns the server's Chatlog, loading data/chatlog.jsonl on first use."""
+    global _chatlog
+    with _chatlog_lock:
+        if _chatlog is None:
+            _chatlog = Chatlog(os.path.join(handlers.DATA_DIR, "chatlog.jsonl"),
+                               os.path.join(handlers.DATA_DIR, "chatlog.json"), summarizer=_summarizer)
+        return _chatlog
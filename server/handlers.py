@@ -1,10 +1,53 @@
+import atexit
+import collections
 import json
 import os
+import threading
 from datetime import datetime
 import uuid
+from server.index import ListStore, parse_timestamp
+from server.journal import get_journal, apply_op, wrap_store, unwrap_store
+from server.locks import FileLock, get_store_lock, atomic_write_json
+from server.metrics import counter, timed
+from server.sqlite_store import SqliteListStore, get_backend
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
 
+# "file" rewrites data/<store>.json on every change (the default),
+# "journal" appends changes to data/<store>.journal.jsonl (see server/journal.py).
+# "sqlite" keeps every store in one SQLite database (see server/sqlite_store.py).
+# File and sqlite mode are safe with several server processes sharing DATA_DIR
+# (see server/locks.py). Journal mode keeps the authoritative copy in memory,
+# so only one process may use it at a time.
+STORE_MODE = os.getenv("QAPI_STORE_MODE", "file")
+
+LIST_STORES = ['user_goals_map', 'agent_context', 'user_context', 'agent_tasks', 'timeheap']
+
+# Entries import_entries writes per mutation (and holds in memory at once).
+IMPORT_BATCH_SIZE = int(os.getenv("QAPI_IMPORT_BATCH_SIZE", "500"))
+
+# In-process cache of parsed stores. List stores are kept as an indexed
+# ListStore (see server/index.py). Each entry remembers the (mtime, size) of
+# the file it was parsed from, so edits made outside the server are still seen.
+# Values handed out by read_data are shared with the cache: treat them as read-only.
+_store_cache = {}
+_store_versions = {}
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+
+# Recent changes per store as (version, change) pairs, for clients that sync
+# incrementally. Changes after a store's floor version are all in its log; a
+# reload from disk can't be described as changes, so it moves the floor up.
+CHANGE_LOG_SIZE = 1000
+_change_logs = {}
+_change_log_floors = {}
+# Per store, the shared version tokens this process has handed out and the
+# local version each one stood for (see get_version_token), newest last.
+_token_versions = {}
+
+_bytes_read = counter("qapi_store_bytes_read_total", "Bytes of store files parsed from disk.", ["store"])
+_bytes_written = counter("qapi_store_bytes_written_total", "Bytes of store files and journal records written.", ["store"])
+
 def _generate_id():
     """Generates a unique ID."""
     return str(uuid.uuid4())
@@ -15,101 +58,766 @@ def _create_truncated_desc(description, max_length=100):
         return description[:max_length-3] + "..."
     return description
 
+def _add_due_ts(entry):
+    """Stores due_date pre-parsed as epoch seconds (due_ts), so clients don't have to parse it."""
+    if not isinstance(entry, dict):
+        return
+    due_ts = parse_timestamp(entry.get("due_date"))
+    if due_ts is None:
+        entry.pop("due_ts", None)
+    else:
+        entry["due_ts"] = due_ts
+
+def _add_metadata(entry):
+    """Fills in id, entry_date, truncated_desc and due_ts for a new list entry."""
+    if "id" not in entry:
+        entry["id"] = _generate_id()
+    if "entry_date" not in entry:
+        entry["entry_date"] = get_timestamp()
+    if "description" in entry and "truncated_desc" not in entry:
+        entry["truncated_desc"] = _create_truncated_desc(entry["description"])
+    _add_due_ts(entry)
+    return entry
+
 def get_timestamp():
     """Returns the current timestamp in ISO format (UTC)."""
     from datetime import timezone
     return datetime.now(timezone.utc).isoformat()
 
-def read_data(store_name):
-    """Reads data from a specified JSON file in the data directory."""
-    file_path = os.path.join(DATA_DIR, f"{store_name}.json")
+def _store_path(store_name):
+    return os.path.join(DATA_DIR, f"{store_name}.json")
+
+def _file_signature(file_path):
+    """
+    Returns the (mtime, size) used to detect changes to a store file. Our own
+    writes update the cache directly, so this only has to catch writes from
+    other processes and outside edits. Two of those landing within one tick
+    of the filesystem clock with the same size can go unnoticed until the
+    next change. The inode doesn't help: temp file + rename recycles inode
+    numbers (ext4 alternates between two), so it isn't part of the signature.
+    """
+    stat = os.stat(file_path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _default_store(store_name):
+    # If the file doesn't exist, return an empty list for list-based stores
+    # or an empty dict for dict-based stores (like priorities)
+    if store_name in LIST_STORES:
+        return []
+    elif store_name == 'chatlog':
+        # Not a list store any more (see server/chatlog.py), but tools that
+        # still ask for it get an empty list rather than an error.
+        return []
+    elif store_name == 'priorities':
+        return {"daily": [], "weekly": [], "monthly": []}
+    return {"error": f"Data store '{store_name}' not found."}
+
+def _bump_version(store_name, changes):
+    """
+    Moves the store to a new version and logs what changed, or that the
+    store was reset if `changes` is None. Caller holds _cache_lock.
+    """
+    version = _store_versions.get(store_name, 0) + 1
+    _store_versions[store_name] = version
+    log = _change_logs.setdefault(store_name, collections.deque())
+    if changes is None:
+        log.clear()
+        _change_log_floors[store_name] = version
+    else:
+        log.extend((version, change) for change in changes)
+        while len(log) > CHANGE_LOG_SIZE:
+            _change_log_floors[store_name] = log.popleft()[0]
+    return version
+
+def _cache_store(store_name, signature, value, changes=None):
+    """Puts a store into the cache and bumps its version. Caller holds _cache_lock."""
+    version = _bump_version(store_name, changes)
+    _store_cache[store_name] = {"signature": signature, "data": value, "version": version}
+
+def _drop_cached_store(store_name):
+    with _cache_lock:
+        if _store_cache.pop(store_name, None) is not None:
+            _bump_version(store_name, None)
+
+def _describe_changes(value, op):
+    """
+    Turns a mutation into change records: {"op": "add" | "update" | "delete",
+    "id": ..., "entry": ...}. Returns None if it can only be described as a reset.
+    """
+    if op["op"] == "append":
+        return [{"op": "add", "id": op["entry"].get("id"), "entry": op["entry"]}]
+    if op["op"] == "delete":
+        return [{"op": "delete", "id": entry_id} for entry_id in op.get("ids") or [op["id"]]]
+    if op["op"] == "batch":
+        return ([{"op": "delete", "id": entry_id} for entry_id in op.get("delete", ())] +
+                [{"op": "update", "id": entry["id"], "entry": entry} for entry in op.get("update", ())] +
+                [{"op": "add", "id": entry.get("id"), "entry": entry} for entry in op.get("append", ())])
+
+    # A full write: diff the old and new entries by id.
+    new_data = op["data"]
+    if not isinstance(value, ListStore) or not isinstance(new_data, list):
+        return None
+    old_entries = {}
+    for entry in value.entries():
+        if not isinstance(entry, dict) or entry.get("id") is None:
+            return None
+        old_entries[entry["id"]] = entry
+    changes = []
+    for entry in new_data:
+        if not isinstance(entry, dict) or entry.get("id") is None:
+            return None
+        old = old_entries.pop(entry["id"], None)
+        if old is None:
+            changes.append({"op": "add", "id": entry["id"], "entry": entry})
+        elif old != entry:
+            changes.append({"op": "update", "id": entry["id"], "entry": entry})
+    changes.extend({"op": "delete", "id": entry_id} for entry_id in old_entries)
+    return changes
+
+def get_store_version(store_name):
+    """Returns a counter that changes every time the store's contents change."""
+    _get_store(store_name)  # revalidate against the file first
+    with _cache_lock:
+        return _store_versions.get(store_name, 0)
+
+def read_data_with_version(store_name):
+    """Like read_data, but also returns the store version the data belongs to."""
+    value = _get_store(store_name)
+    with _cache_lock:
+        cached = _store_cache.get(store_name)
+        if cached is not None and cached["data"] is value:
+            version = cached["version"]
+        else:
+            version = _store_versions.get(store_name, 0)
+    return unwrap_store(value), version
+
+def _shared_token(store_name):
+    """
+    Names the store's current contents the same way in every process sharing
+    the data: the database's version in sqlite mode, otherwise the (mtime,
+    size) of the store file, plus its journal in journal mode.
+    """
+    if STORE_MODE == "sqlite":
+        return f"s{_sqlite().version(store_name)}"
+    paths = [_store_path(store_name)]
+    if STORE_MODE == "journal":
+        paths.append(_get_journal(store_name).journal_path)
+    parts = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            parts.append(f"{stat.st_mtime_ns:x}.{stat.st_size:x}")
+        except FileNotFoundError:
+            parts.append("0")
+    return "-".join(parts)
+
+def get_version_token(store_name):
+    """
+    Returns (token, data) for a store. The token comes from shared state, so
+    every worker gives the same token for the same contents, and it can be
+    used as an ETag or passed to get_changes_since_token.
+    """
+    for _ in range(3):
+        token = _shared_token(store_name)
+        value = _get_store(store_name)
+        with _cache_lock:
+            cached = _store_cache.get(store_name)
+            version = cached["version"] if cached is not None and cached["data"] is value \
+                else _store_versions.get(store_name, 0)
+        # Another process may have written in between; only a token that held still names this data.
+        if _shared_token(store_name) == token:
+            with _cache_lock:
+                tokens = _token_versions.setdefault(store_name, collections.OrderedDict())
+                tokens[token] = version
+                tokens.move_to_end(token)
+                while len(tokens) > CHANGE_LOG_SIZE:
+                    tokens.popitem(last=False)
+            return token, unwrap_store(value)
+    # Still changing under us: a token that never matches, so clients fetch again next time.
+    return f"{token}~", unwrap_store(value)
+
+def get_changes_since_token(store_name, since):
+    """
+    Like get_changes, for a token from get_version_token. Returns (token,
+    changes), where changes is None if the client has to re-read the store:
+    the token is unknown to this process (it was handed out by another
+    worker, or before a restart) or its history is gone.
+    """
+    token, _ = get_version_token(store_name)
+    if since == token:
+        return token, []
+    with _cache_lock:
+        tokens = _token_versions.get(store_name, {})
+        start, end = tokens.get(since), tokens.get(token)
+        if start is None or end is None or start > end or start < _change_log_floors.get(store_name, 0):
+            return token, None
+        return token, [dict(change, version=change_version)
+                       for change_version, change in _change_logs.get(store_name, ())
+                       if start < change_version <= end]
+
+def get_changes(store_name, since):
+    """
+    Returns (version, changes) with every change made after version `since`,
+    oldest first. changes is None if they are no longer known (the store was
+    reloaded or the log rolled over); the caller has to re-read the store.
+    """
+    _get_store(store_name)  # revalidate against the file first
+    with _cache_lock:
+        version = _store_versions.get(store_name, 0)
+        if since > version or since < _change_log_floors.get(store_name, 0):
+            return version, None
+        return version, [dict(change, version=change_version)
+                         for change_version, change in _change_logs.get(store_name, ())
+                         if change_version > since]
+
+def get_cache_stats():
+    """Returns hit/miss counters for the store cache."""
+    with _cache_lock:
+        hits, misses = _cache_stats["hits"], _cache_stats["misses"]
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "cached_stores": sorted(_store_cache),
+        }
+
+_journal_owner = None
+# Per store, the database version this process's change log is in step with (sqlite mode).
+_sqlite_seen = {}
+
+def get_store_sizes(store_names):
+    """Returns {store: {"entries": n or None, "bytes": size on disk}} for the given stores."""
+    sizes = {}
+    for store_name in store_names:
+        value = _get_store(store_name)
+        paths = [_store_path(store_name)]
+        if STORE_MODE == "journal":
+            paths.append(_get_journal(store_name).journal_path)
+        size = 0
+        if STORE_MODE == "sqlite":
+            paths = []
+            if _sqlite().kind(store_name) is not None:
+                size = _sqlite().size_bytes(store_name)
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        sizes[store_name] = {"entries": len(value) if isinstance(value, ListStore) else None, "bytes": size}
+    return sizes
+
+def _get_journal(store_name):
+    """Returns a store's journal, first making sure no other process is using journal mode."""
+    global _journal_owner
+    with _cache_lock:
+        if _journal_owner is None:
+            owner = FileLock(os.path.join(DATA_DIR, "journal.lock"))
+            if not owner.try_acquire():
+                raise RuntimeError("Another process is using the stores in journal mode. "
+                                   "Run several workers with QAPI_STORE_MODE=file instead.")
+            _journal_owner = owner
+    return get_journal(DATA_DIR, store_name)
+
+def _get_journaled(store_name):
+    """_get_store for journal mode, where the in-memory copy is authoritative."""
+    with _cache_lock:
+        cached = _store_cache.get(store_name)
+        if cached is not None:
+            _cache_stats["hits"] += 1
+            return cached["data"]
+
+    journal = _get_journal(store_name)
+    with journal.lock:
+        with _cache_lock:
+            cached = _store_cache.get(store_name)
+            if cached is not None:
+                return cached["data"]
+        try:
+            value, found = journal.load(_default_store(store_name))
+        except json.JSONDecodeError:
+            return {"error": f"Invalid JSON in data store '{store_name}'."}
+        if not found:
+            return value
+        with _cache_lock:
+            _cache_stats["misses"] += 1
+            _cache_store(store_name, None, value)
+        return value
+
+def _sqlite():
+    return get_backend(os.getenv("QAPI_SQLITE_PATH") or os.path.join(DATA_DIR, "qapi.db"))
+
+def _get_sqlite_store(store_name):
+    """_get_store for sqlite mode. List stores come back as a SqliteListStore that queries the database."""
+    backend = _sqlite()
+    with get_store_lock(DATA_DIR, store_name).read():
+        db_version = backend.version(store_name)
+        with _cache_lock:
+            if _sqlite_seen.get(store_name, 0) != db_version:
+                # Changed by another process; those changes aren't in our log.
+                _sqlite_seen[store_name] = db_version
+                _bump_version(store_name, None)
+        kind = backend.kind(store_name)
+        if kind == "value":
+            return backend.read_value(store_name)
+    if kind == "list":
+        return SqliteListStore(backend, store_name)
+    return wrap_store(_default_store(store_name))
+
+def _mutate_sqlite(store_name, op):
+    value = _get_sqlite_store(store_name)
+    # A store that isn't in the database yet starts out empty.
+    if op["op"] != "write" and not isinstance(value, ListStore):
+        value = ListStore([])
+    changes = _describe_changes(value, op)
+    with _cache_lock:
+        seen = _sqlite_seen.get(store_name, 0)
+    version, written = _sqlite().apply(store_name, op)
+    _bytes_written.inc(written, store=store_name)
+    with _cache_lock:
+        # If another process wrote in between, our change alone doesn't describe the difference.
+        _bump_version(store_name, changes if version == seen + 1 else None)
+        _sqlite_seen[store_name] = version
+    return {"success": f"Data store '{store_name}' updated."}
+
+def _get_store(store_name):
+    """
+    Returns the in-memory value of a store: a ListStore for list stores,
+    the parsed JSON otherwise. Parsed stores are cached until the file's
+    signature changes.
+    """
+    if STORE_MODE == "journal":
+        return _get_journaled(store_name)
+    if STORE_MODE == "sqlite":
+        return _get_sqlite_store(store_name)
+
+    # Wait out writers in this process, so their file isn't taken for an outside edit.
+    with get_store_lock(DATA_DIR, store_name).read():
+        return _load_store_file(store_name)
+
+def _load_store_file(store_name):
+    file_path = _store_path(store_name)
+    try:
+        signature = _file_signature(file_path)
+    except FileNotFoundError:
+        _drop_cached_store(store_name)
+        return wrap_store(_default_store(store_name))
+
+    with _cache_lock:
+        cached = _store_cache.get(store_name)
+        if cached is not None and cached["signature"] == signature:
+            _cache_stats["hits"] += 1
+            return cached["data"]
+
     try:
         with open(file_path, 'r') as f:
-            return json.load(f)
+            value = wrap_store(json.load(f))
+        _bytes_read.inc(signature[1], store=store_name)
     except FileNotFoundError:
-        # If the file doesn't exist, return an empty list for list-based stores
-        # or an empty dict for dict-based stores (like priorities)
-        if store_name in ['user_goals_map', 'agent_context', 'user_context', 'agent_tasks', 'timeheap', 'chatlog']:
-            return []
-        elif store_name == 'priorities':
-            return {"daily": [], "weekly": [], "monthly": []}
-        return {"error": f"Data store '{store_name}' not found."}
+        _drop_cached_store(store_name)
+        return wrap_store(_default_store(store_name))
     except json.JSONDecodeError:
+        _drop_cached_store(store_name)
         return {"error": f"Invalid JSON in data store '{store_name}'."}
 
+    with _cache_lock:
+        _cache_stats["misses"] += 1
+        _cache_store(store_name, signature, value)
+    return value
+
+def _mutate(store_name, op):
+    """
+    Persists one mutation ({"op": "write" | "append" | "delete" | "batch", ...})
+    and applies it to the cached store. A delete carries either "id" or a list
+    of "ids"; a batch carries "delete" ids, "update" entries and "append"
+    entries. Raises on failure.
+    """
+    if STORE_MODE == "journal":
+        journal = _get_journal(store_name)
+        with journal.lock:
+            value = _get_journaled(store_name)
+            if op["op"] != "write" and not isinstance(value, ListStore):
+                value = ListStore([])
+            changes = _describe_changes(value, op)
+            _bytes_written.inc(journal.record(op), store=store_name)
+            value = apply_op(value, op)
+            with _cache_lock:
+                _cache_store(store_name, None, value, changes)
+            if journal.needs_compaction():
+                journal.compact(value)
+        return {"success": f"Data store '{store_name}' updated."}
+
+    # Held across read, change and write, against threads here and other server processes.
+    with get_store_lock(DATA_DIR, store_name).write():
+        if STORE_MODE == "sqlite":
+            return _mutate_sqlite(store_name, op)
+        return _mutate_file(store_name, op)
+
+def _mutate_file(store_name, op):
+    value = _get_store(store_name)
+    if op["op"] != "write" and isinstance(value, dict) and "error" in value:
+        # Don't paper over a store file that won't parse; a full write may still replace it.
+        if _store_exists(store_name):
+            raise ValueError(value["error"])
+        value = ListStore([])  # no file yet, the first append creates the store
+    current = value.entries() if isinstance(value, ListStore) else []
+    changes = _describe_changes(value, op) if isinstance(value, ListStore) else None
+    if op["op"] == "write":
+        new_data = op["data"]
+    elif op["op"] == "append":
+        new_data = current + [op["entry"]]
+    elif op["op"] == "batch":
+        new_data = apply_op(ListStore(current), op).entries()
+    else:
+        dropped = set(op.get("ids") or [op["id"]])
+        new_data = [entry for entry in current if entry.get("id") not in dropped]
+
+    file_path = _store_path(store_name)
+    try:
+        atomic_write_json(file_path, new_data)
+        signature = _file_signature(file_path)
+        _bytes_written.inc(signature[1], store=store_name)
+    except Exception:
+        _drop_cached_store(store_name)
+        raise
+
+    with _cache_lock:
+        cached = _store_cache.get(store_name)
+        if op["op"] != "write" and cached is not None and cached["data"] is value:
+            # Keep the warm indexes instead of rebuilding them from new_data.
+            _cache_store(store_name, signature, apply_op(value, op), changes)
+        elif op["op"] == "write" and cached is not None and cached["data"] is value:
+            _cache_store(store_name, signature, wrap_store(new_data), changes)
+        else:
+            _cache_store(store_name, signature, wrap_store(new_data))
+    return {"success": f"Data store '{store_name}' updated."}
+
+def compact_journals():
+    """Writes every journaled store back to its JSON snapshot."""
+    if STORE_MODE != "journal":
+        return
+    with _cache_lock:
+        stores = {name: cached["data"] for name, cached in _store_cache.items()}
+    for store_name, value in stores.items():
+        journal = _get_journal(store_name)
+        with journal.lock:
+            if os.path.exists(journal.journal_path):
+                journal.compact(value, background=False)
+
+# Leave readable, up to date JSON files behind on a clean shutdown.
+atexit.register(compact_journals)
+
+def locked_store(store_name):
+    """
+    Returns a context manager that holds off every other writer to the store,
+    in this process and others, for a read-then-write sequence of calls.
+    """
+    if STORE_MODE == "journal":
+        return _get_journal(store_name).lock
+    return get_store_lock(DATA_DIR, store_name).write()
+
+def _store_exists(store_name):
+    """Whether anything backs the store yet: its file, journal or database table."""
+    if STORE_MODE == "sqlite":
+        return _sqlite().kind(store_name) is not None
+    if STORE_MODE == "journal" and os.path.exists(_get_journal(store_name).journal_path):
+        return True
+    return os.path.exists(_store_path(store_name))
+
+def get_list_store(store_name):
+    """
+    Returns the indexed ListStore behind a list store, or an error dict.
+    Like read_data's result, it is shared with the cache: don't modify it.
+    """
+    store = _get_store(store_name)
+    if isinstance(store, dict) and "error" in store:
+        return store
+    if not isinstance(store, ListStore):
+        return {"error": f"Data store '{store_name}' is not a list."}
+    return store
+
+@timed
+def delete_data_entries(store_name, entry_ids):
+    """Deletes several entries from a list-based data store in one write."""
+    try:
+        store = get_list_store(store_name)
+        if isinstance(store, dict):
+            return store
+        entry_ids = [entry_id for entry_id in entry_ids if store.get(entry_id) is not None]
+        if not entry_ids:
+            return {"success": f"Nothing to delete in '{store_name}'."}
+        return _mutate(store_name, {"op": "delete", "ids": entry_ids})
+    except Exception as e:
+        return {"error": f"Error deleting from data store '{store_name}': {e}"}
+
+@timed
+def read_data(store_name):
+    """Reads data from a specified JSON file in the data directory."""
+    return unwrap_store(_get_store(store_name))
+
+@timed
 def write_data(store_name, data):
     """Writes data to a specified JSON file in the data directory."""
-    file_path = os.path.join(DATA_DIR, f"{store_name}.json")
     try:
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=4)
-        return {"success": f"Data store '{store_name}' updated."}
+        if isinstance(data, list):
+            for entry in data:
+                _add_due_ts(entry)
+        return _mutate(store_name, {"op": "write", "data": data})
     except Exception as e:
         return {"error": f"Error writing to data store '{store_name}': {e}"}
 
+@timed
 def append_data(store_name, new_entry):
     """
     Appends a new entry to a JSON list in a file,
     automatically adding id, entry_date, and truncated_desc.
     """
-    file_path = os.path.join(DATA_DIR, f"{store_name}.json")
     try:
-        data = read_data(store_name)
-        if "error" in data: # Handle case where read_data returned an error
-            data = [] # Assume empty list if file not found or invalid JSON for append
+        # Only the kind of store matters here; unwrapping would read every entry (all rows in sqlite mode).
+        store = _get_store(store_name)
+        if isinstance(store, dict) and "error" in store:
+            store = ListStore([]) # Assume empty list if file not found or invalid JSON for append
 
-        if isinstance(data, list):
+        if isinstance(store, ListStore):
             # Add metadata if not already present
-            if "id" not in new_entry:
-                new_entry["id"] = _generate_id()
-            if "entry_date" not in new_entry:
-                new_entry["entry_date"] = get_timestamp()
-            if "description" in new_entry and "truncated_desc" not in new_entry:
-                new_entry["truncated_desc"] = _create_truncated_desc(new_entry["description"])
-
-            data.append(new_entry)
-            return write_data(store_name, data)
+            _add_metadata(new_entry)
+            return _mutate(store_name, {"op": "append", "entry": new_entry})
         else:
             return {"error": f"Data store '{store_name}' is not a list. Use write_data for dictionary-based stores."}
     except Exception as e:
         return {"error": f"Error appending to data store '{store_name}': {e}"}
 
+@timed
 def delete_data_entry(store_name, entry_id):
     """Deletes an entry from a list-based data store by its ID."""
-    file_path = os.path.join(DATA_DIR, f"{store_name}.json")
     try:
-        data = read_data(store_name)
-        if "error" in data:
-            return data # Pass through error from read_data
+        store = _get_store(store_name)
+        if isinstance(store, dict) and "error" in store:
+            return store # Pass through error from read_data
 
-        if isinstance(data, list):
-            initial_len = len(data)
-            data = [entry for entry in data if entry.get("id") != entry_id]
-            if len(data) < initial_len:
-                return write_data(store_name, data)
-            else:
+        if isinstance(store, ListStore):
+            if store.get(entry_id) is None:
                 return {"error": f"Entry with ID '{entry_id}' not found in '{store_name}'."}
+            return _mutate(store_name, {"op": "delete", "id": entry_id})
         else:
             return {"error": f"Data store '{store_name}' is not a list. Cannot delete by ID."}
     except Exception as e:
         return {"error": f"Error deleting from data store '{store_name}': {e}"}
 
+def _plan_batch(store_name, ops):
+    """
+    Turns one store's share of a batch_mutate call into a single "batch"
+    mutation. Returns (mutation, summary). Raises ValueError if any
+    operation can't be applied. Caller holds the store's lock.
+    """
+    store = get_list_store(store_name)
+    if isinstance(store, dict):
+        if _store_exists(store_name):
+            raise ValueError(store["error"])
+        store = ListStore([])  # the batch creates the store
+
+    deleted, updated, appended = [], {}, []
+    for op in ops:
+        kind = op.get("op")
+        if kind == "append":
+            if not isinstance(op.get("entry"), dict):
+                raise ValueError("An append needs an 'entry' object.")
+            appended.append(_add_metadata(dict(op["entry"])))
+        elif kind in ("update", "delete"):
+            entry_id = op.get("entry_id")
+            current = updated.get(entry_id) or (store.get(entry_id) if entry_id not in deleted else None)
+            if current is None:
+                raise ValueError(f"Entry with ID '{entry_id}' not found.")
+            if kind == "delete":
+                updated.pop(entry_id, None)
+                deleted.append(entry_id)
+                continue
+            fields = op.get("fields")
+            if not isinstance(fields, dict):
+                raise ValueError("An update needs a 'fields' object.")
+            entry = dict(current, **fields, id=entry_id)
+            if "description" in fields and "truncated_desc" not in fields:
+                entry["truncated_desc"] = _create_truncated_desc(str(entry["description"]))
+            _add_due_ts(entry)
+            updated[entry_id] = entry
+        else:
+            raise ValueError(f"Unknown op '{kind}'. Use append, update or delete.")
+
+    mutation = {"op": "batch", "delete": deleted, "update": list(updated.values()), "append": appended}
+    summary = {"appended": [entry["id"] for entry in appended], "updated": len(updated), "deleted": len(deleted)}
+    return mutation, summary
+
+@timed
+def batch_mutate(operations):
+    """
+    Applies a list of operations on list stores, each one of
+    {"op": "append", "store_name", "entry"}, {"op": "update", "store_name",
+    "entry_id", "fields"} or {"op": "delete", "store_name", "entry_id"}.
+    Each store's operations are written in one mutation, all or nothing;
+    a store that fails doesn't hold back the others.
+    Returns {store_name: summary or error}.
+    """
+    if not isinstance(operations, list) or not operations:
+        return {"error": "'operations' must be a non-empty list."}
+    by_store = {}
+    for op in operations:
+        if not isinstance(op, dict) or not op.get("store_name"):
+            return {"error": f"Every operation needs a 'store_name': {op}"}
+        by_store.setdefault(op["store_name"], []).append(op)
+
+    results = {}
+    for store_name, ops in by_store.items():
+        try:
+            with locked_store(store_name):
+                mutation, summary = _plan_batch(store_name, ops)
+                _mutate(store_name, mutation)
+            results[store_name] = summary
+        except Exception as e:
+            results[store_name] = {"error": f"Nothing changed in '{store_name}': {e}"}
+    return results
+
+@timed
+def import_entries(store_name, lines, batch_size=None):
+    """
+    Appends entries from an iterable of JSON lines to a list store,
+    batch_size (default QAPI_IMPORT_BATCH_SIZE) entries per write, so memory use doesn't grow with the input.
+    Entries whose id is already in the store are skipped, which makes an
+    interrupted import safe to re-run. Returns counts and the first few bad lines.
+    """
+    if store_name not in LIST_STORES:
+        return {"error": f"'{store_name}' is not a list store. Use one of: {', '.join(LIST_STORES)}."}
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    report = {"imported": 0, "skipped": 0, "batches": 0, "bad_lines": 0, "errors": []}
+
+    def flush(batch):
+        with locked_store(store_name):
+            store = get_list_store(store_name)
+            if isinstance(store, dict):
+                raise ValueError(store["error"])
+            fresh, seen = [], set()
+            for entry in batch:
+                if entry["id"] in seen or store.get(entry["id"]) is not None:
+                    report["skipped"] += 1
+                    continue
+                seen.add(entry["id"])
+                fresh.append(entry)
+            if fresh:
+                _mutate(store_name, {"op": "batch", "append": fresh})
+        report["imported"] += len(fresh)
+        report["batches"] += 1
+
+    batch = []
+    try:
+        for line_no, line in enumerate(lines, 1):
+            try:
+                if isinstance(line, bytes):
+                    line = line.decode("utf-8")
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if not isinstance(entry, dict):
+                    raise ValueError("not a JSON object")
+            except ValueError as e:
+                report["bad_lines"] += 1
+                if len(report["errors"]) < 20:
+                    report["errors"].append({"line": line_no, "error": str(e)})
+                continue
+            batch.append(_add_metadata(entry))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    except Exception as e:
+        # Whatever was flushed before this stays imported.
+        return dict(report, error=f"Import into '{store_name}' stopped: {e}")
+    return report
+
+@timed
 def load_memory(store_name, entry_id=None):
     """
     Loads memory from a specified data store.
     If entry_id is provided, loads a specific entry.
     Otherwise, loads the entire store.
     """
-    data = read_data(store_name)
-    if "error" in data:
-        return data
+    store = _get_store(store_name)
+    if isinstance(store, dict) and "error" in store:
+        return store
 
     if entry_id:
-        if isinstance(data, list):
-            for entry in data:
-                if entry.get("id") == entry_id:
-                    return entry
+        if isinstance(store, ListStore):
+            entry = store.get(entry_id)
+            if entry is not None:
+                return entry
             return {"error": f"Entry with ID '{entry_id}' not found in '{store_name}'."}
         else:
             return {"error": f"Data store '{store_name}' is not a list. Cannot load specific entry by ID."}
-    return data
+    return unwrap_store(store)
+
+@timed
+def load_summaries(store_name, cursor=None, limit=50):
+    """
+    Loads one page of a list store as just ids and truncated descriptions.
+    Pass the returned next_cursor to get the following page; it is None on the last one.
+    """
+    store = _get_store(store_name)
+    if isinstance(store, dict) and "error" in store:
+        return store
+    if not isinstance(store, ListStore):
+        return {"error": f"Data store '{store_name}' is not a list. Use read_data for dictionary-based stores."}
+
+    try:
+        entries, more = store.page(cursor, max(1, min(int(limit), 500)))
+    except KeyError:
+        return {"error": f"Cursor '{cursor}' is no longer valid (the entry was deleted). Start over without a cursor."}
+    summaries = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        summaries.append({
+            "id": entry.get("id"),
+            "truncated_desc": entry.get("truncated_desc") or _create_truncated_desc(str(entry.get("description", ""))),
+        })
+    ids = [summary["id"] for summary in summaries if summary["id"] is not None]
+    return {"entries": summaries, "next_cursor": ids[-1] if more and ids else None, "total": len(store)}
+
+@timed
+def load_entries(store_name, entry_ids):
+    """Loads the full entries for a list of ids in one call. Unknown ids are listed under 'missing'."""
+    store = _get_store(store_name)
+    if isinstance(store, dict) and "error" in store:
+        return store
+    if not isinstance(store, ListStore):
+        return {"error": f"Data store '{store_name}' is not a list. Cannot load entries by ID."}
+
+    entries, missing = [], []
+    for entry_id in entry_ids:
+        entry = store.get(entry_id)
+        if entry is None:
+            missing.append(entry_id)
+        else:
+            entries.append(entry)
+    return {"entries": entries, "missing": missing}
+
+@timed
+def find_entries_by_date(store_name, field, start=None, end=None):
+    """
+    Returns the entries of a list store whose due_date or entry_date falls
+    between start and end (ISO timestamps, either one optional), oldest first.
+    """
+    store = _get_store(store_name)
+    if isinstance(store, dict) and "error" in store:
+        return store
+    if not isinstance(store, ListStore):
+        return {"error": f"Data store '{store_name}' is not a list. Cannot query by date."}
+
+    bounds = []
+    for bound in (start, end):
+        timestamp = parse_timestamp(bound) if bound else None
+        if bound and timestamp is None:
+            return {"error": f"Invalid timestamp '{bound}'. Use ISO format."}
+        bounds.append(timestamp)
+    try:
+        return store.find_by_date(field, bounds[0], bounds[1])
+    except ValueError as e:
+        return {"error": str(e)}
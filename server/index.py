@@ -0,0 +1,207 @@
+"""
+In-memory indexes for list stores.
+
+ListStore holds a list store's entries together with an id -> slot map and
+sorted (timestamp, id) indexes on due_date and entry_date, so single-entry
+lookups, deletes and date range queries don't scan the store. Deleting an
+entry only leaves a hole in its slot; holes are squeezed out lazily.
+
+Deleting or re-dating an entry leaves its old (timestamp, id) pair behind in
+the date index. Stale pairs at the front are skipped right away (a head
+offset moves past them), so the earliest live entry is always at the head,
+and the index is compacted once stale pairs outnumber live ones. Range
+queries skip the few stale pairs in between.
+"""
+import bisect
+import threading
+from datetime import datetime, timezone
+
+DATE_FIELDS = ("due_date", "entry_date")
+
+def parse_timestamp(value):
+    """
+    Parses an ISO timestamp (a 'Z' suffix is fine) to epoch seconds.
+    Naive timestamps are taken as UTC. Returns None if it can't be parsed.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+class ListStore:
+    """A list store plus its id and date indexes."""
+
+    def __init__(self, entries):
+        self._lock = threading.Lock()
+        self._build(list(entries))
+
+    def _build(self, slots):
+        self._slots = slots
+        self._view = [entry for entry in slots if entry is not None]
+        self._holes = len(slots) - len(self._view)
+        self._positions = {}      # id -> slot of its first entry
+        self._duplicates = set()  # ids that appear more than once
+        self._dates = {field: [] for field in DATE_FIELDS}     # sorted (timestamp, id), live from _heads on
+        self._heads = {field: 0 for field in DATE_FIELDS}      # first pair that may be live
+        self._stale = {field: 0 for field in DATE_FIELDS}      # stale pairs at or after the head
+        self._timestamps = {field: {} for field in DATE_FIELDS}  # id -> timestamp (of its live pair)
+        for slot, entry in enumerate(slots):
+            if entry is not None:
+                self._index(slot, entry)
+        for field in DATE_FIELDS:
+            self._dates[field].sort(key=lambda item: item[0])
+
+    def _index(self, slot, entry, keep_sorted=False):
+        if not isinstance(entry, dict) or entry.get("id") is None:
+            return
+        entry_id = entry["id"]
+        if entry_id in self._positions:
+            self._duplicates.add(entry_id)
+            return
+        self._positions[entry_id] = slot
+        for field in DATE_FIELDS:
+            timestamp = parse_timestamp(entry.get(field))
+            if timestamp is None:
+                continue
+            self._timestamps[field][entry_id] = timestamp
+            dates = self._dates[field]
+            if keep_sorted and dates and dates[-1][0] > timestamp:
+                position = bisect.bisect_right(dates, timestamp, lo=self._heads[field], key=lambda item: item[0])
+                dates.insert(position, (timestamp, entry_id))
+            else:
+                dates.append((timestamp, entry_id))
+
+    def _unindex_date(self, field, entry_id):
+        """Marks the entry's pair in a date index stale. Caller holds _lock."""
+        if self._timestamps[field].pop(entry_id, None) is None:
+            return
+        self._stale[field] += 1
+        dates, timestamps = self._dates[field], self._timestamps[field]
+        head = self._heads[field]
+        while head < len(dates) and timestamps.get(dates[head][1]) != dates[head][0]:
+            head += 1
+            self._stale[field] -= 1
+        self._heads[field] = head
+        live = len(dates) - head - self._stale[field]
+        if self._stale[field] > 32 and self._stale[field] > live:
+            self._dates[field] = [pair for pair in dates[head:] if timestamps.get(pair[1]) == pair[0]]
+            self._heads[field] = 0
+            self._stale[field] = 0
+        elif head > 32 and head > len(dates) // 2:
+            # Drop the skipped front once it's most of the list.
+            del dates[:head]
+            self._heads[field] = 0
+
+    def __len__(self):
+        return len(self._slots) - self._holes
+
+    def entries(self):
+        """Returns the live entries in store order. The list is shared: don't modify it."""
+        with self._lock:
+            if self._view is None:
+                self._view = [entry for entry in self._slots if entry is not None]
+            return self._view
+
+    def get(self, entry_id):
+        with self._lock:
+            slot = self._positions.get(entry_id)
+            return None if slot is None else self._slots[slot]
+
+    def page(self, after_id=None, limit=50):
+        """
+        Returns up to `limit` live entries in store order, starting after the
+        entry with id `after_id`. Raises KeyError if that entry is gone.
+        """
+        with self._lock:
+            if after_id is None:
+                slot = 0
+            else:
+                slot = self._positions[after_id] + 1
+            found = []
+            while slot < len(self._slots) and len(found) < limit:
+                if self._slots[slot] is not None:
+                    found.append(self._slots[slot])
+                slot += 1
+            more = any(entry is not None for entry in self._slots[slot:slot + self._holes + 1])
+            return found, more
+
+    def append(self, entry):
+        with self._lock:
+            self._slots.append(entry)
+            # The old view may already be in a reader's hands, so leave it as it was.
+            self._view = None
+            self._index(len(self._slots) - 1, entry, keep_sorted=True)
+
+    def replace(self, entry_id, entry):
+        """Puts `entry` in the slot of the entry with this id. Returns False if there was none."""
+        with self._lock:
+            slot = self._positions.get(entry_id)
+            if slot is None:
+                return False
+            self._slots[slot] = entry
+            self._view = None
+            for field in DATE_FIELDS:
+                timestamp = parse_timestamp(entry.get(field)) if isinstance(entry, dict) else None
+                if timestamp == self._timestamps[field].get(entry_id):
+                    continue
+                self._unindex_date(field, entry_id)
+                if timestamp is None:
+                    continue
+                self._timestamps[field][entry_id] = timestamp
+                dates = self._dates[field]
+                dates.insert(bisect.bisect_right(dates, timestamp, lo=self._heads[field], key=lambda item: item[0]),
+                             (timestamp, entry_id))
+            return True
+
+    def delete(self, entry_id):
+        """Removes every entry with this id. Returns False if there was none."""
+        with self._lock:
+            slot = self._positions.pop(entry_id, None)
+            if slot is None:
+                return False
+            for field in DATE_FIELDS:
+                self._unindex_date(field, entry_id)
+            # Handed-out views stay as they were; the next entries() call builds a new one.
+            self._view = None
+            if entry_id in self._duplicates:
+                self._duplicates.discard(entry_id)
+                self._build([entry for entry in self._slots
+                             if entry is not None and not (isinstance(entry, dict) and entry.get("id") == entry_id)])
+                return True
+            self._slots[slot] = None
+            self._holes += 1
+            if self._holes > 32 and self._holes > len(self._slots) // 2:
+                self._build([entry for entry in self._slots if entry is not None])
+            return True
+
+    def find_by_date(self, field, start=None, end=None, limit=None):
+        """
+        Returns entries whose `field` timestamp falls in [start, end] (epoch
+        seconds, either bound optional), ordered by that timestamp.
+        """
+        if field not in DATE_FIELDS:
+            raise ValueError(f"No index on '{field}'. Indexed fields: {', '.join(DATE_FIELDS)}")
+        with self._lock:
+            dates = self._dates[field]
+            timestamps = self._timestamps[field]
+            head = self._heads[field]
+            lo = head if start is None else bisect.bisect_left(dates, start, lo=head, key=lambda item: item[0])
+            hi = len(dates) if end is None else bisect.bisect_right(dates, end, lo=head, key=lambda item: item[0])
+            found = []
+            seen = set()
+            for position in range(lo, hi):
+                timestamp, entry_id = dates[position]
+                if timestamps.get(entry_id) != timestamp or entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                found.append(self._slots[self._positions[entry_id]])
+                if limit is not None and len(found) >= limit:
+                    break
+            return found
@@ -0,0 +1,205 @@
+"""
+Background jobs for the long-running endpoints (/instruct, /search,
+/create_daily_timeheap).
+
+A bounded pool of worker threads takes jobs off a bounded queue. Submitting
+to a full queue fails right away instead of piling work up. Each job gets a
+deadline that the job function is expected to check between steps. A job
+still running at its deadline (stuck in a model call, say) is marked
+timed_out there and then, and its worker moves on; the abandoned run is left
+to finish on its own thread and its result is dropped.
+
+Identical requests arriving together share one execution: a job submitted
+with the key of a job that is still queued or running gets that job back,
+and SingleFlight does the same for requests answered inline.
+"""
+import collections
+import contextvars
+import logging
+import queue
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    pass
+
+class JobTimeout(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind, fn, args, timeout, key=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.context = contextvars.copy_context()  # so the job logs under the submitting request's id
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.timeout = timeout
+        self.status = "queued"   # queued, running, done, failed, timed_out
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.abandoned = False  # timed out while its run was still going
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+class JobQueue:
+    def __init__(self, workers=2, max_queued=16, timeout=300.0, keep_finished=1000):
+        self.timeout = timeout
+        self.keep_finished = keep_finished
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._finished = collections.deque()  # ids in the order they finished, oldest first
+        self._inflight = {}  # key -> queued or running job
+        self._abandoned = 0  # timed out jobs whose run hasn't returned yet
+        self._lock = threading.Lock()
+        for number in range(workers):
+            threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True).start()
+
+    def submit(self, kind, fn, *args, timeout=None, key=None):
+        """
+        Queues fn(*args, deadline=...) and returns the Job. If a job with the
+        same key is still queued or running, returns that one instead.
+        Raises QueueFull when the queue is at its limit.
+        """
+        job = Job(kind, fn, args, timeout or self.timeout, key)
+        with self._lock:
+            if key is not None:
+                if key in self._inflight:
+                    return self._inflight[key]
+                self._inflight[key] = job
+            self._jobs[job.id] = job
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                del self._jobs[job.id]
+                self._inflight.pop(key, None)
+                raise QueueFull(f"{self._queue.maxsize} jobs are already queued.")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout):
+        """Waits up to `timeout` seconds for a job to finish and returns it (None if unknown)."""
+        job = self.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.status == "running")
+            abandoned = self._abandoned
+        return {"queued": self._queue.qsize(), "running": running, "abandoned": abandoned,
+                "max_queued": self._queue.maxsize}
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.started = time.time()
+            deadline = job.started + job.timeout
+            runner = threading.Thread(target=self._run, args=(job, deadline), name=f"job-{job.id[:8]}", daemon=True)
+            runner.start()
+            runner.join(max(0.0, deadline - time.time()))
+            if runner.is_alive():
+                self._abandon(job)
+
+    def _abandon(self, job):
+        with self._lock:
+            if job.finished is not None:
+                return
+            job.abandoned = True
+            self._abandoned += 1
+        logger.warning("Job %s (%s) is still running at its deadline; giving up on it.", job.id, job.kind)
+        self._finish(job, "timed_out", error=f"The job ran past its {job.timeout:g}s deadline.")
+
+    def _run(self, job, deadline):
+        try:
+            result = job.context.run(job.fn, *job.args, deadline=deadline)
+        except JobTimeout as e:
+            self._finish(job, "timed_out", error=str(e))
+        except Exception as e:
+            logger.exception("Job %s (%s) failed.", job.id, job.kind)
+            self._finish(job, "failed", error=str(e))
+        else:
+            self._finish(job, "done", result=result)
+        with self._lock:
+            if job.abandoned:
+                self._abandoned -= 1
+
+    def _finish(self, job, status, result=None, error=None):
+        """Settles a job. The first call wins: a run that returns after its job timed out changes nothing."""
+        with self._lock:
+            if job.finished is not None:
+                return
+            job.status, job.result, job.error = status, result, error
+            job.finished = time.time()
+            job.fn = job.args = job.context = None
+            if job.key is not None and self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+        job.done.set()
+        self._forget_old(job.id)
+
+    def _forget_old(self, job_id):
+        with self._lock:
+            self._finished.append(job_id)
+            while len(self._finished) > self.keep_finished:
+                self._jobs.pop(self._finished.popleft(), None)
+
+class SingleFlight:
+    """Lets concurrent calls with the same key share one execution."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """
+        Returns (fn(*args), shared). If a call with this key is already
+        running, waits for it and returns its result (or raises its error).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
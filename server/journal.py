@@ -0,0 +1,249 @@
+"""
+Append-only journal storage for the data stores.
+
+In journal mode a mutation is written as one JSON line to
+data/<store>.journal.jsonl instead of rewriting data/<store>.json. The JSON
+file becomes a snapshot: once enough records pile up, a background thread
+writes the current state to it (temp file + rename) and the journal starts
+over. Loading a store reads the snapshot and replays whatever journal tail
+is left, so a crash loses at most the records that were not fsynced yet.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from server.index import ListStore
+
+# Records are fsynced once this many are pending, or by the flusher thread
+# every FSYNC_INTERVAL seconds, whichever comes first.
+FSYNC_INTERVAL = float(os.getenv("QAPI_JOURNAL_FSYNC_INTERVAL", "0.05"))
+FSYNC_BATCH = int(os.getenv("QAPI_JOURNAL_FSYNC_BATCH", "32"))
+# Number of journal records after which a store is compacted into its snapshot.
+COMPACT_AFTER = int(os.getenv("QAPI_JOURNAL_COMPACT_AFTER", "1000"))
+
+logger = logging.getLogger(__name__)
+
+_journals = {}
+_journals_lock = threading.Lock()
+_flusher = None
+
+def wrap_store(data):
+    """List stores are held in memory as an indexed ListStore, anything else as is."""
+    return ListStore(data) if isinstance(data, list) else data
+
+def unwrap_store(value):
+    return value.entries() if isinstance(value, ListStore) else value
+
+def apply_op(value, op, replay=False):
+    """
+    Applies one mutation record to an in-memory store and returns the new
+    store value. List stores are changed in place. When replaying, appends
+    whose id is already present made it into the snapshot and are skipped.
+    """
+    kind = op["op"]
+    if kind == "write":
+        return wrap_store(op["data"])
+    if kind == "append":
+        entry = op["entry"]
+        if replay and entry.get("id") is not None and value.get(entry["id"]) is not None:
+            return value
+        value.append(entry)
+        return value
+    if kind == "delete":
+        for entry_id in op.get("ids") or [op["id"]]:
+            value.delete(entry_id)
+        return value
+    if kind == "batch":
+        # Deletes, then updates (whole entries, matched by id), then appends.
+        for entry_id in op.get("delete", ()):
+            value.delete(entry_id)
+        for entry in op.get("update", ()):
+            value.replace(entry["id"], entry)
+        for entry in op.get("append", ()):
+            if replay and entry.get("id") is not None and value.get(entry["id"]) is not None:
+                continue
+            value.append(entry)
+        return value
+    raise ValueError(f"Unknown journal op '{kind}'")
+
+class StoreJournal:
+    """The journal and snapshot files backing a single store."""
+
+    def __init__(self, data_dir, store_name):
+        self.store_name = store_name
+        self.snapshot_path = os.path.join(data_dir, f"{store_name}.json")
+        self.journal_path = os.path.join(data_dir, f"{store_name}.journal.jsonl")
+        self.compacting_path = self.journal_path + ".compacting"
+        # Held by callers around "record, then apply" so compaction sees a consistent cut.
+        self.lock = threading.RLock()
+        self._file = None
+        self._pending = 0   # records written but not fsynced yet
+        self._records = 0   # records since the last compaction
+        self._compactor = None
+
+    def load(self, default):
+        """
+        Rebuilds the store from its snapshot plus the journal tail.
+        Returns (value, found); found is False when neither file exists.
+        """
+        with self.lock:
+            found = False
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    data = json.load(f)
+                found = True
+            except FileNotFoundError:
+                data = default
+
+            value = wrap_store(data)
+            leftover = os.path.exists(self.compacting_path)
+            self._records = 0
+            for path in (self.compacting_path, self.journal_path):
+                for op in self._read_ops(path):
+                    found = True
+                    try:
+                        value = apply_op(value, op, replay=True)
+                    except Exception as e:
+                        logger.warning("Skipping bad journal record in %s: %s", path, e)
+                    self._records += 1
+
+            if leftover:
+                # A compaction died half way. Everything is replayed now, so
+                # finish it in the foreground before taking new writes.
+                self.compact(value, background=False)
+            return value, found
+
+    def _read_ops(self, path):
+        try:
+            with open(path, 'r') as f:
+                for line_no, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn write from a crash; only the tail can be torn.
+                        logger.warning("Ignoring torn record at %s:%d", path, line_no)
+                        return
+        except FileNotFoundError:
+            return
+
+    def record(self, op):
+        """Appends one mutation record to the journal. Returns its size in bytes."""
+        line = json.dumps(op) + "\n"
+        with self.lock:
+            if self._file is None:
+                self._file = open(self.journal_path, 'a')
+            self._file.write(line)
+            self._file.flush()
+            self._pending += 1
+            self._records += 1
+            if self._pending >= FSYNC_BATCH:
+                self.sync()
+        _start_flusher()
+        return len(line.encode())
+
+    def sync(self):
+        """fsyncs any records written since the last sync."""
+        with self.lock:
+            if self._file is not None and self._pending:
+                os.fsync(self._file.fileno())
+                self._pending = 0
+
+    def needs_compaction(self):
+        return self._records >= COMPACT_AFTER and not self._compacting()
+
+    def _compacting(self):
+        return self._compactor is not None and self._compactor.is_alive()
+
+    def compact(self, value, background=True):
+        """
+        Starts a new journal and writes `value` (the store after every record
+        in the old one) out as the snapshot.
+        """
+        with self.lock:
+            if self._compacting():
+                return
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.journal_path):
+                if os.path.exists(self.compacting_path):
+                    # Keep both tails replayable: fold the live journal into the leftover one.
+                    with open(self.journal_path, 'r') as src, open(self.compacting_path, 'a') as dst:
+                        dst.write(src.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, self.compacting_path)
+            self._records = 0
+            # Entries are never edited in place, so a shallow copy is a stable cut.
+            snapshot = unwrap_store(value)
+            if isinstance(snapshot, list):
+                snapshot = list(snapshot)
+            if background:
+                self._compactor = threading.Thread(target=self._write_snapshot, args=(snapshot,),
+                                                   name=f"compact-{self.store_name}")
+                self._compactor.start()
+            else:
+                self._write_snapshot(snapshot)
+
+    def _write_snapshot(self, data):
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            if os.path.exists(self.compacting_path):
+                os.remove(self.compacting_path)
+        except Exception:
+            logger.exception("Compaction of '%s' failed; the journal is kept for replay.", self.store_name)
+
+    def close(self):
+        with self.lock:
+            compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self.lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+def get_journal(data_dir, store_name):
+    """Returns the shared StoreJournal for a store."""
+    with _journals_lock:
+        journal = _journals.get(store_name)
+        if journal is None:
+            journal = _journals[store_name] = StoreJournal(data_dir, store_name)
+        return journal
+
+def _flush_loop(stop):
+    while not stop.wait(FSYNC_INTERVAL):
+        with _journals_lock:
+            journals = list(_journals.values())
+        for journal in journals:
+            try:
+                journal.sync()
+            except Exception:
+                logger.exception("fsync of '%s' journal failed.", journal.store_name)
+
+def _start_flusher():
+    global _flusher
+    with _journals_lock:
+        if _flusher is None:
+            _flusher = threading.Event()
+            threading.Thread(target=_flush_loop, args=(_flusher,), name="journal-flusher", daemon=True).start()
+
+def close_all():
+    """Flushes every open journal and waits for running compactions."""
+    with _journals_lock:
+        journals = list(_journals.values())
+    for journal in journals:
+        journal.close()
+
+atexit.register(close_all)
@@ -0,0 +1,423 @@
+"""
+LLM backends for the agent loop.
+
+agent_execute only needs start_chat(instruction) and chat.send_message(content),
+where instruction is the bare request the session is for (the stub picks its
+script by it), content is the full prompt or a list of {"function_response": ...} parts, and
+the reply is a Turn: a list of Parts holding either text or a FunctionCall.
+chat.stream_message(content) yields the same Parts as they arrive instead,
+text possibly split over several of them.
+Which backend is used comes from QAPI_LLM_BACKEND:
+
+    gemini  the real model (needs GEMINI_API_KEY), the default
+    stub    a scripted fake model, no network (QAPI_STUB_SCRIPT, QAPI_STUB_LATENCY)
+    record  gemini, saving every session to QAPI_RECORDINGS_DIR
+    replay  plays the sessions in QAPI_RECORDINGS_DIR back
+
+Whichever it is, model calls go through a CallLimiter that caps how many run
+at once and how fast they start (QAPI_LLM_MAX_CONCURRENT, QAPI_LLM_RATE).
+A session started with a deadline gives its slot back at the deadline even
+if its call hasn't returned, and Gemini calls give up after
+QAPI_LLM_CALL_TIMEOUT seconds.
+"""
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class FunctionCall:
+    def __init__(self, name, args=None):
+        self.name = name
+        self.args = args or {}
+
+class Part:
+    def __init__(self, text="", function_call=None):
+        self.text = text
+        self.function_call = function_call
+
+class Turn:
+    """One model reply."""
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def to_dict(self):
+        return {"parts": [
+            {"function_call": {"name": part.function_call.name, "args": part.function_call.args}}
+            if part.function_call else {"text": part.text}
+            for part in self.parts
+        ]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([
+            Part(function_call=FunctionCall(part["function_call"]["name"], part["function_call"].get("args")))
+            if "function_call" in part else Part(text=part.get("text", ""))
+            for part in data.get("parts", [])
+        ])
+
+def _plain(value):
+    """Turns the proto containers the Gemini SDK hands out into plain dicts and lists."""
+    if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        return value
+    if hasattr(value, "items"):
+        return {key: _plain(item) for key, item in value.items()}
+    return [_plain(item) for item in value]
+
+class _Chat:
+    def stream_message(self, content):
+        # Backends that can't stream hand the whole turn over at once.
+        yield from self.send_message(content).parts
+
+class GeminiBackend:
+    """The real model, through google-generativeai."""
+
+    def __init__(self, model_name, system_instruction, tools, temperature):
+        import google.generativeai as genai
+        from google.generativeai import types
+
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY not found in environment variables.")
+        genai.configure(api_key=api_key)
+        self._model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config={"temperature": temperature},
+            tools=types.Tool(function_declarations=tools),
+            system_instruction=system_instruction,
+        )
+
+    def start_chat(self, instruction=None):
+        return _GeminiChat(self._model.start_chat())
+
+# Longest one Gemini request may take, in seconds (0 for the SDK's default).
+CALL_TIMEOUT = float(os.getenv("QAPI_LLM_CALL_TIMEOUT", "120"))
+
+class _GeminiChat(_Chat):
+    def __init__(self, chat):
+        self._chat = chat
+        self._options = {"timeout": CALL_TIMEOUT} if CALL_TIMEOUT > 0 else None
+
+    def send_message(self, content):
+        return Turn(list(self._parts(self._chat.send_message(content, request_options=self._options))))
+
+    def stream_message(self, content):
+        for chunk in self._chat.send_message(content, stream=True, request_options=self._options):
+            yield from self._parts(chunk)
+
+    def _parts(self, response):
+        if response.candidates and response.candidates[0].content.parts:
+            for part in response.candidates[0].content.parts:
+                if part.function_call:
+                    yield Part(function_call=FunctionCall(part.function_call.name, _plain(part.function_call.args)))
+                elif part.text:
+                    yield Part(text=part.text)
+
+class StubBackend:
+    """
+    A deterministic fake model. The script is a list of sessions like
+    {"match": "...", "turns": [...]}, each turn being {"text": "...",
+    "function_calls": [{"name": ..., "args": {...}}], "latency": 0.2} (all
+    optional). A session with a "match" string is used for instructions that
+    contain it (the bare instruction given to start_chat, not the prompt built
+    around it, which carries the chatlog and store snapshots); other
+    instructions go round-robin over the sessions without one.
+    Once a session runs out of turns it keeps answering with plain text.
+    """
+
+    DEFAULT_SCRIPT = [
+        {"turns": [
+            {"function_calls": [{"name": "get_timestamp", "args": {}}]},
+            {"text": "Done."},
+        ]},
+    ]
+
+    def __init__(self, script=None, latency=0.0):
+        self.script = script or self.DEFAULT_SCRIPT
+        self.latency = latency
+        self._fallback = itertools.cycle([session for session in self.script if "match" not in session]
+                                         or self.script)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, latency=0.0):
+        with open(path, 'r') as f:
+            return cls(json.load(f), latency)
+
+    def start_chat(self, instruction=None):
+        return _StubChat(self, instruction)
+
+    def pick_session(self, prompt):
+        for session in self.script:
+            if "match" in session and session["match"] in prompt:
+                return session
+        with self._lock:
+            return next(self._fallback)
+
+class _StubChat(_Chat):
+    def __init__(self, backend, instruction):
+        self._backend = backend
+        self._instruction = instruction
+        self._turns = None
+
+    def _next_turn(self, content):
+        if self._turns is None:
+            instruction = self._instruction if self._instruction is not None else content
+            self._turns = iter(self._backend.pick_session(instruction if isinstance(instruction, str) else "")["turns"])
+        return next(self._turns, {"text": "Done."})
+
+    def send_message(self, content):
+        turn = self._next_turn(content)
+        time.sleep(turn.get("latency", self._backend.latency))
+        return Turn(self._function_calls(turn, [Part(text=turn["text"])] if turn.get("text") else []))
+
+    def stream_message(self, content):
+        # The turn's latency is spread over its text, one word per chunk.
+        turn = self._next_turn(content)
+        words = turn.get("text", "").split(" ") if turn.get("text") else []
+        latency = turn.get("latency", self._backend.latency)
+        for position, word in enumerate(words):
+            time.sleep(latency / len(words))
+            yield Part(text=word if position == 0 else " " + word)
+        if not words:
+            time.sleep(latency)
+        yield from self._function_calls(turn, [])
+
+    def _function_calls(self, turn, parts):
+        return parts + [Part(function_call=FunctionCall(call["name"], call.get("args", {})))
+                        for call in turn.get("function_calls", [])]
+
+class RecordingBackend:
+    """Wraps another backend and saves every session to a JSON file for ReplayBackend."""
+
+    def __init__(self, inner, directory):
+        self.inner = inner
+        self.directory = directory
+        self._sequence = itertools.count()
+        os.makedirs(directory, exist_ok=True)
+
+    def start_chat(self, instruction=None):
+        # Names sort in the order sessions started, which is the order they replay in.
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{next(self._sequence):06d}-{uuid.uuid4().hex[:6]}.json"
+        return _RecordingChat(self.inner.start_chat(instruction), os.path.join(self.directory, name))
+
+class _RecordingChat(_Chat):
+    def __init__(self, chat, path):
+        self._chat = chat
+        self._path = path
+        self._exchanges = []
+
+    def send_message(self, content):
+        turn = self._chat.send_message(content)
+        self._record(content, turn)
+        return turn
+
+    def stream_message(self, content):
+        parts = []
+        for part in self._chat.stream_message(content):
+            parts.append(part)
+            yield part
+        self._record(content, Turn(parts))
+
+    def _record(self, content, turn):
+        self._exchanges.append({"sent": content, "received": turn.to_dict()})
+        # Rewritten after every exchange so a session that dies half way is still usable.
+        with open(self._path, 'w') as f:
+            json.dump({"exchanges": self._exchanges}, f, indent=4, default=str)
+
+class ReplayMismatch(Exception):
+    pass
+
+class ReplayBackend:
+    """
+    Plays recorded sessions back in file name order, one per start_chat(),
+    starting over when they run out. The sent messages are compared with
+    the recording: in strict mode a difference raises ReplayMismatch,
+    otherwise it is only logged (tool results with ids and timestamps
+    rarely match exactly).
+    """
+
+    def __init__(self, directory, strict=False):
+        paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".json"))
+        if not paths:
+            raise ValueError(f"No recordings found in '{directory}'.")
+        self._sessions = []
+        for path in paths:
+            with open(path, 'r') as f:
+                self._sessions.append((path, json.load(f)["exchanges"]))
+        self._next = itertools.cycle(self._sessions)
+        self._lock = threading.Lock()
+        self.strict = strict
+
+    def start_chat(self, instruction=None):
+        with self._lock:
+            path, exchanges = next(self._next)
+        return _ReplayChat(path, exchanges, self.strict)
+
+class _ReplayChat(_Chat):
+    def __init__(self, path, exchanges, strict):
+        self._path = path
+        self._exchanges = iter(exchanges)
+        self._strict = strict
+
+    def send_message(self, content):
+        exchange = next(self._exchanges, None)
+        if exchange is None:
+            raise ReplayMismatch(f"{self._path}: the recording has no more turns.")
+        sent = json.loads(json.dumps(content, default=str))
+        if sent != exchange["sent"]:
+            if self._strict:
+                raise ReplayMismatch(f"{self._path}: sent message differs from the recording.")
+            logger.debug("%s: sent message differs from the recording.", self._path)
+        return Turn.from_dict(exchange["received"])
+
+class LLMBusy(Exception):
+    pass
+
+class CallLimiter:
+    """
+    A semaphore plus a token bucket in front of the model. At most
+    max_concurrent calls run at once, and calls start at no more than `rate`
+    per second on average (bursts of up to `burst`; rate 0 means no rate
+    limit). A session's first call is turned away with LLMBusy when
+    max_waiting calls are already queued or it waits longer than max_wait
+    seconds. Later calls of a session that is under way always wait their
+    turn, so admitted sessions aren't abandoned half way.
+    """
+
+    def __init__(self, max_concurrent=4, rate=0.0, burst=5, max_waiting=16, max_wait=10.0):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._rejected = 0
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self, admission=True):
+        with self._cond:
+            if admission and self._waiting >= self.max_waiting:
+                self._rejected += 1
+                raise LLMBusy(f"{self._waiting} model calls are already waiting.")
+            give_up = time.monotonic() + self.max_wait if admission else None
+            self._waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    has_token = self.rate <= 0 or self._tokens >= 1
+                    if self._active < self.max_concurrent and has_token:
+                        self._active += 1
+                        if self.rate > 0:
+                            self._tokens -= 1
+                        return
+                    timeout = None if give_up is None else give_up - now
+                    if timeout is not None and timeout <= 0:
+                        self._rejected += 1
+                        raise LLMBusy(f"Waited {self.max_wait:g}s for a model call slot.")
+                    if self._active < self.max_concurrent:
+                        # Only short of a token: wake up when the next one is due.
+                        refill = (1 - self._tokens) / self.rate
+                        timeout = refill if timeout is None else min(timeout, refill)
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"active": self._active, "waiting": self._waiting, "rejected": self._rejected,
+                    "max_concurrent": self.max_concurrent, "rate": self.rate}
+
+class LimitedBackend:
+    """Wraps another backend so every model call goes through a CallLimiter."""
+
+    def __init__(self, inner, limiter):
+        self.inner = inner
+        self.limiter = limiter
+
+    def start_chat(self, instruction=None, deadline=None):
+        """deadline (epoch seconds) is when the session's calls stop counting against the limiter."""
+        return _LimitedChat(self.inner.start_chat(instruction), self.limiter, deadline)
+
+class _LimitedChat(_Chat):
+    def __init__(self, chat, limiter, deadline=None):
+        self._chat = chat
+        self._limiter = limiter
+        self._deadline = deadline
+        self._started = False
+
+    @contextlib.contextmanager
+    def _slot(self):
+        self._limiter.acquire(admission=not self._started)
+        self._started = True
+        released = threading.Lock()
+
+        def release():
+            # Whichever comes first, the call returning or the deadline, gives the slot back.
+            if released.acquire(blocking=False):
+                self._limiter.release()
+
+        timer = None
+        if self._deadline is not None:
+            # A call hung past the session's deadline mustn't keep others from the model.
+            timer = threading.Timer(max(0.0, self._deadline - time.time()), release)
+            timer.daemon = True
+            timer.start()
+        try:
+            yield
+        finally:
+            if timer is not None:
+                timer.cancel()
+            release()
+
+    def send_message(self, content):
+        with self._slot():
+            return self._chat.send_message(content)
+
+    def stream_message(self, content):
+        with self._slot():
+            yield from self._chat.stream_message(content)
+
+def create_backend(model_name, system_instruction, tools, temperature):
+    """Builds the backend selected by QAPI_LLM_BACKEND, behind the call limiter."""
+    kind = os.getenv("QAPI_LLM_BACKEND", "gemini")
+    recordings_dir = os.getenv("QAPI_RECORDINGS_DIR", "recordings")
+    if kind == "gemini":
+        backend = GeminiBackend(model_name, system_instruction, tools, temperature)
+    elif kind == "stub":
+        latency = float(os.getenv("QAPI_STUB_LATENCY", "0"))
+        script_path = os.getenv("QAPI_STUB_SCRIPT")
+        backend = StubBackend.from_file(script_path, latency) if script_path else StubBackend(latency=latency)
+    elif kind == "record":
+        backend = RecordingBackend(GeminiBackend(model_name, system_instruction, tools, temperature), recordings_dir)
+    elif kind == "replay":
+        backend = ReplayBackend(recordings_dir, strict=os.getenv("QAPI_REPLAY_STRICT") == "1")
+    else:
+        raise ValueError(f"Unknown QAPI_LLM_BACKEND '{kind}'.")
+    return LimitedBackend(backend, CallLimiter(
+        max_concurrent=int(os.getenv("QAPI_LLM_MAX_CONCURRENT", "4")),
+        rate=float(os.getenv("QAPI_LLM_RATE", "0")),
+        burst=int(os.getenv("QAPI_LLM_BURST", "5")),
+        max_waiting=int(os.getenv("QAPI_LLM_MAX_WAITING", "16")),
+        max_wait=float(os.getenv("QAPI_LLM_MAX_WAIT", "10")),
+    ))
@@ -0,0 +1,174 @@
+"""
+Locks that keep the stores consistent under a threaded, multi-process server.
+
+Each store gets a StoreLock: a reader/writer lock between the threads of one
+process, plus an advisory lock on data/<store>.lock between processes
+(fcntl.flock, or msvcrt.locking on Windows). Readers only take the
+in-process side; store files are replaced atomically (temp file + rename),
+so another process can never be seen half way through a write. Writers take
+both sides, so a read-modify-write in one worker can't lose another
+worker's change.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+class RWLock:
+    """Many readers or one writer. Waiting writers go before new readers."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = None         # thread holding the write lock
+        self._write_depth = 0
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writer is threading.current_thread():
+                # A writer may read what it is about to change.
+                self._write_depth += 1
+                return
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            if self._writer is threading.current_thread():
+                self._write_depth -= 1
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._write_depth += 1
+                return
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._write_depth -= 1
+            if not self._write_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+class FileLock:
+    """An exclusive advisory lock on a file, shared by nothing else in this process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self.path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            return
+        self._file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                time.sleep(0.01)
+
+    def release(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def try_acquire(self):
+        """Takes the lock if nobody holds it. Returns whether it did."""
+        self._file = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+
+class StoreLock:
+    def __init__(self, lock_path):
+        self._rw = RWLock()
+        self._file_lock = FileLock(lock_path)
+        self._file_depth = 0  # only touched by the thread holding the write lock
+
+    @contextlib.contextmanager
+    def read(self):
+        self._rw.acquire_read()
+        try:
+            yield
+        finally:
+            self._rw.release_read()
+
+    @contextlib.contextmanager
+    def write(self):
+        self._rw.acquire_write()
+        try:
+            if not self._file_depth:
+                self._file_lock.acquire()
+            self._file_depth += 1
+            try:
+                yield
+            finally:
+                self._file_depth -= 1
+                if not self._file_depth:
+                    self._file_lock.release()
+        finally:
+            self._rw.release_write()
+
+_store_locks = {}
+_store_locks_lock = threading.Lock()
+
+def get_store_lock(data_dir, store_name):
+    """Returns the shared StoreLock for a store."""
+    with _store_locks_lock:
+        lock = _store_locks.get(store_name)
+        if lock is None:
+            lock = _store_locks[store_name] = StoreLock(os.path.join(data_dir, f"{store_name}.lock"))
+        return lock
+
+def atomic_write_json(path, data):
+    """Writes data to path through a temp file and a rename, so readers see the old or the new file, never half of one."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
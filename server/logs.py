@@ -0,0 +1,113 @@
+"""
+Logging setup for the server.
+
+Log calls only put the record on a queue; a QueueListener thread formats
+and writes them, so request threads never wait on the log file. The file
+rotates by size (QAPI_LOG_MAX_BYTES, QAPI_LOG_BACKUPS) or, if
+QAPI_LOG_ROTATE_WHEN is set (e.g. "midnight"), by time.
+
+Several processes may log to the same file (server workers). Only one of
+them rotates it: the first to take <file>.lock. The others write through a
+WatchedFileHandler, which reopens the file once it has been rotated away.
+If that process exits, the file stops rotating until the next start. With
+QAPI_LOG_ROTATE=external no process rotates, and every one reopens the file
+after an outside tool (e.g. logrotate) moves it.
+
+QAPI_LOG_LEVEL sets the root level and QAPI_LOG_LEVELS overrides it per
+logger, e.g. "werkzeug=WARNING,server.app=DEBUG". QAPI_LOG_FORMAT=json
+writes one JSON object per line. Every record carries the id of the request
+it was logged for (request_id_var), which also follows the request into its
+jobs and tool threads.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from server.locks import FileLock
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+# Chatty third-party loggers, quietened unless QAPI_LOG_LEVELS says otherwise.
+QUIET_LOGGERS = {"werkzeug": "WARNING", "urllib3": "WARNING", "google": "WARNING", "grpc": "WARNING",
+                 "httpx": "WARNING"}
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s %(threadName)s [%(request_id)s] : %(message)s'
+
+_listener = None
+_rotation_lock = None  # held for good by the process that rotates the log
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def parse_levels(spec):
+    """Turns "name=LEVEL,name=LEVEL" into {name: LEVEL}."""
+    levels = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def _file_handler(filename):
+    global _rotation_lock
+    if os.getenv("QAPI_LOG_ROTATE") == "external":
+        return logging.handlers.WatchedFileHandler(filename, encoding="utf-8")
+    lock = FileLock(f"{filename}.lock")
+    if not lock.try_acquire():
+        # Another process rotates this file; renaming it under that process would lose lines.
+        return logging.handlers.WatchedFileHandler(filename, encoding="utf-8")
+    _rotation_lock = lock
+    when = os.getenv("QAPI_LOG_ROTATE_WHEN")
+    backups = int(os.getenv("QAPI_LOG_BACKUPS", "5"))
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(filename, when=when, backupCount=backups, encoding="utf-8")
+    return logging.handlers.RotatingFileHandler(filename, maxBytes=int(os.getenv("QAPI_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+                                                backupCount=backups, encoding="utf-8")
+
+def setup_logging(filename):
+    """Routes every log record through a queue to a rotating file. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = _file_handler(filename)
+    if os.getenv("QAPI_LOG_FORMAT", "text") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(os.getenv("QAPI_LOG_LEVEL", "INFO").upper())
+    for name, level in {**QUIET_LOGGERS, **parse_levels(os.getenv("QAPI_LOG_LEVELS"))}.items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    # Write out whatever is still queued on exit.
+    atexit.register(_listener.stop)
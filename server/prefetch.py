@@ -0,0 +1,131 @@
+"""
+Speculative store prefetch for the first model turn.
+
+Most sessions start by reading the same stores (the system prompt tells the
+model to read a store before appending to it, and the daily timeheap always
+needs the goals and priorities), which costs a round trip or two before any
+real work happens. The prefetcher picks the stores a session will probably
+need and attaches compact snapshots of them to the first message:
+
+* per-endpoint rules (RULES), always prefetched;
+* learned frequencies: a store the model touched in at least MIN_RATE of the
+  last sessions of that endpoint is prefetched too, once MIN_SESSIONS are seen.
+
+After the session it records which prefetched stores the model didn't read
+again (hits), which it read again anyway and which it read without them being
+prefetched, so hit rates (and the round trips saved) can be watched on
+/healthcheck. A snapshot the model neither read again nor touched counts as a
+hit too: it may have answered from it, and there's no telling it didn't.
+"""
+import collections
+import logging
+import os
+import threading
+from server.budget import measure
+from server.handlers import LIST_STORES, load_summaries, read_data
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("QAPI_PREFETCH", "1") == "1"
+RULES = {
+    "create_daily_timeheap": ["user_goals_map", "priorities", "timeheap"],
+}
+MIN_SESSIONS = int(os.getenv("QAPI_PREFETCH_MIN_SESSIONS", "5"))
+MIN_RATE = float(os.getenv("QAPI_PREFETCH_MIN_RATE", "0.5"))
+MAX_STORES = int(os.getenv("QAPI_PREFETCH_MAX_STORES", "4"))
+# Only the first page of a list store goes in, as ids and truncated descs.
+PAGE_SIZE = int(os.getenv("QAPI_PREFETCH_PAGE_SIZE", "50"))
+# Other stores go in whole only if they are smaller than this.
+MAX_STORE_BYTES = int(os.getenv("QAPI_PREFETCH_MAX_STORE_BYTES", "8000"))
+# Learned frequencies are taken over this many recent sessions per endpoint.
+WINDOW = 50
+
+# Tool calls that fetch a whole store (or its first page), i.e. what a prefetch replaces.
+def _is_full_read(name, args):
+    if name == "read_data":
+        return True
+    if name == "load_memory":
+        return not args.get("entry_id")
+    if name == "load_summaries":
+        return not args.get("cursor")
+    return False
+
+class Prefetcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._history = collections.defaultdict(lambda: collections.deque(maxlen=WINDOW))  # kind -> touched store sets
+        self._stats = collections.Counter()
+
+    def plan(self, kind):
+        """Returns the stores to prefetch for a session of this endpoint."""
+        stores = list(RULES.get(kind, []))
+        with self._lock:
+            history = self._history[kind]
+            if len(history) >= MIN_SESSIONS:
+                counts = collections.Counter(store for touched in history for store in touched)
+                for store, count in counts.most_common():
+                    if count / len(history) < MIN_RATE:
+                        break
+                    if store not in stores:
+                        stores.append(store)
+        return stores[:MAX_STORES]
+
+    def snapshot(self, stores):
+        """Returns {store: compact snapshot} for the stores that could be read and are small enough."""
+        snapshots = {}
+        for store in stores:
+            if store in LIST_STORES:
+                value = load_summaries(store, limit=PAGE_SIZE)
+            else:
+                value = read_data(store)
+                if measure(value)[0] > MAX_STORE_BYTES:
+                    continue
+            if isinstance(value, dict) and "error" in value:
+                continue
+            snapshots[store] = value
+        return snapshots
+
+    def record(self, kind, prefetched, calls):
+        """
+        Learns from a finished session. calls is every (name, args) the model made.
+        """
+        touched = {args.get("store_name") for _, args in calls if args.get("store_name")}
+        reread = {args.get("store_name") for name, args in calls if _is_full_read(name, args)}
+        # A snapshot answers without any tool call, so every prefetched store the model didn't read again is a hit.
+        used = prefetched - reread
+        with self._lock:
+            # Count hits as touched, or a prefetch that works would stop being learned.
+            self._history[kind].append(touched | used)
+            self._stats["sessions"] += 1
+            self._stats["prefetched"] += len(prefetched)
+            self._stats["hits"] += len(used)
+            self._stats["rereads"] += len(prefetched & reread)
+            self._stats["misses"] += len(reread - prefetched)
+        logger.debug("Prefetch for %s: prefetched %s, touched %s, read %s.",
+                     kind, sorted(prefetched), sorted(touched), sorted(reread))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        prefetched = stats.get("prefetched", 0)
+        reads = stats.get("hits", 0) + stats.get("misses", 0)
+        # A hit is a prefetched store the model didn't read itself: one read, and usually one round trip, saved.
+        stats["hit_rate"] = stats.get("hits", 0) / prefetched if prefetched else 0.0
+        stats["coverage"] = stats.get("hits", 0) / reads if reads else 0.0
+        return stats
+
+_prefetcher = Prefetcher()
+
+def prefetch(kind):
+    """Returns (stores, snapshots) to attach to the first message of a session, or empty ones if disabled."""
+    if not ENABLED:
+        return [], {}
+    snapshots = _prefetcher.snapshot(_prefetcher.plan(kind))
+    return list(snapshots), snapshots
+
+def record_session(kind, prefetched, calls):
+    if ENABLED:
+        _prefetcher.record(kind, set(prefetched), calls)
+
+def get_prefetch_stats():
+    return _prefetcher.stats()
@@ -0,0 +1,132 @@
+"""
+Local full-text search over the list stores.
+
+An inverted index with BM25 ranking over each entry's description (or its
+truncated_desc when there is no description). The index follows the stores
+through their change logs: every append_data/write_data/delete_data_entry
+shows up there as add/update/delete records, which are applied to the index
+the next time it is searched. A store is only re-indexed from scratch when
+its changes are no longer known (first use, or the file changed on disk).
+"""
+import collections
+import heapq
+import math
+import re
+import threading
+from server.handlers import LIST_STORES, get_changes, read_data_with_version
+from server.metrics import timed
+
+# Standard BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower()) if isinstance(text, str) else []
+
+def _entry_text(entry):
+    return entry.get("description") or entry.get("truncated_desc") or ""
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}       # (store, id) -> (length, truncated_desc, terms)
+        self._postings = collections.defaultdict(dict)  # term -> {(store, id): term frequency}
+        self._total_length = 0
+        self._store_ids = collections.defaultdict(set)  # store -> ids indexed for it
+        self._versions = {}   # store -> store version the index is at
+
+    def _add(self, store_name, entry):
+        if not isinstance(entry, dict) or entry.get("id") is None:
+            return
+        key = (store_name, entry["id"])
+        self._remove(key)
+        terms = tokenize(_entry_text(entry))
+        counts = collections.Counter(terms)
+        for term, count in counts.items():
+            self._postings[term][key] = count
+        self._docs[key] = (len(terms), entry.get("truncated_desc") or _entry_text(entry)[:100], tuple(counts))
+        self._total_length += len(terms)
+        self._store_ids[store_name].add(entry["id"])
+
+    def _remove(self, key):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+        self._total_length -= doc[0]
+        self._store_ids[key[0]].discard(key[1])
+        for term in doc[2]:
+            del self._postings[term][key]
+            if not self._postings[term]:
+                del self._postings[term]
+
+    def _reindex(self, store_name, entries):
+        for entry_id in list(self._store_ids[store_name]):
+            self._remove((store_name, entry_id))
+        for entry in entries if isinstance(entries, list) else []:
+            self._add(store_name, entry)
+
+    def sync(self, store_name):
+        """Brings one store's part of the index up to date. Caller holds self._lock."""
+        since = self._versions.get(store_name)
+        changes = None
+        if since is not None:
+            version, changes = get_changes(store_name, since)
+        if changes is None:
+            data, version = read_data_with_version(store_name)
+            if isinstance(data, dict) and "error" in data:
+                return
+            self._reindex(store_name, data)
+        else:
+            for change in changes:
+                if change["op"] == "delete":
+                    self._remove((store_name, change["id"]))
+                else:
+                    self._add(store_name, change["entry"])
+        self._versions[store_name] = version
+
+    def search(self, query, limit=10, stores=None):
+        """
+        Returns up to `limit` hits as {"store", "id", "score", "truncated_desc"},
+        best first.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            for store_name in stores or LIST_STORES:
+                self.sync(store_name)
+            wanted = set(stores) if stores else None
+            total_docs = len(self._docs)
+            if not terms or not total_docs:
+                return []
+            average_length = self._total_length / total_docs or 1
+            scores = collections.defaultdict(float)
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, frequency in postings.items():
+                    if wanted is not None and key[0] not in wanted:
+                        continue
+                    length = self._docs[key][0]
+                    scores[key] += idf * frequency * (K1 + 1) / (
+                        frequency + K1 * (1 - B + B * length / average_length))
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [{"store": store_name, "id": entry_id, "score": round(score, 4),
+                     "truncated_desc": self._docs[(store_name, entry_id)][1]}
+                    for (store_name, entry_id), score in best]
+
+    def stats(self):
+        with self._lock:
+            return {"documents": len(self._docs), "terms": len(self._postings)}
+
+_index = SearchIndex()
+
+@timed(name="search_index")
+def search(query, limit=10, stores=None):
+    """Ranks list store entries against a query with BM25."""
+    return _index.search(query, limit, stores)
+
+def get_index_stats():
+    return _index.stats()
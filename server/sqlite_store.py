@@ -0,0 +1,307 @@
+"""
+SQLite storage for the data stores (QAPI_STORE_MODE=sqlite).
+
+Everything lives in one database (QAPI_SQLITE_PATH, data/qapi.db by
+default) in WAL mode, so readers don't block the writer and several server
+processes can share it. Each list store is its own table, one row per entry:
+
+    seq       insertion order (the order read_data returns)
+    id        indexed, for lookups and deletes
+    due_ts    due_date as epoch seconds, indexed, for range queries
+    entry_ts  entry_date as epoch seconds, indexed
+    data      the entry as JSON
+
+Other stores (priorities) are one JSON value each in the `value_stores`
+table. `store_versions` holds a counter per store that every write bumps in
+the same transaction, so a process can tell when another one changed a store.
+
+SqliteListStore gives handlers the read side of ListStore with every lookup,
+page and range query done in SQL, so nothing loads a whole table unless it
+asks for every entry.
+
+To move the JSON files in data/ into the database once:
+
+    python -m server.sqlite_store migrate [--data-dir data] [--db data/qapi.db] [--force]
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+from server.index import DATE_FIELDS, ListStore, parse_timestamp
+
+_STORE_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# entry field -> column holding it as epoch seconds
+_DATE_COLUMNS = {"due_date": "due_ts", "entry_date": "entry_ts"}
+
+def _table(store_name):
+    if not _STORE_NAME_RE.match(store_name):
+        raise ValueError(f"Invalid store name '{store_name}'.")
+    return f'"store_{store_name}"'
+
+class SqliteBackend:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._tables = set()
+        self._tables_lock = threading.Lock()
+        # store -> (version, entries): whole-table reads, reused until the store's version moves on
+        self._entries_cache = {}
+        self._entries_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS store_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS value_stores (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+            """)
+
+    def _connect(self):
+        """Returns this thread's connection (sqlite3 connections can't be shared between threads)."""
+        conn = getattr(self._local, "conn", None)
+        # A forked child must not reuse its parent's connection.
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _has_table(self, conn, store_name):
+        if store_name in self._tables:
+            return True
+        found = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                             (f"store_{store_name}",)).fetchone()
+        if found:
+            with self._tables_lock:
+                self._tables.add(store_name)
+        return bool(found)
+
+    def _create_table(self, conn, store_name):
+        table = _table(store_name)
+        conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT, due_ts REAL, entry_ts REAL, data TEXT NOT NULL)""")
+        for column in ("id", "due_ts", "entry_ts"):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "store_{store_name}_{column}" ON {table} ({column})')
+        with self._tables_lock:
+            self._tables.add(store_name)
+
+    def kind(self, store_name):
+        """'list', 'value', or None if the store has never been written."""
+        conn = self._connect()
+        if self._has_table(conn, store_name):
+            return "list"
+        if conn.execute("SELECT 1 FROM value_stores WHERE name = ?", (store_name,)).fetchone():
+            return "value"
+        return None
+
+    def version(self, store_name):
+        row = self._connect().execute("SELECT version FROM store_versions WHERE name = ?", (store_name,)).fetchone()
+        return row[0] if row else 0
+
+    # Reads
+
+    def read_value(self, store_name):
+        row = self._connect().execute("SELECT data FROM value_stores WHERE name = ?", (store_name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self, store_name):
+        return self._connect().execute(f"SELECT COUNT(*) FROM {_table(store_name)}").fetchone()[0]
+
+    def size_bytes(self, store_name):
+        if self.kind(store_name) == "value":
+            row = self._connect().execute("SELECT length(data) FROM value_stores WHERE name = ?", (store_name,)).fetchone()
+        else:
+            row = self._connect().execute(f"SELECT SUM(length(data)) FROM {_table(store_name)}").fetchone()
+        return (row[0] or 0) if row else 0
+
+    def entries(self, store_name):
+        """Every entry in order. The list is shared between callers: don't modify it."""
+        # Version first: if a write lands in between, the entries are newer than the version
+        # they're cached under, and the next call just reads them again.
+        version = self.version(store_name)
+        with self._entries_lock:
+            cached = self._entries_cache.get(store_name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        rows = self._connect().execute(f"SELECT data FROM {_table(store_name)} ORDER BY seq")
+        entries = [json.loads(data) for data, in rows]
+        with self._entries_lock:
+            self._entries_cache[store_name] = (version, entries)
+        return entries
+
+    def get(self, store_name, entry_id):
+        row = self._connect().execute(f"SELECT data FROM {_table(store_name)} WHERE id = ? ORDER BY seq LIMIT 1",
+                                      (entry_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def page(self, store_name, after_id=None, limit=50):
+        """Like ListStore.page. Raises KeyError if after_id is gone."""
+        conn = self._connect()
+        table = _table(store_name)
+        after_seq = 0
+        if after_id is not None:
+            row = conn.execute(f"SELECT seq FROM {table} WHERE id = ? ORDER BY seq LIMIT 1", (after_id,)).fetchone()
+            if row is None:
+                raise KeyError(after_id)
+            after_seq = row[0]
+        rows = conn.execute(f"SELECT data FROM {table} WHERE seq > ? ORDER BY seq LIMIT ?",
+                            (after_seq, limit + 1)).fetchall()
+        return [json.loads(data) for data, in rows[:limit]], len(rows) > limit
+
+    def find_by_date(self, store_name, field, start=None, end=None, limit=None):
+        if field not in DATE_FIELDS:
+            raise ValueError(f"No index on '{field}'. Indexed fields: {', '.join(DATE_FIELDS)}")
+        column = _DATE_COLUMNS[field]
+        conditions, params = [f"{column} IS NOT NULL"], []
+        if start is not None:
+            conditions.append(f"{column} >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append(f"{column} <= ?")
+            params.append(end)
+        sql = f"SELECT data FROM {_table(store_name)} WHERE {' AND '.join(conditions)} ORDER BY {column}, seq"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [json.loads(data) for data, in self._connect().execute(sql, params)]
+
+    # Writes: each one is a transaction that also bumps the store's version.
+
+    @staticmethod
+    def _row(entry):
+        entry_id = entry.get("id") if isinstance(entry, dict) else None
+        timestamps = [parse_timestamp(entry.get(field)) if isinstance(entry, dict) else None for field in DATE_FIELDS]
+        data = json.dumps(entry)
+        return (None if entry_id is None else str(entry_id), *timestamps, data)
+
+    def _insert(self, conn, store_name, entries):
+        rows = [self._row(entry) for entry in entries]
+        conn.executemany(f"INSERT INTO {_table(store_name)} (id, due_ts, entry_ts, data) VALUES (?, ?, ?, ?)", rows)
+        return sum(len(row[-1]) for row in rows)
+
+    def _bump(self, conn, store_name):
+        conn.execute("INSERT INTO store_versions (name, version) VALUES (?, 1) "
+                     "ON CONFLICT(name) DO UPDATE SET version = version + 1", (store_name,))
+        return conn.execute("SELECT version FROM store_versions WHERE name = ?", (store_name,)).fetchone()[0]
+
+    def apply(self, store_name, op):
+        """
+        Applies one mutation ({"op": "write" | "append" | "delete" | "batch", ...})
+        in a transaction. Returns (new version, bytes written).
+        """
+        conn = self._connect()
+        written = 0
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            kind = op["op"]
+            if kind == "write" and not isinstance(op["data"], list):
+                if self._has_table(conn, store_name):
+                    conn.execute(f"DROP TABLE {_table(store_name)}")
+                    with self._tables_lock:
+                        self._tables.discard(store_name)
+                data = json.dumps(op["data"])
+                conn.execute("INSERT OR REPLACE INTO value_stores (name, data) VALUES (?, ?)", (store_name, data))
+                written = len(data)
+            else:
+                conn.execute("DELETE FROM value_stores WHERE name = ?", (store_name,))
+                self._create_table(conn, store_name)
+                if kind == "write":
+                    conn.execute(f"DELETE FROM {_table(store_name)}")
+                    written = self._insert(conn, store_name, op["data"])
+                elif kind == "append":
+                    written = self._insert(conn, store_name, [op["entry"]])
+                elif kind == "delete":
+                    conn.executemany(f"DELETE FROM {_table(store_name)} WHERE id = ?",
+                                     [(str(entry_id),) for entry_id in op.get("ids") or [op["id"]]])
+                elif kind == "batch":
+                    conn.executemany(f"DELETE FROM {_table(store_name)} WHERE id = ?",
+                                     [(str(entry_id),) for entry_id in op.get("delete", ())])
+                    rows = [self._row(entry) for entry in op.get("update", ())]
+                    conn.executemany(f"UPDATE {_table(store_name)} SET due_ts = ?, entry_ts = ?, data = ? WHERE id = ?",
+                                     [(*row[1:], row[0]) for row in rows])
+                    written = sum(len(row[-1]) for row in rows)
+                    written += self._insert(conn, store_name, op.get("append", ()))
+                else:
+                    raise ValueError(f"Unknown op '{kind}'")
+            return self._bump(conn, store_name), written
+
+class SqliteListStore(ListStore):
+    """
+    The read side of ListStore for a list store kept in SQLite. Every call
+    goes to the database; nothing is held in memory.
+    """
+
+    def __init__(self, backend, store_name):
+        self._backend = backend
+        self.store_name = store_name
+
+    def __len__(self):
+        return self._backend.count(self.store_name)
+
+    def entries(self):
+        return self._backend.entries(self.store_name)
+
+    def get(self, entry_id):
+        return self._backend.get(self.store_name, entry_id)
+
+    def page(self, after_id=None, limit=50):
+        return self._backend.page(self.store_name, after_id, limit)
+
+    def find_by_date(self, field, start=None, end=None, limit=None):
+        return self._backend.find_by_date(self.store_name, field, start, end, limit)
+
+    def append(self, entry):
+        raise TypeError("SqliteListStore is read-only; write through the handlers.")
+
+    def delete(self, entry_id):
+        raise TypeError("SqliteListStore is read-only; write through the handlers.")
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(path):
+    """Returns the shared SqliteBackend for a database file."""
+    with _backends_lock:
+        backend = _backends.get(path)
+        if backend is None:
+            backend = _backends[path] = SqliteBackend(path)
+        return backend
+
+def migrate(data_dir, db_path, force=False):
+    """
+    Copies every data/<store>.json into the database, one transaction per
+    store. Stores already in the database are skipped unless force is set.
+    Returns {store: entries copied (or "skipped")}.
+    """
+    backend = get_backend(db_path)
+    report = {}
+    for name in sorted(os.listdir(data_dir)):
+        store_name, extension = os.path.splitext(name)
+        if extension != ".json" or not _STORE_NAME_RE.match(store_name):
+            continue
+        if backend.kind(store_name) is not None and not force:
+            report[store_name] = "skipped"
+            continue
+        with open(os.path.join(data_dir, name), 'r') as f:
+            data = json.load(f)
+        backend.apply(store_name, {"op": "write", "data": data})
+        report[store_name] = len(data) if isinstance(data, list) else "value"
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Qapi SQLite store tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="Copy the JSON stores into the SQLite database.")
+    default_data_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
+    migrate_parser.add_argument("--data-dir", default=default_data_dir)
+    migrate_parser.add_argument("--db", help="Database path (default: QAPI_SQLITE_PATH or <data-dir>/qapi.db).")
+    migrate_parser.add_argument("--force", action="store_true", help="Overwrite stores already in the database.")
+    args = parser.parse_args()
+
+    db_path = args.db or os.getenv("QAPI_SQLITE_PATH") or os.path.join(args.data_dir, "qapi.db")
+    for store_name, copied in migrate(args.data_dir, db_path, args.force).items():
+        print(f"{store_name}: {copied}")
+
+if __name__ == "__main__":
+    main()
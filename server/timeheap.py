@@ -0,0 +1,60 @@
+"""
+Heap operations over the timeheap store.
+
+Entries are ordered by due_date through the store's due_date index, a
+sorted array whose front is kept clear of deleted entries (see
+server/index.py). Peeking is a binary search plus a look at the head, and
+popping what is due or a range query costs O(log n + k), plus any stale
+pairs in the range. Stale pairs are compacted away before they outnumber
+the live ones, so that extra cost stays amortized. None of it walks the
+whole store. In sqlite mode the same queries run on the due_ts index.
+"""
+import time
+from server.handlers import get_list_store, delete_data_entries, locked_store
+from server.index import parse_timestamp
+from server.metrics import timed
+
+STORE_NAME = 'timeheap'
+
+@timed(name="timeheap_peek")
+def peek():
+    """Returns the entry with the earliest due_date, or None if the heap is empty."""
+    store = get_list_store(STORE_NAME)
+    if isinstance(store, dict):
+        return store
+    found = store.find_by_date("due_date", limit=1)
+    return _with_due_ts(found[0]) if found else None
+
+@timed(name="timeheap_due")
+def due(before=None, after=None, limit=None):
+    """
+    Returns entries with after <= due_ts <= before (epoch seconds, either
+    bound optional), earliest first.
+    """
+    store = get_list_store(STORE_NAME)
+    if isinstance(store, dict):
+        return store
+    return [_with_due_ts(entry) for entry in store.find_by_date("due_date", after, before, limit)]
+
+def _with_due_ts(entry):
+    # Entries written before due_ts existed get it filled in on the way out.
+    # Cached entries are shared, so copy rather than edit them.
+    if "due_ts" in entry:
+        return entry
+    return dict(entry, due_ts=parse_timestamp(entry.get("due_date")))
+
+@timed(name="timeheap_pop_due")
+def pop_due(now=None, limit=None):
+    """Removes and returns every entry that is due at `now` (defaults to the current time)."""
+    if now is None:
+        now = time.time()
+    # Locked so two callers (or server processes) can't both pop the same entries.
+    with locked_store(STORE_NAME):
+        entries = due(before=now, limit=limit)
+        if isinstance(entries, dict):
+            return entries
+        if entries:
+            result = delete_data_entries(STORE_NAME, [entry["id"] for entry in entries])
+            if "error" in result:
+                return result
+        return entries
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+import textwrap
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from server import handlers, journal, locks
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Points the handlers at an empty data directory, in file mode, with nothing cached."""
+    monkeypatch.setattr(handlers, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(handlers, "STORE_MODE", "file")
+    for name in ("_store_cache", "_store_versions", "_change_logs", "_change_log_floors", "_token_versions",
+                 "_sqlite_seen"):
+        monkeypatch.setattr(handlers, name, {})
+    # Locks and journals are shared per store name, so they'd still point at the last test's directory.
+    monkeypatch.setattr(locks, "_store_locks", {})
+    monkeypatch.setattr(journal, "_journals", {})
+    return tmp_path
+
+def run_worker(data_dir, mode, code, *args, timeout=60):
+    """
+    Runs `code` in a fresh interpreter with the handlers on data_dir in the
+    given store mode. The code sees `handlers` and `args`. Returns the process.
+    """
+    script = "import sys\nsys.path.insert(0, sys.argv[1])\nfrom server import handlers\n" \
+             "handlers.DATA_DIR = sys.argv[2]\nargs = sys.argv[3:]\n" + textwrap.dedent(code)
+    env = dict(os.environ, QAPI_STORE_MODE=mode)
+    return subprocess.Popen([sys.executable, "-c", script, ROOT, str(data_dir), *map(str, args)], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+def wait(process, timeout=60):
+    out, err = process.communicate(timeout=timeout)
+    assert process.returncode == 0, err
+    return out
@@ -0,0 +1,77 @@
+import json
+import pytest
+from server import handlers
+
+def stored_ids(data_dir, store_name):
+    with open(data_dir / f"{store_name}.json") as f:
+        return [entry["id"] for entry in json.load(f)]
+
+@pytest.fixture
+def tasks(data_dir):
+    for entry_id in ("a", "b", "c"):
+        assert "success" in handlers.append_data("agent_tasks", {"id": entry_id, "description": entry_id})
+    return data_dir
+
+def test_batch_mutate_is_all_or_nothing(tasks):
+    version = handlers.get_store_version("agent_tasks")
+    result = handlers.batch_mutate([
+        {"op": "update", "store_name": "agent_tasks", "entry_id": "a", "fields": {"description": "changed"}},
+        {"op": "append", "store_name": "agent_tasks", "entry": {"description": "new"}},
+        {"op": "delete", "store_name": "agent_tasks", "entry_id": "missing"},
+    ])
+    assert "error" in result["agent_tasks"]
+    assert [entry["description"] for entry in handlers.read_data("agent_tasks")] == ["a", "b", "c"]
+    assert stored_ids(tasks, "agent_tasks") == ["a", "b", "c"]
+    assert handlers.get_store_version("agent_tasks") == version
+
+def test_batch_mutate_failing_store_doesnt_hold_back_others(tasks):
+    result = handlers.batch_mutate([
+        {"op": "delete", "store_name": "agent_tasks", "entry_id": "missing"},
+        {"op": "append", "store_name": "agent_context", "entry": {"id": "x", "description": "kept"}},
+    ])
+    assert "error" in result["agent_tasks"]
+    assert result["agent_context"]["appended"] == ["x"]
+    assert stored_ids(tasks, "agent_context") == ["x"]
+
+def test_batch_mutate_rolls_back_a_failed_write(tasks, monkeypatch):
+    def fail(path, data):
+        raise OSError("disk full")
+    monkeypatch.setattr(handlers, "atomic_write_json", fail)
+    result = handlers.batch_mutate([
+        {"op": "delete", "store_name": "agent_tasks", "entry_id": "a"},
+        {"op": "append", "store_name": "agent_tasks", "entry": {"description": "new"}},
+    ])
+    assert "disk full" in result["agent_tasks"]["error"]
+    # Neither the file nor the cache kept half of it.
+    assert stored_ids(tasks, "agent_tasks") == ["a", "b", "c"]
+    assert [entry["id"] for entry in handlers.read_data("agent_tasks")] == ["a", "b", "c"]
+
+def test_changes_since_a_version(tasks):
+    version = handlers.get_store_version("agent_tasks")
+    handlers.delete_data_entry("agent_tasks", "b")
+    handlers.batch_mutate([{"op": "update", "store_name": "agent_tasks", "entry_id": "c", "fields": {"done": True}}])
+    latest, changes = handlers.get_changes("agent_tasks", version)
+    assert latest == version + 2
+    assert [(change["op"], change["id"]) for change in changes] == [("delete", "b"), ("update", "c")]
+    assert handlers.get_changes("agent_tasks", latest) == (latest, [])
+
+def test_outside_edit_resets_the_cursor(tasks):
+    version = handlers.get_store_version("agent_tasks")
+    with open(tasks / "agent_tasks.json", "w") as f:
+        json.dump([{"id": "z", "description": "edited by hand"}], f)
+    latest, changes = handlers.get_changes("agent_tasks", version)
+    assert latest > version and changes is None
+    # From the new version on, changes are tracked again.
+    handlers.append_data("agent_tasks", {"id": "y", "description": "after"})
+    assert [change["id"] for change in handlers.get_changes("agent_tasks", latest)[1]] == ["y"]
+
+def test_version_tokens(tasks):
+    token, data = handlers.get_version_token("agent_tasks")
+    assert [entry["id"] for entry in data] == ["a", "b", "c"]
+    assert handlers.get_changes_since_token("agent_tasks", token) == (token, [])
+    handlers.append_data("agent_tasks", {"id": "d", "description": "d"})
+    new_token, changes = handlers.get_changes_since_token("agent_tasks", token)
+    assert new_token != token
+    assert [(change["op"], change["id"]) for change in changes] == [("add", "d")]
+    # A token this process never handed out can only be answered with a reset.
+    assert handlers.get_changes_since_token("agent_tasks", "unknown")[1] is None
@@ -0,0 +1,69 @@
+import random
+from server.index import ListStore, parse_timestamp
+
+def entry(number, minute):
+    return {"id": f"e{number}", "due_date": f"2030-01-01T{minute // 60:02d}:{minute % 60:02d}:00Z"}
+
+def due_ids(store, **kwargs):
+    return [found["id"] for found in store.find_by_date("due_date", **kwargs)]
+
+def test_order_after_update_and_delete():
+    store = ListStore([entry(0, 30), entry(1, 10), entry(2, 20), entry(3, 40)])
+    assert due_ids(store) == ["e1", "e2", "e0", "e3"]
+
+    store.replace("e1", entry(1, 50))
+    assert due_ids(store) == ["e2", "e0", "e3", "e1"]
+    store.delete("e2")
+    assert due_ids(store) == ["e0", "e3", "e1"]
+    assert due_ids(store, limit=1) == ["e0"]
+    store.append(entry(4, 5))
+    assert due_ids(store) == ["e4", "e0", "e3", "e1"]
+
+    # Store order is insertion order, whatever the dates say.
+    assert [found["id"] for found in store.entries()] == ["e0", "e1", "e3", "e4"]
+    page, more = store.page(limit=2)
+    assert [found["id"] for found in page] == ["e0", "e1"] and more
+    page, more = store.page(after_id="e1", limit=2)
+    assert [found["id"] for found in page] == ["e3", "e4"] and not more
+
+def test_handed_out_views_stay_unchanged():
+    store = ListStore([entry(0, 0), entry(1, 1)])
+    view = store.entries()
+    store.append(entry(2, 2))
+    store.delete("e0")
+    store.replace("e1", entry(1, 9))
+    assert [found["id"] for found in view] == ["e0", "e1"]
+    assert [found["id"] for found in store.entries()] == ["e1", "e2"]
+
+def test_matches_a_sorted_list_under_random_changes():
+    rng = random.Random(0)
+    model = {f"e{number}": entry(number, rng.randrange(1000)) for number in range(200)}
+    store = ListStore(list(model.values()))
+    next_number = len(model)
+    for step in range(3000):
+        roll = rng.random()
+        if roll < 0.3:
+            new = entry(next_number, rng.randrange(1000))
+            next_number += 1
+            store.append(new)
+            model[new["id"]] = new
+        elif roll < 0.6 and model:
+            # Popping the earliest entry is what the timeheap does most.
+            entry_id = due_ids(store, limit=1)[0] if rng.random() < 0.5 else rng.choice(list(model))
+            store.delete(entry_id)
+            del model[entry_id]
+        elif model:
+            entry_id = rng.choice(list(model))
+            changed = entry(int(entry_id[1:]), rng.randrange(1000))
+            store.replace(entry_id, changed)
+            model[entry_id] = changed
+        if step % 50 == 0:
+            low, high = sorted(rng.sample(range(1000), 2))
+            start = entry(0, low)["due_date"]
+            end = entry(0, high)["due_date"]
+            found = store.find_by_date("due_date", parse_timestamp(start), parse_timestamp(end))
+            expected = [item for item in model.values() if start <= item["due_date"] <= end]
+            assert sorted(item["id"] for item in found) == sorted(item["id"] for item in expected)
+            assert [item["due_date"] for item in found] == sorted(item["due_date"] for item in expected)
+    assert len(store) == len(model)
+    assert [item["id"] for item in store.entries()] == list(model)
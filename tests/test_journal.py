@@ -0,0 +1,42 @@
+import json
+from conftest import run_worker, wait
+
+def test_replay_after_crash(tmp_path):
+    # A few records land in the snapshot at compaction, the rest only in the journal.
+    crash = run_worker(tmp_path, "journal", """
+import os
+from server import journal
+journal.COMPACT_AFTER = 5
+for i in range(12):
+    handlers.append_data("timeheap", {"id": f"e{i}", "description": f"entry {i}",
+                                      "due_date": f"2030-01-01T00:{i:02d}:00Z"})
+handlers.delete_data_entry("timeheap", "e3")
+handlers.batch_mutate([{"op": "update", "store_name": "timeheap", "entry_id": "e4", "fields": {"description": "moved"}}])
+# No atexit handlers: no final fsync, no compaction.
+os._exit(0)
+""")
+    wait(crash)
+    assert (tmp_path / "timeheap.journal.jsonl").exists()
+
+    out = wait(run_worker(tmp_path, "journal", """
+import json
+print(json.dumps(handlers.read_data("timeheap")))
+"""))
+    entries = json.loads(out)
+    assert [entry["id"] for entry in entries] == [f"e{i}" for i in range(12) if i != 3]
+    assert next(entry for entry in entries if entry["id"] == "e4")["description"] == "moved"
+
+def test_torn_tail_is_ignored(tmp_path):
+    wait(run_worker(tmp_path, "journal", """
+import os
+handlers.append_data("agent_tasks", {"id": "a", "description": "kept"})
+os._exit(0)
+"""))
+    with open(tmp_path / "agent_tasks.journal.jsonl", "a") as f:
+        f.write('{"op": "append", "entry": {"id": "b", "desc')
+
+    out = wait(run_worker(tmp_path, "journal", """
+import json
+print(json.dumps(handlers.read_data("agent_tasks")))
+"""))
+    assert [entry["id"] for entry in json.loads(out)] == ["a"]
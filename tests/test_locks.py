@@ -0,0 +1,51 @@
+import json
+import os
+import pytest
+from conftest import run_worker, wait
+from server.locks import FileLock, StoreLock
+
+APPENDER = """
+for i in range(int(args[1])):
+    result = handlers.append_data("agent_tasks", {"id": f"{args[0]}-{i}", "description": "task"})
+    assert "success" in result, result
+"""
+
+@pytest.mark.parametrize("mode", ["file", "sqlite"])
+def test_concurrent_appends_across_processes(tmp_path, mode):
+    workers, per_worker = 4, 25
+    processes = [run_worker(tmp_path, mode, APPENDER, f"w{n}", per_worker) for n in range(workers)]
+    for process in processes:
+        wait(process)
+
+    out = wait(run_worker(tmp_path, mode, """
+import json
+print(json.dumps([entry["id"] for entry in handlers.read_data("agent_tasks")]))
+"""))
+    ids = json.loads(out)
+    # Every append made it, none twice: no worker overwrote another's read-modify-write.
+    assert sorted(ids) == sorted(f"w{n}-{i}" for n in range(workers) for i in range(per_worker))
+    for n in range(workers):
+        # Each worker's own entries keep the order it appended them in.
+        mine = [entry_id for entry_id in ids if entry_id.startswith(f"w{n}-")]
+        assert mine == [f"w{n}-{i}" for i in range(per_worker)]
+
+def test_file_lock_excludes_other_processes(tmp_path):
+    path = tmp_path / "store.lock"
+    probe = "from server.locks import FileLock\nprint(FileLock(args[0]).try_acquire())\n"
+    lock = FileLock(str(path))
+    lock.acquire()
+    try:
+        assert wait(run_worker(tmp_path, "file", probe, path)).strip() == "False"
+    finally:
+        lock.release()
+    assert wait(run_worker(tmp_path, "file", probe, path)).strip() == "True"
+
+def test_store_lock_write_is_reentrant(tmp_path):
+    lock = StoreLock(os.path.join(tmp_path, "store.lock"))
+    with lock.write():
+        # batch_mutate holds the lock around _mutate, which takes it again.
+        with lock.write():
+            with lock.read():
+                pass
+    with lock.read():
+        pass